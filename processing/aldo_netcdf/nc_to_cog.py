@@ -6,27 +6,118 @@ Each timestep becomes a separate band in the output COG.
 Handles both WRF curvilinear grids (GCPs from XLONG/XLAT) and
 PALM local grids (affine geotransform from origin_x/origin_y in EPSG:2056).
 
+Everything runs in-process through rasterio: the EPSG:3857 target grid is
+computed once per run, every timestep is reprojected straight into a single
+multi-band dataset, and the COG is written from it with the GDAL COG driver.
+
 Usage:
     # WRF (auto-detects curvilinear grid):
     uv run nc_to_cog.py -i wrfout_d03_2022-07-15_12_00_00 -v T2 -o t2_cog.tif
 
     # PALM (auto-detects local grid with origin attrs, --z-level picks height):
     uv run nc_to_cog.py -i TEST_4_3d.001-001.nc -v ta --z-level 3 -o ta_cog.tif
+
+    # PALM vertical profile, one pass over the file:
+    uv run nc_to_cog.py -i TEST_4_3d.001-001.nc -v ta --heights 1.25,10,50 -o ta_cog.tif
+
+    # Derived variables, from an expression or a named recipe (see RECIPES):
+    uv run nc_to_cog.py -i wrfout_d03_2022-07-15_12_00_00 -v "hypot(U10, V10)" -o ws_cog.tif
+    uv run nc_to_cog.py -i wrfout_d03_2022-07-15_12_00_00 -v rh2 -o rh2_cog.tif
+
+    # Batch: every input × variable of a JSON manifest, in parallel:
+    uv run nc_to_cog.py --manifest batch_manifest.json --workers 8
 """
 
 import argparse
-import shutil
-import subprocess
+import ast
+import hashlib
+import json
+import multiprocessing.util
+import os
+import resource
+import sys
 import tempfile
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
 
 try:
     import netCDF4 as nc
     import numpy as np
+    import rasterio
+    import rasterio.shutil
+    from rasterio.control import GroundControlPoint
+    from rasterio.crs import CRS
+    from rasterio.errors import NotGeoreferencedWarning
+    from rasterio.io import MemoryFile
+    from rasterio.transform import Affine
+    from rasterio.warp import Resampling, calculate_default_transform, reproject
 except ImportError:
-    print("Missing dependencies. Run: uv add netcdf4 numpy")
+    print("Missing dependencies. Run: uv add netcdf4 numpy rasterio")
     raise
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from build_cache import BuildCache  # noqa: E402
+
+DST_CRS = CRS.from_epsg(3857)
+EARTH_RADIUS = 6378137.0
+
+# Methods the WRF resampling index implements (nearest cell, barycentric
+# linear); other methods warp WRF grids with rasterio from their GCPs
+WRF_INDEX_RESAMPLING = ("nearest", "bilinear")
+
+# Bump when the on-disk WRF resampling index layout changes
+INDEX_VERSION = 1
+DEFAULT_INDEX_CACHE = Path(__file__).parent / "index_cache"
+
+RESAMPLING = {
+    "nearest": Resampling.nearest,
+    "average": Resampling.average,
+    "bilinear": Resampling.bilinear,
+    "cubic": Resampling.cubic,
+}
+
+# Named derived variables for -v, evaluated per timestep (see _compile_expression)
+RECIPES = {
+    # WRF 10 m wind speed (m/s) and meteorological direction (degrees, from)
+    "wspd10": "hypot(U10, V10)",
+    "wdir10": "(270 - degrees(arctan2(V10, U10))) % 360",
+    # WRF 2 m temperature in °C
+    "t2c": "T2 - 273.15",
+    # WRF 2 m relative humidity (%) from the mixing ratio, temperature and
+    # surface pressure (Bolton 1980 saturation vapour pressure)
+    "rh2": "clip(100 * (Q2 * PSFC / (0.622 + Q2))"
+    " / (611.2 * exp(17.67 * (T2 - 273.15) / (T2 - 29.65))), 0, 100)",
+    # PALM potential temperature in °C
+    "theta_c": "theta - 273.15",
+}
+
+# NumPy functions and constants allowed in -v expressions
+EXPRESSION_FUNCTIONS = {
+    name: getattr(np, name)
+    for name in (
+        "abs sqrt exp log log10 hypot arctan2 degrees radians sin cos tan "
+        "minimum maximum clip where floor ceil"
+    ).split()
+}
+EXPRESSION_CONSTANTS = {"pi": np.pi}
+_EXPRESSION_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Call,
+    ast.Name,
+    ast.Constant,
+    ast.Load,
+    ast.operator,
+    ast.unaryop,
+    ast.cmpop,
+)
+
 
 def get_netcdf_info(input_path: str) -> dict:
     """Inspect a NetCDF file and return dimension/variable/coordinate info."""
@@ -110,149 +201,637 @@ def _get_palm_geotransform(ds: nc.Dataset) -> tuple[float, float, float, float,
     return top_left_x, top_left_y, dx, dy, "EPSG:2056"
 
 
-def _extract_timestep(var_data, t: int, z_level: int | None = None) -> np.ndarray:
-    """Extract a 2D slice from a variable at timestep t.
+def _wrf_gcps(
+    lon_2d: np.ndarray, lat_2d: np.ndarray, gcp_step: int = 10
+) -> list[GroundControlPoint]:
+    """Build GCPs every gcp_step cells (plus the four corners) for a WRF grid."""
+    height, width = lon_2d.shape
+    cells = [
+        (row, col)
+        for row in range(0, height, gcp_step)
+        for col in range(0, width, gcp_step)
+    ]
+    cells += [(0, 0), (0, width - 1), (height - 1, 0), (height - 1, width - 1)]
+    return [
+        GroundControlPoint(
+            row=row + 0.5,
+            col=col + 0.5,
+            x=float(lon_2d[row, col]),
+            y=float(lat_2d[row, col]),
+            z=0.0,
+        )
+        for row, col in cells
+    ]
+
 
-    For 4D data (time, z, y, x), uses z_level if provided, else level 0.
+def _source_georef(
+    grid_type: str,
+    lon_2d: np.ndarray | None = None,
+    lat_2d: np.ndarray | None = None,
+    palm_gt: tuple[float, float, float, float, str] | None = None,
+) -> dict:
+    """Return the rasterio source georeferencing kwargs for a grid.
+
+    WRF grids are described by GCPs in EPSG:4326, PALM grids by an affine
+    transform in EPSG:2056 (rows ordered north to south, see SlabReader).
     """
-    shape = var_data.shape
-    if len(shape) == 4:
-        # (time, z, y, x)
-        z = z_level if z_level is not None else 0
-        data = var_data[t, z, :, :]
-    elif len(shape) == 3:
-        # (time, y, x)
-        data = var_data[t, :, :]
+    if grid_type == "wrf":
+        return {
+            "gcps": _wrf_gcps(lon_2d, lat_2d),
+            "src_crs": CRS.from_epsg(4326),
+        }
+    top_left_x, top_left_y, dx, dy, srs = palm_gt
+    return {
+        "src_transform": Affine(dx, 0.0, top_left_x, 0.0, -dy, top_left_y),
+        "src_crs": CRS.from_string(srs),
+    }
+
+
+def _target_grid(src_georef: dict, shape: tuple[int, int]) -> dict:
+    """Compute the EPSG:3857 target grid once for a source grid."""
+    height, width = shape
+    if "gcps" in src_georef:
+        transform, dst_width, dst_height = calculate_default_transform(
+            src_georef["src_crs"], DST_CRS, width, height, gcps=src_georef["gcps"]
+        )
     else:
-        data = var_data[t]
-
-    if hasattr(data, "mask"):
-        data = np.ma.filled(data, fill_value=np.nan)
-
-    return np.asarray(data, dtype=np.float32)
-
-
-def _run_cmd(cmd: list[str], label: str):
-    """Run a subprocess command, raising on failure."""
-    print(f"  Running: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"{label} failed:\n{result.stderr}")
-    if result.stdout.strip():
-        for line in result.stdout.strip().split("\n")[:5]:
-            print(f"    {line}")
-
-
-def _write_wrf_geotiff(
-    data: np.ndarray,
-    lon_2d: np.ndarray,
-    lat_2d: np.ndarray,
-    output_path: Path,
-    gcp_step: int = 10,
-):
-    """Write a single-band GeoTIFF with GCPs for WRF curvilinear grids."""
-    height, width = data.shape
-
-    bil_path = output_path.with_suffix(".bil")
-    hdr_path = output_path.with_suffix(".hdr")
-    data.astype("<f4").tofile(bil_path)
-    hdr_path.write_text(
-        f"NROWS {height}\n"
-        f"NCOLS {width}\n"
-        f"NBANDS 1\n"
-        f"NBITS 32\n"
-        f"PIXELTYPE FLOAT\n"
-        f"BYTEORDER I\n"
-        f"LAYOUT BIL\n"
-    )
+        t = src_georef["src_transform"]
+        left, top = t.c, t.f
+        right, bottom = left + t.a * width, top + t.e * height
+        transform, dst_width, dst_height = calculate_default_transform(
+            src_georef["src_crs"], DST_CRS, width, height, left, bottom, right, top
+        )
+    return {"transform": transform, "width": dst_width, "height": dst_height}
 
-    gcps = []
-    for row in range(0, height, gcp_step):
-        for col in range(0, width, gcp_step):
-            lon = float(lon_2d[row, col])
-            lat = float(lat_2d[row, col])
-            gcps.append(f"-gcp {col + 0.5} {row + 0.5} {lon} {lat}")
-    for row, col in [(0, 0), (0, width - 1), (height - 1, 0), (height - 1, width - 1)]:
-        lon = float(lon_2d[row, col])
-        lat = float(lat_2d[row, col])
-        gcps.append(f"-gcp {col + 0.5} {row + 0.5} {lon} {lat}")
-
-    cmd = [
-        "gdal_translate",
-        "-of", "GTiff",
-        "-a_srs", "EPSG:4326",
-    ]
-    for gcp in gcps:
-        cmd.extend(gcp.split())
-    cmd.extend([str(bil_path), str(output_path)])
-    _run_cmd(cmd, "gdal_translate (GCP embedding)")
-
-    bil_path.unlink(missing_ok=True)
-    hdr_path.unlink(missing_ok=True)
-
-
-def _write_palm_geotiff(
-    data: np.ndarray,
-    geotransform: tuple[float, float, float, float, str],
-    output_path: Path,
-):
-    """Write a single-band GeoTIFF with affine geotransform for PALM grids."""
-    height, width = data.shape
-    top_left_x, top_left_y, dx, dy, srs = geotransform
-
-    bil_path = output_path.with_suffix(".bil")
-    hdr_path = output_path.with_suffix(".hdr")
-
-    # PALM y-axis goes from south to north, but raster convention is top-to-bottom.
-    # Flip the data so row 0 = northernmost.
-    data_flipped = np.flipud(data)
-    data_flipped.astype("<f4").tofile(bil_path)
-    hdr_path.write_text(
-        f"NROWS {height}\n"
-        f"NCOLS {width}\n"
-        f"NBANDS 1\n"
-        f"NBITS 32\n"
-        f"PIXELTYPE FLOAT\n"
-        f"BYTEORDER I\n"
-        f"LAYOUT BIL\n"
-        f"ULXMAP {top_left_x + dx / 2}\n"
-        f"ULYMAP {top_left_y - dy / 2}\n"
-        f"XDIM {dx}\n"
-        f"YDIM {dy}\n"
+
+def _coords_hash(lon_2d: np.ndarray, lat_2d: np.ndarray) -> str:
+    """Hash 2D coordinate arrays into a stable cache key."""
+    h = hashlib.sha256(f"v{INDEX_VERSION}:{lon_2d.shape}".encode())
+    h.update(np.ascontiguousarray(lon_2d, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lat_2d, dtype=np.float64).tobytes())
+    return h.hexdigest()[:24]
+
+
+def _lonlat_to_mercator(
+    lon: np.ndarray, lat: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Spherical Web Mercator (EPSG:3857) forward projection."""
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def _build_wrf_index(lon_2d: np.ndarray, lat_2d: np.ndarray) -> dict:
+    """Build a destination-pixel → source-(row, col, weights) index for a WRF grid.
+
+    The source grid is split into triangles (two per cell) whose vertices are
+    the XLONG/XLAT cell centers projected to EPSG:3857. Every destination pixel
+    center that falls inside a triangle gets the flat indices of its three
+    vertices and their barycentric weights, i.e. exact piecewise-linear
+    interpolation of the curvilinear grid instead of a sparse GCP polynomial.
+    """
+    lon_2d = np.asarray(lon_2d, dtype=np.float64)
+    lat_2d = np.asarray(lat_2d, dtype=np.float64)
+    height, width = lon_2d.shape
+
+    # Same target grid as the GCP-based warp
+    grid = _target_grid(_source_georef("wrf", lon_2d=lon_2d, lat_2d=lat_2d), (height, width))
+    t = grid["transform"]
+    dst_h, dst_w = grid["height"], grid["width"]
+
+    # Source vertices in destination pixel space (pixel centers at integers)
+    mx, my = _lonlat_to_mercator(lon_2d, lat_2d)
+    px = ((mx - t.c) / t.a - 0.5).ravel()
+    py = ((my - t.f) / t.e - 0.5).ravel()
+
+    flat = np.arange(height * width, dtype=np.int64).reshape(height, width)
+    a, b = flat[:-1, :-1].ravel(), flat[:-1, 1:].ravel()
+    c, d = flat[1:, :-1].ravel(), flat[1:, 1:].ravel()
+    tri = np.stack([np.concatenate([a, b]), np.concatenate([b, d]), np.concatenate([c, c])])
+
+    idx = np.zeros((3, dst_h * dst_w), dtype=np.int32)
+    weights = np.zeros((3, dst_h * dst_w), dtype=np.float32)
+    covered = np.zeros(dst_h * dst_w, dtype=bool)
+
+    x0, x1, x2 = px[tri]
+    y0, y1, y2 = py[tri]
+    denom = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+    ok = np.abs(denom) > 1e-12
+    tri, x0, x1, x2, y0, y1, y2, denom = (
+        arr[..., ok] for arr in (tri, x0, x1, x2, y0, y1, y2, denom)
     )
 
-    cmd = [
-        "gdal_translate",
-        "-of", "GTiff",
-        "-a_srs", srs,
-        str(bil_path), str(output_path),
-    ]
-    _run_cmd(cmd, "gdal_translate (PALM geotransform)")
+    xmin = np.clip(np.ceil(np.minimum(np.minimum(x0, x1), x2)), 0, dst_w - 1).astype(np.int64)
+    xmax = np.clip(np.floor(np.maximum(np.maximum(x0, x1), x2)), -1, dst_w - 1).astype(np.int64)
+    ymin = np.clip(np.ceil(np.minimum(np.minimum(y0, y1), y2)), 0, dst_h - 1).astype(np.int64)
+    ymax = np.clip(np.floor(np.maximum(np.maximum(y0, y1), y2)), -1, dst_h - 1).astype(np.int64)
+    span_x = int((xmax - xmin).max(initial=-1)) + 1
+    span_y = int((ymax - ymin).max(initial=-1)) + 1
+
+    # Rasterize all triangles at once, one bounding-box offset at a time
+    eps = -1e-9
+    for oy in range(span_y):
+        for ox in range(span_x):
+            X = xmin + ox
+            Y = ymin + oy
+            w0 = ((y1 - y2) * (X - x2) + (x2 - x1) * (Y - y2)) / denom
+            w1 = ((y2 - y0) * (X - x2) + (x0 - x2) * (Y - y2)) / denom
+            w2 = 1.0 - w0 - w1
+            inside = (X <= xmax) & (Y <= ymax) & (w0 >= eps) & (w1 >= eps) & (w2 >= eps)
+            if not inside.any():
+                continue
+            pix = Y[inside] * dst_w + X[inside]
+            idx[:, pix] = tri[:, inside]
+            weights[0, pix] = w0[inside]
+            weights[1, pix] = w1[inside]
+            weights[2, pix] = w2[inside]
+            covered[pix] = True
 
-    bil_path.unlink(missing_ok=True)
-    hdr_path.unlink(missing_ok=True)
+    return {
+        "idx": idx,
+        "weights": weights,
+        "covered": covered,
+        "nearest": idx[np.argmax(weights, axis=0), np.arange(idx.shape[1])],
+        "transform": np.array(t[:6], dtype=np.float64),
+        "shape": np.array([dst_h, dst_w], dtype=np.int64),
+    }
 
 
-def extract_variable_to_cog(
-    input_path: str,
-    variable: str,
+def _load_wrf_index(
+    lon_2d: np.ndarray, lat_2d: np.ndarray, cache_dir: Path | None
+) -> tuple[dict, dict]:
+    """Return (index, target grid) for a WRF grid, reusing the on-disk cache.
+
+    XLONG/XLAT never change between timesteps or variables of a domain, so the
+    index is keyed by a hash of the coordinate arrays and built only once.
+    """
+    key = _coords_hash(lon_2d, lat_2d)
+    cache_file = cache_dir / f"wrf_index_{key}.npz" if cache_dir else None
+
+    if cache_file and cache_file.exists():
+        with np.load(cache_file) as npz:
+            index = {name: npz[name] for name in npz.files}
+        print(f"  Resampling index: cached ({cache_file.name})")
+    else:
+        index = _build_wrf_index(lon_2d, lat_2d)
+        print(f"  Resampling index: built ({int(index['covered'].sum())} pixels)")
+        if cache_file:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(f"{cache_file.stem}.{os.getpid()}.tmp.npz")
+            np.savez(tmp_file, **index)
+            tmp_file.replace(cache_file)
+
+    dst_h, dst_w = (int(v) for v in index["shape"])
+    grid = {
+        "transform": Affine(*index["transform"]),
+        "width": dst_w,
+        "height": dst_h,
+    }
+    return index, grid
+
+
+def _apply_wrf_index(
+    data: np.ndarray, index: dict, out: np.ndarray, resampling: str
+) -> None:
+    """Resample one source band into out with a vectorized gather.
+
+    Only the WRF_INDEX_RESAMPLING methods: "nearest" takes the closest cell,
+    "bilinear" the barycentric weights of the enclosing triangle.
+    """
+    if resampling not in WRF_INDEX_RESAMPLING:
+        raise ValueError(f"The WRF index does not implement '{resampling}' resampling")
+    src = data.ravel()
+    dst = out.reshape(-1)
+    if resampling == "nearest":
+        np.take(src, index["nearest"], out=dst)
+    else:
+        np.einsum("ij,ij->j", np.take(src, index["idx"]), index["weights"], out=dst)
+    dst[~index["covered"]] = np.nan
+
+
+class SlabReader:
+    """Stream (t[, z-levels]) slabs of a NetCDF variable into one reusable float32 buffer.
+
+    Auto mask-and-scale is disabled so each slab is read once in its native
+    dtype; the cast to float32, the fill-value and valid-range masking (NaN),
+    the optional scale/offset and the PALM south-to-north flip are then
+    applied into the same preallocated buffer, which is handed to the writer
+    as-is. The HDF5
+    chunk cache is sized to hold every chunk a slab touches, so files chunked
+    over several timesteps are decompressed once rather than once per slab.
+
+    For 4D variables every requested z-level of a timestep comes from a single
+    read (a strided hyperslab when the levels are evenly spaced), so a vertical
+    profile costs one pass over the file instead of one pass per level. The
+    buffer is always (levels, y, x); 3D variables have a single level.
+    """
+
+    def __init__(
+        self,
+        var_data,
+        z_levels: list[int] | None = None,
+        flip: bool = False,
+        chunk_cache: int | None = None,
+    ):
+        self.var_data = var_data
+        self.ndim = len(var_data.shape)
+        if self.ndim == 4:
+            self.levels = list(z_levels) if z_levels else [0]
+            self.z_index = _level_selector(self.levels)
+        else:
+            self.levels = [None]
+            self.z_index = None
+        self.flip = flip
+        var_data.set_auto_maskandscale(False)
+
+        self.fill_values = [
+            np.asarray(v, dtype=var_data.dtype)
+            for v in (
+                getattr(var_data, "_FillValue", None),
+                getattr(var_data, "missing_value", None),
+            )
+            if v is not None
+        ]
+        if not self.fill_values:
+            default = nc.default_fillvals.get(var_data.dtype.str[1:])
+            if default is not None:
+                self.fill_values.append(np.asarray(default, dtype=var_data.dtype))
+        # valid_range wins over valid_min/valid_max; both apply to the packed
+        # values, before scale/offset, as in netCDF4's masked arrays
+        valid_range = getattr(var_data, "valid_range", None)
+        if valid_range is not None:
+            valid_min, valid_max = np.asarray(valid_range).ravel()[:2]
+        else:
+            valid_min = getattr(var_data, "valid_min", None)
+            valid_max = getattr(var_data, "valid_max", None)
+        self.valid_min, self.valid_max = (
+            None if v is None else np.asarray(v, dtype=var_data.dtype)
+            for v in (valid_min, valid_max)
+        )
+        self.scale = getattr(var_data, "scale_factor", None)
+        self.offset = getattr(var_data, "add_offset", None)
+
+        if chunk_cache is None:
+            chunk_cache = self.chunk_cache_bytes(var_data, self.levels)
+        if isinstance(var_data.chunking(), (list, tuple)):
+            var_data.set_var_chunk_cache(size=int(chunk_cache), preemption=0.75)
+        self.chunk_cache = chunk_cache
+
+        self.buffer = np.empty(
+            (len(self.levels), *var_data.shape[-2:]), dtype=np.float32
+        )
+
+    @staticmethod
+    def chunk_cache_bytes(var_data, z_levels: list[int | None] | None = None) -> int:
+        """Bytes needed to cache every chunk touched by one (t[, z-levels]) slab."""
+        chunking = var_data.chunking()
+        if not isinstance(chunking, (list, tuple)):
+            return 0
+        ny, nx = var_data.shape[-2:]
+        cy, cx = chunking[-2:]
+        n_chunks = -(-ny // cy) * -(-nx // cx)
+        if len(chunking) == 4 and z_levels and z_levels[0] is not None:
+            # Worst case for the z span, whatever its alignment to the chunks
+            span = max(z_levels) - min(z_levels) + 1
+            cz = chunking[1]
+            n_chunks *= min(-(-var_data.shape[1] // cz), -(-(span - 1) // cz) + 1)
+        return n_chunks * int(np.prod(chunking)) * var_data.dtype.itemsize
+
+    def slab_bytes(self) -> int:
+        """Transient bytes per read: the native slab plus its fill mask."""
+        return self.buffer.size * (self.var_data.dtype.itemsize + 1)
+
+    def read(self, t: int, out: np.ndarray | None = None) -> np.ndarray:
+        """Read timestep t (all selected levels) into `out` or the shared buffer."""
+        if self.z_index is not None:
+            raw = self.var_data[t, self.z_index]
+        else:
+            raw = self.var_data[t][np.newaxis]
+        if self.flip:
+            # PALM y-axis goes from south to north, but raster convention is
+            # top-to-bottom: row 0 = northernmost.
+            raw = raw[:, ::-1]
+        buf = self.buffer if out is None else out
+        np.copyto(buf, raw, casting="unsafe")
+        for fill in self.fill_values:
+            if not np.isnan(fill):
+                buf[raw == fill] = np.nan
+        if self.valid_min is not None:
+            buf[raw < self.valid_min] = np.nan
+        if self.valid_max is not None:
+            buf[raw > self.valid_max] = np.nan
+        if self.scale is not None:
+            buf *= np.float32(self.scale)
+        if self.offset is not None:
+            buf += np.float32(self.offset)
+        return buf
+
+
+def _level_selector(levels: list[int]) -> slice | list[int]:
+    """Index selecting sorted z-levels in one read: a (strided) slice when possible."""
+    if len(levels) == 1:
+        return slice(levels[0], levels[0] + 1)
+    steps = {b - a for a, b in zip(levels, levels[1:])}
+    if len(steps) == 1:
+        return slice(levels[0], levels[-1] + 1, steps.pop())
+    return levels
+
+
+def _parse_levels(text: str) -> list[int]:
+    """Parse z-level indices such as '3', '0,3,5', '0-7' or '0-20:5'."""
+    levels = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        span, _, step = part.partition(":")
+        first, dash, last = span.partition("-")
+        if dash:
+            levels.extend(range(int(first), int(last) + 1, int(step or 1)))
+        else:
+            levels.append(int(first))
+    return levels
+
+
+def _parse_heights(text: str) -> list[float]:
+    """Parse target heights in metres such as '1.25,10,50'."""
+    return [float(part) for part in text.split(",") if part.strip()]
+
+
+def _resolve_levels(
+    ds: nc.Dataset,
+    var_data,
+    grid_type: str,
+    z_levels: list[int] | None = None,
+    heights: list[float] | None = None,
+) -> list[int | None]:
+    """Turn requested z-level indices or heights into sorted level indices.
+
+    Heights are matched to the nearest value of the variable's z coordinate.
+    Without either, 4D variables use the grid's default level. 3D variables
+    always return [None].
+    """
+    if len(var_data.shape) != 4:
+        if z_levels or heights:
+            print(f"  Note: {var_data.name} has no vertical dimension, ignoring z-levels")
+        return [None]
+
+    z_dim_name = var_data.dimensions[1]
+    nz = var_data.shape[1]
+    z_values = ds.variables[z_dim_name][:] if z_dim_name in ds.variables else None
+
+    if heights:
+        if z_values is None:
+            raise ValueError(
+                f"Cannot resolve heights: no coordinate variable for '{z_dim_name}'"
+            )
+        z_values = np.asarray(z_values, dtype=float)
+        z_levels = [int(np.abs(z_values - h).argmin()) for h in heights]
+        for h, z in zip(heights, z_levels):
+            print(f"  Height {h:g}m -> z-level {z} ({z_values[z]:.2f}m)")
+    elif not z_levels:
+        default = _default_z_level(grid_type)
+        z_levels = [default if default is not None else 0]
+
+    levels = sorted(set(z_levels))
+    out_of_range = [z for z in levels if not 0 <= z < nz]
+    if out_of_range:
+        raise ValueError(
+            f"Z-level(s) {out_of_range} out of range for '{z_dim_name}' (0-{nz - 1})"
+        )
+
+    for z in levels:
+        if z_values is not None:
+            print(f"  Z-level: index {z} = {float(z_values[z]):.2f}m ({z_dim_name})")
+        else:
+            print(f"  Z-level: index {z} ({z_dim_name})")
+    return levels
+
+
+def _level_output(template: str, z_level: int | None, multi: bool) -> str:
+    """Output path for one z-level: fill `{z}`, or append `_z{z}` for multi-level runs."""
+    if "{z}" in template:
+        return template.replace("{z}", "" if z_level is None else str(z_level))
+    if not multi:
+        return template
+    stem, dot, suffix = template.rpartition(".")
+    return f"{stem}_z{z_level}{dot}{suffix}" if dot else f"{template}_z{z_level}"
+
+
+def _compile_expression(ds: nc.Dataset, variable: str) -> dict | None:
+    """Compile a -v derived-variable expression or RECIPES name.
+
+    Returns None when `variable` is a plain dataset variable (case-insensitive).
+    Otherwise the expression may only use dataset variables, numeric
+    constants, arithmetic/comparison operators and EXPRESSION_FUNCTIONS;
+    anything else (attributes, subscripts, keywords, other names) is
+    rejected before compiling, so evaluation cannot reach Python builtins.
+    """
+    available = {v.lower(): v for v in ds.variables}
+    if variable.lower() in available:
+        return None
+
+    text = RECIPES.get(variable.lower(), variable)
+    try:
+        tree = ast.parse(text, mode="eval")
+        if isinstance(tree.body, ast.Name):
+            raise SyntaxError(text)
+    except SyntaxError:
+        raise ValueError(
+            f"Variable '{variable}' not found. Available: {list(ds.variables)}, "
+            f"recipes: {sorted(RECIPES)}"
+        ) from None
+
+    names = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, _EXPRESSION_NODES):
+            raise ValueError(f"Unsupported syntax in '{text}': {ast.unparse(node)}")
+        if isinstance(node, ast.Call) and (
+            not isinstance(node.func, ast.Name)
+            or node.func.id not in EXPRESSION_FUNCTIONS
+            or node.keywords
+        ):
+            raise ValueError(f"Unsupported call in '{text}': {ast.unparse(node)}")
+        if isinstance(node, ast.Compare) and len(node.ops) > 1:
+            raise ValueError(f"Chained comparisons are not supported: {ast.unparse(node)}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"Only numeric constants are allowed: {ast.unparse(node)}")
+        if isinstance(node, ast.Name) and not (
+            node.id in EXPRESSION_FUNCTIONS or node.id in EXPRESSION_CONSTANTS
+        ):
+            if node.id.lower() not in available:
+                raise ValueError(
+                    f"Unknown variable '{node.id}' in '{text}'. "
+                    f"Available: {list(ds.variables)}"
+                )
+            names[node.id] = available[node.id.lower()]
+    if not names:
+        raise ValueError(f"Expression '{text}' does not use any dataset variable")
+
+    return {"text": text, "code": compile(tree, "<expression>", "eval"), "names": names}
+
+
+class ExpressionReader:
+    """Evaluate a compiled derived-variable expression per timestep.
+
+    Every input variable is streamed through its own SlabReader (same levels,
+    same flip), the expression is evaluated with NumPy on their buffers and
+    the result is copied into one reusable buffer. Fill values are NaN by
+    then, so they propagate to the derived layer. Each input is read once
+    per timestep no matter how often the expression uses it.
+    """
+
+    def __init__(
+        self,
+        expression: dict,
+        inputs: dict,
+        z_levels: list[int] | None = None,
+        flip: bool = False,
+        chunk_cache: int | None = None,
+    ):
+        share = None if chunk_cache is None else chunk_cache // len(inputs)
+        self.readers = {
+            name: SlabReader(var_data, z_levels, flip, share)
+            for name, var_data in inputs.items()
+        }
+        first = next(iter(self.readers.values()))
+        self.levels = first.levels
+        self.buffer = np.empty_like(first.buffer)
+        self.chunk_cache = sum(reader.chunk_cache for reader in self.readers.values())
+        self.code = expression["code"]
+        self.namespace = {
+            "__builtins__": {},
+            **EXPRESSION_FUNCTIONS,
+            **EXPRESSION_CONSTANTS,
+        }
+
+    def read(self, t: int, out: np.ndarray | None = None) -> np.ndarray:
+        """Evaluate the expression for timestep t into `out` or the shared buffer."""
+        values = {name: reader.read(t) for name, reader in self.readers.items()}
+        with np.errstate(all="ignore"):
+            result = eval(self.code, self.namespace, values)
+        buf = self.buffer if out is None else out
+        np.copyto(buf, result, casting="unsafe")
+        return buf
+
+
+def _parse_size(text: str) -> int:
+    """Parse a memory size such as '512M', '8G' or a plain number of MB into bytes."""
+    text = text.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text) * (1 << 20))
+
+
+def _peak_memory_mb() -> float:
+    """Peak resident memory of this process so far in MB (a high-water mark)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _memory_plan(
+    var_data,
+    grid: dict,
+    num_bands: int,
+    max_memory: int | None,
+    z_levels: list[int | None] | None = None,
+    num_inputs: int = 1,
+    depth: int = 1,
+) -> dict:
+    """Decide the chunk cache, stack location, GDAL cache and pipeline depth.
+
+    Each of the `depth` pipeline slots holds one float32 slab and its warped
+    bands (see _convert_variable). Without a budget everything stays in
+    memory with a 4 GB GDAL cache. With one, the pipeline depth is reduced
+    first, then the chunk cache is capped, then the multi-band stacks are
+    spilled to temporary GeoTIFFs (one per output) next to the outputs if
+    they do not fit.
+    """
+    num_levels = len(z_levels or [None])
+    band_bytes = grid["height"] * grid["width"] * 4
+    stack_bytes = num_bands * band_bytes
+    ny, nx = var_data.shape[-2:]
+    slot_bytes = num_levels * (band_bytes + ny * nx * 4)
+    # The reader's native slab and fill mask; derived variables also keep one
+    # float32 slab per input
+    read_bytes = num_levels * ny * nx * num_inputs * (var_data.dtype.itemsize + 1)
+    if num_inputs > 1:
+        read_bytes += num_levels * ny * nx * num_inputs * 4
+    chunk_cache = num_inputs * SlabReader.chunk_cache_bytes(var_data, z_levels)
+
+    if max_memory is None:
+        fixed = depth * slot_bytes + read_bytes
+        return {
+            "chunk_cache": chunk_cache,
+            "spill": False,
+            "gdal_cache_mb": 4096,
+            "depth": depth,
+            "estimate": stack_bytes + fixed + chunk_cache,
+        }
+
+    # Keep at least half of the budget for caches and the stacks
+    while depth > 1 and depth * slot_bytes + read_bytes > max_memory // 2:
+        depth -= 1
+    fixed = depth * slot_bytes + read_bytes
+    if fixed > max_memory:
+        raise MemoryError(
+            f"--max-memory {max_memory / (1 << 20):.0f} MB is below the "
+            f"{fixed / (1 << 20):.0f} MB needed for one band and one slab per level"
+        )
+    # A quarter of what is left goes to GDAL's block cache (16 MB to 4 GB)
+    gdal_cache = min(4096 << 20, max(16 << 20, (max_memory - fixed) // 4))
+    chunk_cache = min(chunk_cache, max(0, max_memory - fixed - gdal_cache) // 2)
+    spill = fixed + gdal_cache + chunk_cache + stack_bytes > max_memory
+    return {
+        "chunk_cache": chunk_cache,
+        "spill": spill,
+        "gdal_cache_mb": gdal_cache >> 20,
+        "depth": depth,
+        "estimate": fixed + gdal_cache + chunk_cache + (0 if spill else stack_bytes),
+    }
+
+
+def _write_cog(
+    src,
     output_path: str,
-    z_level: int | None = None,
-    resampling: str = "bilinear",
-    compress: str = "DEFLATE",
-):
-    """Extract a variable from NetCDF and create a multi-band COG (one band per timestep)."""
-    ds = nc.Dataset(input_path)
+    compress: str,
+    num_threads: int | str = "ALL_CPUS",
+    cache_mb: int = 4096,
+) -> None:
+    """Write an open multi-band dataset to a GoogleMapsCompatible COG."""
+    with rasterio.Env(GDAL_CACHEMAX=cache_mb, GDAL_NUM_THREADS=str(num_threads)):
+        rasterio.shutil.copy(
+            src,
+            output_path,
+            driver="COG",
+            COMPRESS=compress,
+            LEVEL=6,
+            PREDICTOR=2,
+            BLOCKSIZE=256,
+            TILING_SCHEME="GoogleMapsCompatible",
+            OVERVIEW_RESAMPLING="AVERAGE",
+            BIGTIFF="IF_SAFER",
+        )
 
-    # Detect grid type
-    grid_type = _detect_grid_type(ds)
-    print(f"  Grid type: {grid_type}")
 
-    # Find variable (case-insensitive)
+def _print_summary(output_path: str) -> None:
+    """Print a short gdalinfo-style summary of the written COG."""
+    with rasterio.open(output_path) as ds:
+        print(f"    Driver: {ds.driver}")
+        print(f"    Size is {ds.width}, {ds.height}")
+        print(f"    Bands: {ds.count} ({ds.dtypes[0]}), NoData: {ds.nodata}")
+        print(f"    CRS: {ds.crs}")
+        print(f"    Pixel size: ({ds.res[0]:.4f}, {ds.res[1]:.4f})")
+        print(f"    Bounds: {tuple(round(v, 2) for v in ds.bounds)}")
+
+
+def _find_variable(ds: nc.Dataset, variable: str) -> tuple[str, object, int]:
+    """Return (name, variable, num_timesteps) for a case-insensitive variable name."""
     var_name = next((v for v in ds.variables if v.lower() == variable.lower()), None)
     if var_name is None:
         available = [v for v in ds.variables.keys()]
-        ds.close()
         raise ValueError(f"Variable '{variable}' not found. Available: {available}")
 
     var_data = ds.variables[var_name]
@@ -264,142 +843,618 @@ def extract_variable_to_cog(
             time_dim = dim_name
             break
     if time_dim is None:
-        ds.close()
         raise ValueError(f"No time dimension found in variable '{var_name}'")
 
-    num_timesteps = len(ds.dimensions[time_dim])
+    return var_name, var_data, len(ds.dimensions[time_dim])
 
-    # Report z-level usage for 4D data
-    if len(var_data.shape) == 4:
-        z_idx = z_level if z_level is not None else 0
-        z_dim_name = var_data.dimensions[1]
-        if z_dim_name in ds.variables:
-            z_values = ds.variables[z_dim_name][:]
-            z_height = float(z_values[z_idx])
-            print(f"  Z-level: index {z_idx} = {z_height:.2f}m ({z_dim_name})")
-        else:
-            print(f"  Z-level: index {z_idx} ({z_dim_name})")
 
-    print(f"  Variable: {var_name}, shape: {var_data.shape}, timesteps: {num_timesteps}")
+def _default_z_level(grid_type: str) -> int | None:
+    """Default z-level index: 3 (~1.25m, pedestrian height) for PALM, none otherwise."""
+    return 3 if grid_type == "palm" else None
+
+
+def _prepare_grid(ds: nc.Dataset, index_cache: Path | None = DEFAULT_INDEX_CACHE) -> dict:
+    """Detect the grid of an open dataset and compute everything its variables share.
+
+    Returns a picklable plan with the grid type, the EPSG:3857 target grid,
+    the source georeferencing and, for WRF grids, the resampling index.
+    """
+    grid_type = _detect_grid_type(ds)
+    print(f"  Grid type: {grid_type}")
 
-    # Set up grid-specific coordinate info
+    plan = {"grid_type": grid_type}
     if grid_type == "wrf":
         lon_2d, lat_2d = _find_wrf_coordinates(ds)
         print(f"  Grid size: {lat_2d.shape[0]} x {lon_2d.shape[1]}")
         print(f"  Lon range: [{float(lon_2d.min()):.4f}, {float(lon_2d.max()):.4f}]")
         print(f"  Lat range: [{float(lat_2d.min()):.4f}, {float(lat_2d.max()):.4f}]")
-        palm_gt = None
+        plan["wrf_index"], plan["grid"] = _load_wrf_index(lon_2d, lat_2d, index_cache)
+        # For the methods the index does not implement (see WRF_INDEX_RESAMPLING)
+        plan["src_georef"] = _source_georef(grid_type, lon_2d, lat_2d)
     elif grid_type == "palm":
         palm_gt = _get_palm_geotransform(ds)
         x = ds.variables["x"][:]
         y = ds.variables["y"][:]
         print(f"  Grid size: {len(y)} x {len(x)}, resolution: {palm_gt[2]:.2f}m")
         print(f"  Origin (LV95): E={palm_gt[0]:.2f}, N={palm_gt[1]:.2f}")
-        lon_2d = lat_2d = None
+        plan["src_georef"] = _source_georef(grid_type, palm_gt=palm_gt)
+        # The target grid is computed once and shared by every timestep
+        plan["grid"] = _target_grid(plan["src_georef"], (len(y), len(x)))
     else:
         raise ValueError(f"Unsupported grid type: {grid_type}")
 
-    temp_dir = Path(tempfile.mkdtemp(prefix="nc_to_cog_"))
+    grid = plan["grid"]
+    print(f"  Target grid (EPSG:3857): {grid['width']} x {grid['height']}")
+    return plan
+
+
+def _convert_variable(
+    ds: nc.Dataset,
+    variable: str,
+    output_path: str,
+    plan: dict,
+    z_levels: list[int] | None = None,
+    resampling: str = "bilinear",
+    compress: str = "DEFLATE",
+    progress: bool = True,
+    num_threads: int | str = "ALL_CPUS",
+    max_memory: int | None = None,
+    heights: list[float] | None = None,
+    level_layout: str = "separate",
+    threads: int | None = None,
+) -> tuple[list[str], int]:
+    """Convert one variable of an open dataset to COG(s) using a prepared grid plan.
+
+    All requested z-levels (indices, or heights in metres) are read in one
+    pass. With level_layout "separate" each level gets its own COG (see
+    _level_output); with "stacked" they share one COG whose bands are ordered
+    time-major and described as t{t:03d}_z{z}.
+
+    Timesteps are warped by a pool of `threads` threads (default: all CPUs)
+    while this thread reads ahead, bounded by a fixed number of buffer slots.
+
+    max_memory (bytes) limits the read-ahead, caps the HDF5 chunk cache and
+    GDAL cache and spills the multi-band stacks to temporary GeoTIFFs when
+    they would not fit. Returns the written paths and the total number of bands.
+    """
+    expression = _compile_expression(ds, variable)
+    if expression is None:
+        var_name, var_data, num_timesteps = _find_variable(ds, variable)
+        inputs = {var_name: var_data}
+    else:
+        inputs = {}
+        for name, ds_name in expression["names"].items():
+            var_name, inputs[name], num_timesteps = _find_variable(ds, ds_name)
+        shapes = {name: inputs[name].shape for name in inputs}
+        if len(set(shapes.values())) > 1:
+            raise ValueError(f"Expression inputs differ in shape: {shapes}")
+        var_name, var_data = expression["text"], next(iter(inputs.values()))
+    grid_type, grid = plan["grid_type"], plan["grid"]
+
+    levels = _resolve_levels(ds, var_data, grid_type, z_levels, heights)
+    num_levels = len(levels)
+    z_values = None
+    if levels[0] is not None and var_data.dimensions[1] in ds.variables:
+        z_values = ds.variables[var_data.dimensions[1]][:]
+
+    print(f"  Variable: {var_name}, shape: {var_data.shape}, timesteps: {num_timesteps}")
 
-    resampling_map = {
-        "nearest": "near",
-        "average": "average",
-        "bilinear": "bilinear",
-        "cubic": "cubic",
+    num_bands = num_timesteps * num_levels
+    threads = max(1, min(threads or os.cpu_count() or 1, num_timesteps))
+    memory = _memory_plan(
+        var_data,
+        grid,
+        num_bands,
+        max_memory,
+        levels,
+        len(inputs),
+        depth=1 if threads == 1 else 2 * threads,
+    )
+    threads = min(threads, memory["depth"])
+    reader_args = {
+        "z_levels": levels if levels[0] is not None else None,
+        "flip": grid_type == "palm",
+        "chunk_cache": memory["chunk_cache"],
     }
+    if expression is None:
+        reader = SlabReader(var_data, **reader_args)
+    else:
+        print(f"  Expression: {expression['text']}")
+        reader = ExpressionReader(expression, inputs, **reader_args)
+    print(
+        f"  Memory plan: ~{memory['estimate'] / (1 << 20):.0f} MB, "
+        f"chunk cache {reader.chunk_cache / (1 << 20):.1f} MB, "
+        f"stack {'on disk' if memory['spill'] else 'in memory'}, "
+        f"{threads} warp thread(s)"
+    )
 
+    if level_layout == "stacked" or num_levels == 1:
+        outputs = [_level_output(output_path, levels[0], multi=False)]
+    else:
+        outputs = [_level_output(output_path, z, multi=True) for z in levels]
+    bands_per_output = num_bands if len(outputs) == 1 else num_timesteps
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "count": bands_per_output,
+        "width": grid["width"],
+        "height": grid["height"],
+        "crs": DST_CRS,
+        "transform": grid["transform"],
+        "nodata": np.nan,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "BIGTIFF": "IF_SAFER",
+    }
+
+    def level_tags(z: int) -> dict:
+        tags = {"z_level": z}
+        if z_values is not None:
+            tags["height_m"] = f"{float(z_values[z]):.2f}"
+        return tags
+
+    with ExitStack() as cleanup:
+        stacks = []
+        for path in outputs:
+            if memory["spill"]:
+                # One multi-band scratch file per output, never per-band files
+                fd, spill_path = tempfile.mkstemp(
+                    suffix=".tif", prefix=".stack_", dir=Path(path).parent
+                )
+                os.close(fd)
+                cleanup.callback(Path(spill_path).unlink, missing_ok=True)
+                stack = cleanup.enter_context(rasterio.open(spill_path, "w", **profile))
+            else:
+                mem = cleanup.enter_context(MemoryFile())
+                stack = cleanup.enter_context(mem.open(**profile))
+            stacks.append(stack)
+
+        if levels[0] is not None:
+            if len(outputs) == 1 and num_levels > 1:
+                for t in range(num_timesteps):
+                    for i, z in enumerate(levels):
+                        bidx = t * num_levels + i + 1
+                        stacks[0].set_band_description(bidx, f"t{t:03d}_z{z}")
+                        stacks[0].update_tags(bidx, time_index=t, **level_tags(z))
+            else:
+                for stack, z in zip(stacks, levels):
+                    stack.update_tags(**level_tags(z))
+        if expression is not None:
+            for stack in stacks:
+                stack.update_tags(expression=expression["text"])
+
+        use_index = grid_type == "wrf" and resampling in WRF_INDEX_RESAMPLING
+
+        def warp(slab: np.ndarray, out: np.ndarray) -> None:
+            for i in range(num_levels):
+                if use_index:
+                    _apply_wrf_index(slab[i], plan["wrf_index"], out[i], resampling)
+                else:
+                    out[i].fill(np.nan)
+                    reproject(
+                        source=slab[i],
+                        destination=out[i],
+                        src_nodata=np.nan,
+                        dst_transform=grid["transform"],
+                        dst_crs=DST_CRS,
+                        dst_nodata=np.nan,
+                        resampling=RESAMPLING.get(resampling, Resampling.bilinear),
+                        **plan["src_georef"],
+                    )
+
+        def write(t: int, out: np.ndarray) -> None:
+            for i in range(num_levels):
+                if len(stacks) == 1:
+                    stacks[0].write(out[i], t * num_levels + i + 1)
+                else:
+                    stacks[i].write(out[i], t + 1)
+
+        # Each slot is one slab plus its warped bands, reused once written
+        band_shape = (num_levels, grid["height"], grid["width"])
+        free = [
+            (np.empty_like(reader.buffer), np.empty(band_shape, dtype=np.float32))
+            for _ in range(memory["depth"])
+        ]
+        if threads == 1:
+            slab, out = free[0]
+            for t in range(num_timesteps):
+                if progress:
+                    print(f"  Reprojecting timestep {t + 1}/{num_timesteps}")
+                warp(reader.read(t, out=slab), out)
+                write(t, out)
+        else:
+            # This thread is the only one touching the NetCDF file and the
+            # output datasets; the pool only warps. Free slots bound how far
+            # reading can run ahead, and bands are written in timestep order.
+            def job(t, slab, out):
+                warp(slab, out)
+                return t, slab, out
+
+            # rasterio silences NotGeoreferencedWarning for its in-memory warp
+            # sources with warnings.catch_warnings(), which is not thread-safe;
+            # filter it once here for the whole pool instead.
+            pending = deque()
+            with warnings.catch_warnings(), ThreadPoolExecutor(threads) as pool:
+                warnings.simplefilter("ignore", NotGeoreferencedWarning)
+                for t in range(num_timesteps):
+                    if not free:
+                        done, slab, out = pending.popleft().result()
+                        write(done, out)
+                        free.append((slab, out))
+                    if progress:
+                        print(f"  Reprojecting timestep {t + 1}/{num_timesteps}")
+                    slab, out = free.pop()
+                    reader.read(t, out=slab)
+                    pending.append(pool.submit(job, t, slab, out))
+                while pending:
+                    done, slab, out = pending.popleft().result()
+                    write(done, out)
+
+        for stack, path in zip(stacks, outputs):
+            print(f"  Creating COG {path}...")
+            _write_cog(stack, path, compress, num_threads, memory["gdal_cache_mb"])
+
+    peak = _peak_memory_mb()
+    budget = f" (budget {max_memory / (1 << 20):.0f} MB)" if max_memory else ""
+    print(f"  Process peak memory so far: {peak:.0f} MB{budget}")
+    return outputs, num_bands
+
+
+def extract_variable_to_cog(
+    input_path: str,
+    variable: str,
+    output_path: str,
+    z_level: int | None = None,
+    resampling: str = "bilinear",
+    compress: str = "DEFLATE",
+    index_cache: Path | None = DEFAULT_INDEX_CACHE,
+    max_memory: int | None = None,
+    z_levels: list[int] | None = None,
+    heights: list[float] | None = None,
+    level_layout: str = "separate",
+    threads: int | None = None,
+) -> list[str]:
+    """Extract a variable from NetCDF and create multi-band COG(s) (one band per timestep).
+
+    WRF grids are resampled through a cached curvilinear index (see
+    _load_wrf_index); PALM grids are reprojected with rasterio from their
+    affine geotransform. Several z-levels or heights are exported from a
+    single pass over the file (see _convert_variable).
+    """
+    if z_levels is None and z_level is not None:
+        z_levels = [z_level]
+    ds = nc.Dataset(input_path)
     try:
-        warped_tifs = []
-        for t in range(num_timesteps):
-            print(f"  Extracting timestep {t + 1}/{num_timesteps}")
-            data = _extract_timestep(var_data, t, z_level)
-            raw_tif = temp_dir / f"band_{t:04d}_raw.tif"
-
-            if grid_type == "wrf":
-                _write_wrf_geotiff(data, lon_2d, lat_2d, raw_tif)
-                src_srs = None  # GCPs already embed EPSG:4326
-            elif grid_type == "palm":
-                _write_palm_geotiff(data, palm_gt, raw_tif)
-                src_srs = "EPSG:2056"
-
-            # Warp to EPSG:3857
-            warped_tif = temp_dir / f"band_{t:04d}_3857.tif"
-            cmd = [
-                "gdalwarp",
-                str(raw_tif),
-                str(warped_tif),
-                "-t_srs", "EPSG:3857",
-                "-r", resampling_map.get(resampling, "bilinear"),
-                "-dstnodata", "nan",
-            ]
-            if src_srs:
-                cmd.extend(["-s_srs", src_srs])
-            _run_cmd(cmd, f"gdalwarp (timestep {t} to 3857)")
-            warped_tifs.append(warped_tif)
-            raw_tif.unlink(missing_ok=True)
+        plan = _prepare_grid(ds, index_cache)
+        outputs, _ = _convert_variable(
+            ds,
+            variable,
+            output_path,
+            plan,
+            z_levels=z_levels,
+            resampling=resampling,
+            compress=compress,
+            max_memory=max_memory,
+            heights=heights,
+            level_layout=level_layout,
+            threads=threads,
+        )
+    finally:
+        ds.close()
 
+    for path in outputs:
+        print(f"\n  COG created: {path}")
+        _print_summary(path)
+    return outputs
+
+
+def _load_manifest(manifest_path: Path) -> list[dict]:
+    """Expand a batch manifest into one task per (input, variable).
+
+    Manifest format (paths are relative to the manifest file):
+
+        {
+          "output_dir": "../../frontend/public/geodata",
+          "resampling": "bilinear",
+          "compress": "DEFLATE",
+          "jobs": [
+            {"input": "wrfout_d02_2022-07-15_12_00_00",
+             "variables": ["T2", "U10", "Q2", "SWDOWN"],
+             "output": "wrf_d02_{var}_cog.tif"},
+            {"input": "TEST_4_3d.001-001.nc",
+             "variables": ["ta", "wspeed"],
+             "z_levels": [3],
+             "output": "palm_{var}_cog.tif"},
+            {"input": "TEST_4_3d.001-001.nc",
+             "variables": ["ta"],
+             "heights": [1.25, 10, 50],
+             "level_layout": "stacked",
+             "output": "palm_{var}_profile_cog.tif"}
+          ]
+        }
+
+    `{var}` is replaced by the lowercase variable name and `{z}` by the
+    z-level index. Variables may be RECIPES names or derived-variable
+    objects such as {"name": "ws10", "expr": "hypot(U10, V10)"}. Jobs may
+    override `resampling` and `compress`. `z_levels` (a list or a string
+    such as "0-7") or `heights` (metres) select levels, which are all
+    exported in a single pass; with the default "separate" layout and no
+    `{z}` in the template, `_z{z}` is appended per level.
+    """
+    manifest = json.loads(manifest_path.read_text())
+    base_dir = manifest_path.parent
+    output_dir = base_dir / manifest.get("output_dir", ".")
+
+    tasks = []
+    for job in manifest["jobs"]:
+        input_path = base_dir / job["input"]
+        z_levels = job.get("z_levels")
+        if isinstance(z_levels, str):
+            z_levels = _parse_levels(z_levels)
+        for variable in job["variables"]:
+            # Derived variables: {"name": "wspd10", "expr": "hypot(U10, V10)"}
+            if isinstance(variable, dict):
+                name, variable = variable["name"], variable["expr"]
+            else:
+                name = variable
+            # {z} is left in place for _level_output
+            output = job["output"].format(var=name.lower(), z="{z}")
+            tasks.append(
+                {
+                    "input": str(input_path),
+                    "variable": variable,
+                    "z_levels": z_levels,
+                    "heights": job.get("heights"),
+                    "level_layout": job.get("level_layout", "separate"),
+                    "output": str(output_dir / output),
+                    "resampling": job.get(
+                        "resampling", manifest.get("resampling", "bilinear")
+                    ),
+                    "compress": job.get(
+                        "compress", manifest.get("compress", "DEFLATE")
+                    ),
+                }
+            )
+    return tasks
+
+
+# Datasets opened by a batch worker process, reused across the tasks it runs
+_WORKER_DATASETS: dict[str, nc.Dataset] = {}
+
+
+def _close_worker_datasets() -> None:
+    for ds in _WORKER_DATASETS.values():
         ds.close()
+    _WORKER_DATASETS.clear()
 
-        # Stack all warped timesteps into a multi-band VRT
-        stacked_vrt = temp_dir / "stacked.vrt"
-        cmd = [
-            "gdalbuildvrt",
-            "-separate",
-            str(stacked_vrt),
-        ] + [str(p) for p in warped_tifs]
-        _run_cmd(cmd, "gdalbuildvrt -separate")
-
-        # Convert VRT to COG
-        print("  Creating COG...")
-        cmd = [
-            "gdal_translate",
-            str(stacked_vrt),
-            output_path,
-            "-of", "COG",
-            "-co", f"COMPRESS={compress}",
-            "-co", "LEVEL=6",
-            "-co", "PREDICTOR=2",
-            "-co", "BLOCKSIZE=256",
-            "-co", "TILING_SCHEME=GoogleMapsCompatible",
-            "-co", "OVERVIEW_RESAMPLING=AVERAGE",
-            "-co", "BIGTIFF=IF_SAFER",
-            "--config", "GDAL_CACHEMAX", "4096",
-            "--config", "GDAL_NUM_THREADS", "ALL_CPUS",
-        ]
-        _run_cmd(cmd, "gdal_translate (COG creation)")
 
-        print(f"\n  COG created: {output_path}")
+def _init_worker() -> None:
+    """Close the worker's datasets when the pool shuts it down.
+
+    Pool workers leave through multiprocessing's exit hooks, not atexit.
+    """
+    multiprocessing.util.Finalize(None, _close_worker_datasets, exitpriority=10)
 
-        # Verify
-        result = subprocess.run(
-            ["gdalinfo", output_path], capture_output=True, text=True
+
+def _run_task(task: dict, plan: dict, ds: nc.Dataset | None = None) -> dict:
+    """Convert one batch task and return its timing record."""
+    if ds is None:
+        ds = _WORKER_DATASETS.get(task["input"])
+        if ds is None:
+            ds = _WORKER_DATASETS[task["input"]] = nc.Dataset(task["input"])
+
+    start = time.perf_counter()
+    try:
+        outputs, bands = _convert_variable(
+            ds,
+            task["variable"],
+            task["output"],
+            plan,
+            z_levels=task["z_levels"],
+            resampling=task["resampling"],
+            compress=task["compress"],
+            progress=False,
+            num_threads=task.get("num_threads", "ALL_CPUS"),
+            max_memory=task.get("max_memory"),
+            heights=task["heights"],
+            level_layout=task["level_layout"],
+            threads=task.get("threads"),
+        )
+        error = None
+    except Exception as e:  # reported in the summary, other outputs keep going
+        outputs, bands, error = [task["output"]], 0, f"{type(e).__name__}: {e}"
+    return {
+        "output": outputs[0]
+        if len(outputs) == 1
+        else f"{outputs[0]} (+{len(outputs) - 1} more levels)",
+        "outputs": outputs,
+        "bands": bands,
+        "seconds": time.perf_counter() - start,
+        # ru_maxrss never goes down: with workers, this is the peak of the
+        # worker process over every task it has run so far, not of this task
+        "peak_mb": _peak_memory_mb(),
+        "error": error,
+    }
+
+
+def _task_key(cache: BuildCache, task: dict) -> str:
+    """Build-cache key of one conversion: script, input file and output-affecting options."""
+    params = {
+        name: task.get(name)
+        for name in (
+            "variable",
+            "z_levels",
+            "heights",
+            "level_layout",
+            "resampling",
+            "compress",
         )
-        if result.returncode == 0:
-            for line in result.stdout.split("\n")[:20]:
-                print(f"    {line}")
+    }
+    params["index_version"] = INDEX_VERSION
+    return cache.key([__file__], [task["input"]], params)
+
+
+def run_batch(
+    manifest_path: Path,
+    workers: int | None = None,
+    index_cache: Path | None = DEFAULT_INDEX_CACHE,
+    max_memory: int | None = None,
+    threads: int | None = None,
+    force: bool = False,
+) -> list[dict]:
+    """Convert every (input, variable) of a manifest, in parallel.
+
+    Outputs whose build-cache key (script, input content, options) is
+    unchanged are skipped unless force is set. Each remaining input is opened
+    once in this process to detect its grid and build the target grid / WRF
+    index; the resulting plan is shared by all of its variables. Independent
+    outputs are then converted by a pool of worker processes, each of which
+    opens an input at most once.
+    """
+    cache = BuildCache()
+    tasks = []
+    for task in _load_manifest(manifest_path):
+        task = {**task, "max_memory": max_memory, "threads": threads}
+        task["key"] = _task_key(cache, task)
+        if not cache.check(task["output"], task["key"], force):
+            tasks.append(task)
+    if not tasks:
+        print(f"Batch: every output of {manifest_path} is up to date")
+        return []
+
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(tasks)) or 1
+    print(f"Batch: {len(tasks)} outputs from {manifest_path}, {workers} worker(s)")
+
+    inputs = list(dict.fromkeys(task["input"] for task in tasks))
+    plans = {}
+    open_datasets = {}
+    for input_path in inputs:
+        if not Path(input_path).exists():
+            raise FileNotFoundError(f"Input file not found: {input_path}")
+        print(f"\nPreparing grid for {input_path}...")
+        ds = nc.Dataset(input_path)
+        plans[input_path] = _prepare_grid(ds, index_cache)
+        if workers == 1:
+            open_datasets[input_path] = ds
+        else:
+            ds.close()
 
+    start = time.perf_counter()
+    results = []
+    try:
+        if workers == 1:
+            for task in tasks:
+                print(f"\n{task['output']}")
+                result = _run_task(task, plans[task["input"]], open_datasets[task["input"]])
+                if not result["error"]:
+                    cache.record(task["output"], task["key"], result["outputs"])
+                results.append(result)
+        else:
+            # Split GDAL's own threads and the warp threads between the
+            # worker processes
+            num_threads = max(1, (os.cpu_count() or 1) // workers)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                futures = {
+                    pool.submit(
+                        _run_task,
+                        {
+                            **task,
+                            "num_threads": num_threads,
+                            "threads": threads or num_threads,
+                        },
+                        plans[task["input"]],
+                    ): task
+                    for task in tasks
+                }
+                for future in as_completed(futures):
+                    result = future.result()
+                    status = "FAILED" if result["error"] else "done"
+                    print(f"  [{status}] {result['output']} ({result['seconds']:.1f}s)")
+                    if not result["error"]:
+                        task = futures[future]
+                        cache.record(task["output"], task["key"], result["outputs"])
+                results = [future.result() for future in futures]
     finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        for ds in open_datasets.values():
+            ds.close()
+
+    wall = time.perf_counter() - start
+    print(f"\nBatch summary ({len(results)} outputs, {workers} worker(s), {wall:.1f}s wall):")
+    # Peak RSS so far of the process that ran the output (the worker, with --workers)
+    print(f"  {'seconds':>8}  {'bands':>5}  {'proc peak MB':>12}  output")
+    for result in results:
+        print(
+            f"  {result['seconds']:>8.1f}  {result['bands']:>5}  "
+            f"{result['peak_mb']:>12.0f}  {result['output']}"
+        )
+        if result["error"]:
+            print(f"  {'':>8}  {'':>5}  {'':>12}  FAILED: {result['error']}")
+    cpu_total = sum(result["seconds"] for result in results)
+    print(f"  {cpu_total:>8.1f}  total conversion time ({cpu_total / max(wall, 1e-9):.1f}x parallel)")
+    return results
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Convert WRF/PALM NetCDF to multi-band COG (one band per timestep)"
     )
-    parser.add_argument("--input", "-i", required=True, help="Input NetCDF file")
-    parser.add_argument("--variable", "-v", required=True, help="Variable to extract")
-    parser.add_argument("--output", "-o", required=True, help="Output COG file")
+    parser.add_argument("--input", "-i", help="Input NetCDF file")
+    parser.add_argument(
+        "--variable",
+        "-v",
+        help="Variable to extract, a recipe name (see --list-recipes) or an "
+        "expression over variables such as 'hypot(U10, V10)' or 'T2 - 273.15'",
+    )
+    parser.add_argument("--output", "-o", help="Output COG file")
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        type=Path,
+        help="Batch mode: JSON manifest of inputs × variables (replaces -i/-v/-o)",
+    )
     parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        default=None,
+        help="Batch mode: number of worker processes (default: all CPUs)",
+    )
+    levels = parser.add_mutually_exclusive_group()
+    levels.add_argument(
         "--z-level",
         type=int,
         default=None,
         help="Z-level index for 4D data (default: 0 for WRF, 3 (~1.25m) for PALM)",
     )
+    levels.add_argument(
+        "--z-levels",
+        type=_parse_levels,
+        default=None,
+        help="Several z-level indices read in one pass, e.g. 0,3,5 or 0-7 or 0-20:5",
+    )
+    levels.add_argument(
+        "--heights",
+        type=_parse_heights,
+        default=None,
+        help="Target heights in metres, matched to the nearest z coordinate, e.g. 1.25,10,50",
+    )
+    parser.add_argument(
+        "--level-layout",
+        default="separate",
+        choices=["separate", "stacked"],
+        help="Multi-level output: one COG per level ({z} in -o, or _z<N> appended) "
+        "or one COG with time-major bands named t<T>_z<N> (default: separate)",
+    )
     parser.add_argument(
         "--resampling",
         "-r",
         default="bilinear",
         choices=["nearest", "average", "bilinear", "cubic"],
+        help="Resampling method (default: bilinear). On WRF grids nearest and bilinear "
+        "use the cached resampling index; average and cubic warp from GCPs, slower",
     )
     parser.add_argument(
         "--compress",
@@ -407,8 +1462,71 @@ def main():
         default="DEFLATE",
         choices=["DEFLATE", "LZW", "JPEG", "WEBP"],
     )
+    parser.add_argument(
+        "--index-cache",
+        type=Path,
+        default=DEFAULT_INDEX_CACHE,
+        help="Directory for cached WRF resampling indexes (default: index_cache/)",
+    )
+    parser.add_argument(
+        "--no-index-cache",
+        action="store_true",
+        help="Rebuild the WRF resampling index in memory without touching the cache",
+    )
+    parser.add_argument(
+        "--threads",
+        "-t",
+        type=int,
+        default=None,
+        help="Threads warping timesteps in parallel while one thread reads the "
+        "NetCDF (default: all CPUs; in batch mode, CPUs / workers)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild outputs even if the build cache says they are up to date",
+    )
+    parser.add_argument(
+        "--list-recipes",
+        action="store_true",
+        help="List the named derived-variable recipes and exit",
+    )
+    parser.add_argument(
+        "--max-memory",
+        default=None,
+        help="Memory budget for data buffers and caches per output, e.g. 2G or 512M "
+        "(plain numbers are MB). Caps the chunk and GDAL caches and spills the band "
+        "stack to one temporary GeoTIFF if needed",
+    )
 
     args = parser.parse_args()
+    if args.list_recipes:
+        for name, expression in RECIPES.items():
+            print(f"{name:>10}  {expression}")
+        print(f"\nFunctions: {', '.join(EXPRESSION_FUNCTIONS)}")
+        return
+    index_cache = None if args.no_index_cache else args.index_cache
+    max_memory = _parse_size(args.max_memory) if args.max_memory else None
+
+    if args.manifest:
+        if not args.manifest.exists():
+            raise FileNotFoundError(f"Manifest not found: {args.manifest}")
+        results = run_batch(
+            args.manifest,
+            args.workers,
+            index_cache,
+            max_memory,
+            args.threads,
+            force=args.force,
+        )
+        failed = [r for r in results if r["error"]]
+        if failed:
+            raise SystemExit(f"\n{len(failed)} output(s) failed")
+        print("\nDone!")
+        return
+
+    if not (args.input and args.variable and args.output):
+        parser.error("--input, --variable and --output are required without --manifest")
 
     if not Path(args.input).exists():
         raise FileNotFoundError(f"Input file not found: {args.input}")
@@ -420,22 +1538,43 @@ def main():
 
     # Auto-detect z-level default for PALM if not specified
     z_level = args.z_level
-    if z_level is None:
+    if z_level is None and not (args.z_levels or args.heights):
         ds = nc.Dataset(args.input)
-        if _detect_grid_type(ds) == "palm":
-            z_level = 3  # ~1.25m, pedestrian height
+        z_level = _default_z_level(_detect_grid_type(ds))
+        if z_level is not None:
             print(f"  PALM detected: using default z-level {z_level} (~1.25m)")
         ds.close()
 
+    cache = BuildCache()
+    task = {
+        "input": args.input,
+        "variable": args.variable,
+        "z_levels": args.z_levels or ([z_level] if z_level is not None else None),
+        "heights": args.heights,
+        "level_layout": args.level_layout,
+        "resampling": args.resampling,
+        "compress": args.compress,
+    }
+    key = _task_key(cache, task)
+    if cache.check(args.output, key, force=args.force):
+        return
+
     print(f"\nExtracting variable '{args.variable}'...")
-    extract_variable_to_cog(
+    outputs = extract_variable_to_cog(
         args.input,
         args.variable,
         args.output,
         z_level=z_level,
         resampling=args.resampling,
         compress=args.compress,
+        index_cache=index_cache,
+        max_memory=max_memory,
+        z_levels=args.z_levels,
+        heights=args.heights,
+        level_layout=args.level_layout,
+        threads=args.threads,
     )
+    cache.record(args.output, key, outputs)
 
     print("\nDone!")
 
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Content-addressed rebuild cache shared by the processing pipelines.
+
+Every artifact (a COG, a GeoJSON, a PMTiles/MBTiles file, ...) is keyed by a
+hash of the scripts that produce it, the content of its inputs and its
+parameters. The key and a stat fingerprint of the written outputs are
+recorded in a local manifest (processing/.build_cache.json, or
+$PROCESSING_BUILD_CACHE). A rerun whose key is unchanged and whose outputs
+are still the ones recorded is skipped; anything else is rebuilt.
+
+Input file digests are themselves cached by (size, mtime), so multi-GB
+NetCDF files are only hashed again when they change on disk. Directories
+(e.g. XYZ tile trees) are fingerprinted from their file names, sizes and
+mtimes rather than their content.
+
+Python usage:
+    cache = BuildCache()
+    key = cache.key([__file__], inputs=[csv_path], params={"mode": "point"})
+    if cache.check(output_path, key, force=args.force):
+        return
+    ...build output_path...
+    cache.record(output_path, key)
+
+Shell usage (exit status 0 when up to date):
+    python3 build_cache.py check out.pmtiles --script process.sh \\
+        --inputs in.geojson --param layer=flows && exit 0
+    ...build out.pmtiles...
+    python3 build_cache.py record out.pmtiles --script process.sh \\
+        --inputs in.geojson --param layer=flows
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+DEFAULT_MANIFEST = Path(__file__).resolve().parent / ".build_cache.json"
+
+# Bump when the key derivation changes, so every artifact is rebuilt once
+CACHE_VERSION = 1
+
+# Files that belong to a shapefile and change its content
+SHAPEFILE_SIDECARS = (".shx", ".dbf", ".prj", ".cpg")
+
+
+def with_sidecars(path: str | Path) -> list[Path]:
+    """Return a geometry file plus its existing shapefile sidecars (.dbf, .prj, ...)."""
+    path = Path(path)
+    if path.suffix.lower() != ".shp":
+        return [path]
+    sidecars = [path.with_suffix(ext) for ext in SHAPEFILE_SIDECARS]
+    return [path] + [p for p in sidecars if p.exists()]
+
+
+def _sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stat_fingerprint(path: Path) -> list[int]:
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+class BuildCache:
+    """Manifest of artifact keys, backed by a JSON file shared between runs."""
+
+    def __init__(self, manifest: str | Path | None = None):
+        self.path = Path(
+            manifest or os.environ.get("PROCESSING_BUILD_CACHE") or DEFAULT_MANIFEST
+        )
+        self.data = self._load()
+        self._new_digests: dict[str, dict] = {}
+
+    def _load(self) -> dict:
+        try:
+            data = json.loads(self.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"version": CACHE_VERSION, "artifacts": {}, "files": {}}
+        if data.get("version") != CACHE_VERSION:
+            return {"version": CACHE_VERSION, "artifacts": {}, "files": {}}
+        return data
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the manifest while it is re-read and rewritten."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(self.path.name + ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def digest(self, path: str | Path) -> str:
+        """Content digest of a file (cached by size/mtime) or fingerprint of a directory."""
+        path = Path(path).resolve()
+        if path.is_dir():
+            entries = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = Path(root, name)
+                    rel = file_path.relative_to(path).as_posix()
+                    entries.update(f"{rel}\0{_stat_fingerprint(file_path)}\n".encode())
+            return "dir:" + entries.hexdigest()
+
+        stat = _stat_fingerprint(path)
+        cached = self.data["files"].get(str(path))
+        if cached and cached["stat"] == stat:
+            return cached["sha256"]
+        sha = _sha256_file(path)
+        self.data["files"][str(path)] = self._new_digests[str(path)] = {
+            "stat": stat,
+            "sha256": sha,
+        }
+        return sha
+
+    def key(
+        self,
+        scripts: list[str | Path],
+        inputs: list[str | Path] = (),
+        params: dict | None = None,
+    ) -> str:
+        """Hash scripts, inputs and parameters into an artifact key.
+
+        Scripts and inputs are hashed by content; a missing input raises
+        FileNotFoundError, as the build itself would.
+        """
+        parts = {
+            "version": CACHE_VERSION,
+            "scripts": [self.digest(script) for script in scripts],
+            "inputs": {str(Path(p).resolve()): self.digest(p) for p in inputs},
+            "params": params or {},
+        }
+        blob = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hashlib.sha256(blob).hexdigest()
+
+    def is_fresh(self, target: str | Path, key: str) -> bool:
+        """True when target was recorded with this key and its outputs are untouched."""
+        entry = self.data["artifacts"].get(str(Path(target).resolve()))
+        if not entry or entry["key"] != key:
+            return False
+        for output, stat in entry["outputs"].items():
+            try:
+                if _stat_fingerprint(Path(output)) != stat:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def check(self, target: str | Path, key: str, force: bool = False) -> bool:
+        """Report and return whether target can be skipped (never with force)."""
+        if force or not self.is_fresh(target, key):
+            return False
+        print(f"✓ {target} is up to date (use --force to rebuild)", file=sys.stderr)
+        return True
+
+    def record(
+        self, target: str | Path, key: str, outputs: list[str | Path] | None = None
+    ) -> None:
+        """Record a successful build of target (and any extra outputs it wrote)."""
+        outputs = [Path(p).resolve() for p in (outputs or [target])]
+        entry = {
+            "key": key,
+            "outputs": {str(p): _stat_fingerprint(p) for p in outputs},
+            "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with self._locked():
+            # Merge into the latest manifest: other runs may have recorded since
+            data = self._load()
+            data["files"].update(self._new_digests)
+            data["artifacts"][str(Path(target).resolve())] = entry
+            tmp = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(data, indent=1, sort_keys=True))
+            os.replace(tmp, self.path)
+        self.data = data
+        self._new_digests = {}
+
+
+def _parse_params(items: list[str]) -> dict:
+    params = {}
+    for item in items:
+        name, sep, value = item.partition("=")
+        if not sep:
+            raise SystemExit(f"--param expects NAME=VALUE, got '{item}'")
+        params[name] = value
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check or record an artifact in the processing build cache"
+    )
+    parser.add_argument("action", choices=["check", "record"])
+    parser.add_argument("target", help="Artifact path")
+    parser.add_argument(
+        "--script", action="append", default=[], help="Script producing it (repeatable)"
+    )
+    parser.add_argument("--inputs", nargs="*", default=[], help="Input files or directories")
+    parser.add_argument(
+        "--param", action="append", default=[], help="NAME=VALUE parameter (repeatable)"
+    )
+    parser.add_argument("--outputs", nargs="*", help="All files written (default: target)")
+    parser.add_argument("--force", action="store_true", help="check: always report stale")
+    args = parser.parse_args()
+
+    inputs = [p for path in args.inputs for p in with_sidecars(path)]
+    cache = BuildCache()
+    key = cache.key(args.script, inputs, _parse_params(args.param))
+    if args.action == "check":
+        sys.exit(0 if cache.check(args.target, key, force=args.force) else 1)
+    cache.record(args.target, key, args.outputs)
+
+
+if __name__ == "__main__":
+    main()
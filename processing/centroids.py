@@ -0,0 +1,89 @@
+"""
+Cached centroid lookup tables for geometry files (SHP/GPKG).
+
+A spatial join only needs one lon/lat point per geometry id, yet reading a
+shapefile, reprojecting every polygon and computing centroids dominates the
+run for small CSVs, and the same grid is reused across scenarios (all DAVE
+flow files share the 500 m Vaud/Geneva grid). The id → (lon, lat) table is
+therefore cached as a small .npz in processing/.centroid_cache/ (or
+$PROCESSING_CENTROID_CACHE), keyed by the content of the geometry file and
+its sidecars, the id column, the target CRS and this module.
+
+Centroids are computed in the layer's projected CRS, where they are
+meaningful, and only the points are reprojected to WGS84. A layer in
+geographic coordinates is first projected to its UTM zone.
+
+Usage (from a converter one directory down, imported like build_cache):
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from centroids import centroid_table
+
+    table = centroid_table("grid.shp", "id")    # DataFrame: id, lon, lat
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from build_cache import BuildCache, with_sidecars
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / ".centroid_cache"
+TARGET_CRS = "EPSG:4326"
+
+
+def _compute(geom_path: str | Path, id_col: str, crs: str) -> pd.DataFrame:
+    gdf = gpd.read_file(geom_path)
+    if gdf.crs is None:
+        raise SystemExit(f"{geom_path} has no CRS; cannot compute centroids")
+    if gdf.crs.is_geographic:
+        gdf = gdf.to_crs(gdf.estimate_utm_crs())
+    points = gdf.geometry.centroid.to_crs(crs)
+    return pd.DataFrame(
+        {"id": gdf[id_col].to_numpy(), "lon": points.x.to_numpy(), "lat": points.y.to_numpy()}
+    )
+
+
+def _storable_ids(ids: np.ndarray) -> np.ndarray | None:
+    """ids as a plain numpy array that .npz stores without pickling, or None."""
+    if ids.dtype.kind in "iuf":
+        return ids
+    values = ids.tolist()
+    if all(isinstance(value, str) for value in values):
+        return np.array(values, dtype=str)
+    return None
+
+
+def centroid_table(
+    geom_path: str | Path,
+    id_col: str,
+    crs: str = TARGET_CRS,
+    cache_dir: str | Path | None = None,
+) -> pd.DataFrame:
+    """id, lon, lat of every geometry's centroid, in file order (repeated ids kept)."""
+    cache_dir = Path(
+        cache_dir or os.environ.get("PROCESSING_CENTROID_CACHE") or DEFAULT_CACHE_DIR
+    )
+    cache = BuildCache()
+    key = cache.key([__file__], with_sidecars(geom_path), {"id_col": id_col, "crs": crs})
+    path = cache_dir / f"{Path(geom_path).stem}.{key[:16]}.npz"
+
+    if path.exists():
+        with np.load(path) as data:
+            table = pd.DataFrame({"id": data["id"], "lon": data["lon"], "lat": data["lat"]})
+        print(f"  Centroids loaded from cache ({path.name})", file=sys.stderr)
+        return table
+
+    table = _compute(geom_path, id_col, crs)
+    ids = _storable_ids(table["id"].to_numpy())
+    if ids is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(tmp, id=ids, lon=table["lon"].to_numpy(), lat=table["lat"].to_numpy())
+        os.replace(tmp, path)
+        # Persists the input digests, so the next key is computed from stat alone
+        cache.record(path, key)
+    return table
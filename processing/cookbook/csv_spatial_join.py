@@ -16,121 +16,161 @@ Usage:
     python csv_spatial_join.py grid.shp flows.csv -o flows.geojson \\
         --join-col origin --geom-id-col id --mode line \\
         --origin-col origin --dest-col dest --value-col flow
+
+    # Newline-delimited features straight into tippecanoe (no intermediate file)
+    python csv_spatial_join.py zones.shp data.csv -o - \\
+        --join-col zone_id --geom-id-col id | tippecanoe -o data.pmtiles -l data
 """
 
 import argparse
-import json
 import sys
+from pathlib import Path
+from typing import Iterable, Iterator
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from build_cache import BuildCache, with_sidecars  # noqa: E402
+from centroids import centroid_table  # noqa: E402
+from feature_io import (  # noqa: E402
+    PRECISION,
+    FeatureWriter,
+    GeoParquetWriter,
+    is_stdout,
+    open_writer,
+    read_chunks,
+)
+
+
+def _key(value) -> int | str:
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return str(value)
+
+
+def _normalise(column: pd.Series) -> tuple[pd.Series, np.ndarray]:
+    """Join keys of a column (int when int() accepts the value, else str) and an is-int mask.
 
-def build_centroid_lookup(
-    geom_path: str, geom_id_col: str
-) -> dict[int | str, tuple[float, float]]:
-    """Load geometry file, reproject to WGS84, return {id: (lon, lat)} dict."""
+    The conversion runs once per distinct value, not once per row.
+    """
+    if column.dtype.kind in "iu":
+        return column, np.ones(len(column), dtype=bool)
+    codes, uniques = pd.factorize(column, use_na_sentinel=False)
+    keys = np.empty(len(uniques), dtype=object)
+    keys[:] = [_key(value) for value in uniques]
+    is_int = np.array([type(key) is int for key in keys], dtype=bool)
+    return pd.Series(keys[codes], index=column.index), is_int[codes]
+
+
+def _values(column: pd.Series) -> list:
+    """Plain Python values of a column, None where missing."""
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+def build_centroid_lookup(geom_path: str, geom_id_col: str) -> pd.DataFrame:
+    """Return a key/lon/lat DataFrame of WGS84 centroids (cached, see ../centroids.py)."""
     print(f"Loading geometry from {geom_path}...", file=sys.stderr)
-    gdf = gpd.read_file(geom_path)
-    gdf_wgs84 = gdf.to_crs("EPSG:4326")
-    centroids = gdf_wgs84.set_index(geom_id_col)["geometry"].centroid
-    lookup = {}
-    for idx, geom in centroids.items():
-        try:
-            key = int(idx)
-        except (ValueError, TypeError):
-            key = str(idx)
-        lookup[key] = (geom.x, geom.y)
+    centroids = centroid_table(geom_path, geom_id_col)
+    keys, _ = _normalise(centroids["id"])
+    lookup = centroids[["lon", "lat"]].assign(key=keys.to_numpy())[["key", "lon", "lat"]]
+    # A repeated ID keeps its last geometry
+    lookup = lookup.drop_duplicates("key", keep="last")
     print(f"  {len(lookup)} geometries loaded", file=sys.stderr)
     return lookup
 
 
+def join_centroids(keys: pd.Series, lookup: pd.DataFrame) -> pd.DataFrame:
+    """lon/lat of the centroid matching each key, NaN when unmatched; row order is kept."""
+    left, right = keys, lookup["key"]
+    if left.dtype != right.dtype:
+        left, right = left.astype(object), right.astype(object)
+    joined = pd.DataFrame({"key": left.to_numpy()}).merge(
+        lookup.assign(key=right.to_numpy()), on="key", how="left"
+    )
+    return joined[["lon", "lat"]]
+
+
 def point_mode(
-    df: pd.DataFrame,
-    lookup: dict,
+    chunks: Iterable[pd.DataFrame],
+    lookup: pd.DataFrame,
     join_col: str,
-) -> list[dict]:
+    writer: FeatureWriter | GeoParquetWriter,
+) -> None:
     """One Point per CSV row, located at the centroid of the matched geometry."""
-    prop_cols = [c for c in df.columns if c != join_col]
-    features, skipped = [], 0
-
-    for _, row in df.iterrows():
-        try:
-            key = int(row[join_col])
-        except (ValueError, TypeError):
-            key = str(row[join_col])
-
-        if key not in lookup:
-            skipped += 1
-            continue
-
-        lon, lat = lookup[key]
-        features.append({
-            "type": "Feature",
-            "geometry": {"type": "Point", "coordinates": [lon, lat]},
-            "properties": {
-                col: (None if pd.isna(row[col]) else row[col]) for col in prop_cols
-            },
-        })
+    skipped = 0
+    for df in chunks:
+        prop_cols = [c for c in df.columns if c != join_col]
+        keys, _ = _normalise(df[join_col])
+        coords = join_centroids(keys, lookup)
+
+        matched = coords["lon"].notna().to_numpy()
+        skipped += len(df) - int(matched.sum())
+        df, coords = df[matched], coords[matched]
+
+        writer.write_points(
+            coords["lon"].to_numpy(),
+            coords["lat"].to_numpy(),
+            {c: _values(df[c]) for c in prop_cols},
+        )
 
     if skipped:
         print(f"  Skipped {skipped} rows with unmatched IDs", file=sys.stderr)
-    return features
 
 
 def line_mode(
-    df: pd.DataFrame,
-    lookup: dict,
+    chunks: Iterable[pd.DataFrame],
+    lookup: pd.DataFrame,
     origin_col: str,
     dest_col: str,
     value_col: str,
-) -> list[dict]:
+    writer: FeatureWriter | GeoParquetWriter,
+) -> None:
     """One LineString per CSV row, from origin centroid to dest centroid."""
-    # Drop self-flows
-    before = len(df)
-    df = df[df[origin_col] != df[dest_col]]
-    if len(df) < before:
-        print(
-            f"  Dropped {before - len(df)} self-flows (origin == dest)", file=sys.stderr
-        )
+    self_flows = skipped = 0
+    for df in chunks:
+        # Drop self-flows
+        before = len(df)
+        df = df[df[origin_col] != df[dest_col]]
+        self_flows += before - len(df)
 
-    extra_cols = [
-        c for c in df.columns if c not in (origin_col, dest_col, value_col)
-    ]
-    features, skipped = [], 0
-
-    for _, row in df.iterrows():
-        try:
-            o_key, d_key = int(row[origin_col]), int(row[dest_col])
-        except (ValueError, TypeError):
-            o_key, d_key = str(row[origin_col]), str(row[dest_col])
-
-        if o_key not in lookup or d_key not in lookup:
-            skipped += 1
-            continue
-
-        o_lon, o_lat = lookup[o_key]
-        d_lon, d_lat = lookup[d_key]
-        props = {
-            value_col: float(row[value_col]),
-            "origin": o_key,
-            "dest": d_key,
-        }
-        for col in extra_cols:
-            props[col] = None if pd.isna(row[col]) else row[col]
-
-        features.append({
-            "type": "Feature",
-            "geometry": {
-                "type": "LineString",
-                "coordinates": [[o_lon, o_lat], [d_lon, d_lat]],
+        extra_cols = [
+            c for c in df.columns if c not in (origin_col, dest_col, value_col)
+        ]
+        o_keys, o_int = _normalise(df[origin_col])
+        d_keys, d_int = _normalise(df[dest_col])
+        # Both keys are ints only if both convert; otherwise both are compared as strings
+        mixed = ~(o_int & d_int)
+        if mixed.any():
+            o_keys, d_keys = o_keys.astype(object), d_keys.astype(object)
+            o_keys[mixed] = df[origin_col][mixed].map(str)
+            d_keys[mixed] = df[dest_col][mixed].map(str)
+        origin = join_centroids(o_keys, lookup)
+        dest = join_centroids(d_keys, lookup)
+
+        matched = (origin["lon"].notna() & dest["lon"].notna()).to_numpy()
+        skipped += len(df) - int(matched.sum())
+        df, origin, dest = df[matched], origin[matched], dest[matched]
+        o_keys, d_keys = o_keys[matched], d_keys[matched]
+
+        writer.write_lines(
+            origin["lon"].to_numpy(),
+            origin["lat"].to_numpy(),
+            dest["lon"].to_numpy(),
+            dest["lat"].to_numpy(),
+            {
+                value_col: df[value_col].astype(float).tolist(),
+                "origin": o_keys.tolist(),
+                "dest": d_keys.tolist(),
+                **{c: _values(df[c]) for c in extra_cols},
             },
-            "properties": props,
-        })
+        )
 
+    if self_flows:
+        print(f"  Dropped {self_flows} self-flows (origin == dest)", file=sys.stderr)
     if skipped:
         print(f"  Skipped {skipped} rows with unmatched IDs", file=sys.stderr)
-    return features
 
 
 def main() -> None:
@@ -138,8 +178,13 @@ def main() -> None:
         description="Spatial join: CSV + geometry → GeoJSON (point or line)"
     )
     parser.add_argument("geometry", help="Geometry file (.shp or .gpkg)")
-    parser.add_argument("csv", help="Input CSV file")
-    parser.add_argument("-o", "--output", required=True, help="Output GeoJSON path")
+    parser.add_argument("csv", help="Input CSV file (or Parquet table)")
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Output path: .geojson, .geojsonseq (newline-delimited), .parquet (GeoParquet) or - for stdout",
+    )
     parser.add_argument(
         "--join-col",
         required=True,
@@ -160,32 +205,69 @@ def main() -> None:
     parser.add_argument(
         "--value-col", default="value", help="Numeric value column (line mode)"
     )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=PRECISION,
+        help=f"Decimal places kept in coordinates (default: {PRECISION})",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Rebuild even if the output is up to date"
+    )
     args = parser.parse_args()
 
+    if args.mode == "line" and (not args.origin_col or not args.dest_col):
+        print(
+            "Error: --origin-col and --dest-col required for line mode",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    # Output piped to stdout is always rebuilt
+    cache = key = None
+    if not is_stdout(args.output):
+        cache = BuildCache()
+        params = {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("geometry", "csv", "output", "force")
+        }
+        shared = Path(__file__).resolve().parent.parent
+        scripts = [__file__, shared / "feature_io.py", shared / "centroids.py"]
+        key = cache.key(
+            scripts,
+            with_sidecars(args.geometry) + [Path(args.csv)],
+            params,
+        )
+        if cache.check(args.output, key, force=args.force):
+            return
+
     lookup = build_centroid_lookup(args.geometry, args.geom_id_col)
 
     print(f"Loading CSV from {args.csv}...", file=sys.stderr)
-    df = pd.read_csv(args.csv)
-    print(f"  {len(df)} rows", file=sys.stderr)
-
-    if args.mode == "point":
-        features = point_mode(df, lookup, args.join_col)
-        geom_type = "Point"
-    else:
-        if not args.origin_col or not args.dest_col:
-            print(
-                "Error: --origin-col and --dest-col required for line mode",
-                file=sys.stderr,
+    rows = 0
+
+    def chunks() -> Iterator[pd.DataFrame]:
+        nonlocal rows
+        for df in read_chunks(args.csv):
+            rows += len(df)
+            yield df
+
+    with open_writer(args.output, precision=args.precision) as writer:
+        if args.mode == "point":
+            point_mode(chunks(), lookup, args.join_col, writer)
+            geom_type = "Point"
+        else:
+            line_mode(
+                chunks(), lookup, args.origin_col, args.dest_col, args.value_col, writer
             )
-            sys.exit(1)
-        features = line_mode(df, lookup, args.origin_col, args.dest_col, args.value_col)
-        geom_type = "LineString"
+            geom_type = "LineString"
+    print(f"  {rows} rows", file=sys.stderr)
 
-    geojson = {"type": "FeatureCollection", "features": features}
-    with open(args.output, "w") as f:
-        json.dump(geojson, f)
+    if cache:
+        cache.record(args.output, key)
 
-    print(f"\n{len(features)} {geom_type} features written to {args.output}", file=sys.stderr)
+    print(f"\n{writer.count} {geom_type} features written to {args.output}", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -2,92 +2,135 @@
 """
 Convert a CSV with lat/lon columns to GeoJSON Point features.
 
-All non-coordinate columns are preserved as feature properties.
+All non-coordinate columns are preserved as feature properties. The CSV is
+read and written in chunks, so memory use does not grow with its size.
 
 Usage:
     python csv_to_pmtiles.py data.csv -o data.geojson
     python csv_to_pmtiles.py data.csv -o data.geojson --lat-col latitude --lon-col longitude
 
+    # Newline-delimited features straight into tippecanoe (no intermediate file)
+    python csv_to_pmtiles.py data.csv -o - | tippecanoe -o data.pmtiles -l data
+
 Example:
     python csv_to_pmtiles.py sensors.csv -o sensors.geojson --lat-col y --lon-col x
 """
 
 import argparse
-import json
+import math
 import sys
+from pathlib import Path
 
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from build_cache import BuildCache  # noqa: E402
+from feature_io import PRECISION, is_stdout, open_writer, read_chunks  # noqa: E402
+
+
+def _values(column: pd.Series) -> list:
+    """Plain Python values of a column, None where missing."""
+    return column.astype(object).where(column.notna(), None).tolist()
+
 
 def csv_to_geojson(
-    input_csv: str, output_path: str, lat_col: str, lon_col: str
+    input_csv: str,
+    output_path: str,
+    lat_col: str,
+    lon_col: str,
+    precision: int = PRECISION,
 ) -> None:
     print(f"Loading {input_csv}...", file=sys.stderr)
-    df = pd.read_csv(input_csv)
-
-    if lat_col not in df.columns or lon_col not in df.columns:
-        available = ", ".join(df.columns.tolist())
-        print(
-            f"Error: columns '{lat_col}' and/or '{lon_col}' not found.\n"
-            f"Available columns: {available}",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-
-    # Drop rows with missing coordinates
-    before = len(df)
-    df = df.dropna(subset=[lat_col, lon_col])
-    if len(df) < before:
-        print(
-            f"  Dropped {before - len(df)} rows with missing coordinates",
-            file=sys.stderr,
-        )
+    dropped = 0
+    ranges: dict[str, tuple[float, float]] = {}
+
+    with open_writer(output_path, precision=precision) as writer:
+        for df in read_chunks(input_csv):
+            if lat_col not in df.columns or lon_col not in df.columns:
+                available = ", ".join(df.columns.tolist())
+                print(
+                    f"Error: columns '{lat_col}' and/or '{lon_col}' not found.\n"
+                    f"Available columns: {available}",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
+
+            # Drop rows with missing coordinates
+            before = len(df)
+            df = df.dropna(subset=[lat_col, lon_col])
+            dropped += before - len(df)
+
+            # Columns to include as properties (everything except lat/lon)
+            prop_cols = [c for c in df.columns if c not in (lat_col, lon_col)]
+            writer.write_points(
+                df[lon_col].astype(float).to_numpy(),
+                df[lat_col].astype(float).to_numpy(),
+                {col: _values(df[col]) for col in prop_cols},
+            )
 
-    # Columns to include as properties (everything except lat/lon)
-    prop_cols = [c for c in df.columns if c not in (lat_col, lon_col)]
-
-    features = []
-    for _, row in df.iterrows():
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [float(row[lon_col]), float(row[lat_col])],
-            },
-            "properties": {
-                col: (None if pd.isna(row[col]) else row[col])
-                for col in prop_cols
-            },
-        }
-        features.append(feature)
-
-    geojson = {"type": "FeatureCollection", "features": features}
-    with open(output_path, "w") as f:
-        json.dump(geojson, f)
-
-    print(f"\n{len(features)} Point features written to {output_path}", file=sys.stderr)
+            for col in prop_cols:
+                if not pd.api.types.is_numeric_dtype(df[col]):
+                    continue
+                lo, hi = df[col].min(), df[col].max()
+                if math.isnan(lo):
+                    continue
+                if col in ranges:
+                    lo, hi = min(lo, ranges[col][0]), max(hi, ranges[col][1])
+                ranges[col] = (lo, hi)
+
+    if dropped:
+        print(f"  Dropped {dropped} rows with missing coordinates", file=sys.stderr)
+    print(f"\n{writer.count} Point features written to {output_path}", file=sys.stderr)
 
     # Summary stats for numeric columns
-    for col in prop_cols:
-        if pd.api.types.is_numeric_dtype(df[col]):
-            print(
-                f"  {col}: {df[col].min():.2f} – {df[col].max():.2f}",
-                file=sys.stderr,
-            )
+    for col, (lo, hi) in ranges.items():
+        print(f"  {col}: {lo:.2f} – {hi:.2f}", file=sys.stderr)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Convert CSV with lat/lon to GeoJSON Point features"
     )
-    parser.add_argument("input", help="Input CSV file path")
-    parser.add_argument("-o", "--output", required=True, help="Output GeoJSON path")
+    parser.add_argument("input", help="Input CSV (or Parquet table) path")
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Output path: .geojson, .geojsonseq (newline-delimited), .parquet (GeoParquet) or - for stdout",
+    )
     parser.add_argument(
         "--lat-col", default="lat", help="Latitude column name (default: lat)"
     )
     parser.add_argument(
         "--lon-col", default="lon", help="Longitude column name (default: lon)"
     )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=PRECISION,
+        help=f"Decimal places kept in coordinates (default: {PRECISION})",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Rebuild even if the output is up to date"
+    )
     args = parser.parse_args()
 
-    csv_to_geojson(args.input, args.output, args.lat_col, args.lon_col)
+    if is_stdout(args.output):
+        # Output piped to stdout is always rebuilt
+        csv_to_geojson(
+            args.input, args.output, args.lat_col, args.lon_col, args.precision
+        )
+        sys.exit(0)
+
+    cache = BuildCache()
+    scripts = [__file__, Path(__file__).resolve().parent.parent / "feature_io.py"]
+    key = cache.key(
+        scripts,
+        [args.input],
+        {"lat_col": args.lat_col, "lon_col": args.lon_col, "precision": args.precision},
+    )
+    if not cache.check(args.output, key, force=args.force):
+        csv_to_geojson(
+            args.input, args.output, args.lat_col, args.lon_col, args.precision
+        )
+        cache.record(args.output, key)
@@ -9,6 +9,25 @@ destination grid cells. Self-flows (origin == dest) are excluded.
 Usage:
     python flows_to_geojson.py <grid.shp> <flows.csv> -o output.geojson
 
+    # Several scenarios in one run: the grid is loaded once and the flow files
+    # are converted in parallel; --pmtiles adds one tile archive with a layer
+    # per scenario (named by --layer, default: the output file name)
+    python flows_to_geojson.py <grid.shp> work.csv outdoor.csv \\
+        -o work.geojson -o outdoor.geojson --pmtiles flows.pmtiles
+
+    # Level-of-detail pyramid: flows summed between 1, 2 and 4 km blocks of the
+    # grid, top 20 per origin block, each shown in its own zoom band. They go to
+    # a tippecanoe input next to the output (output.pyramid.geojsonseq, also
+    # what --pmtiles tiles); output.geojson itself keeps only the cell flows
+    python flows_to_geojson.py <grid.shp> <flows.csv> -o output.geojson --pyramid
+
+    The blocks are laid out in the grid file's own CRS, which must be projected
+    in metres; --grid-crs lays them out in another one instead.
+
+The flow CSV is read and written in chunks, so memory use does not grow with
+the number of flows. Use `-o -` (or a .geojsonseq path) for newline-delimited
+features that tippecanoe reads straight from stdin.
+
 Example:
     python flows_to_geojson.py \\
         "../../frontend/public/DAVE simulations/500_grid_Vaud_Geneva_within.shp" \\
@@ -17,97 +36,470 @@ Example:
 """
 
 import argparse
-import json
+import math
+import os
+import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from build_cache import BuildCache, with_sidecars  # noqa: E402
+from centroids import centroid_table  # noqa: E402
+from feature_io import (  # noqa: E402
+    PRECISION,
+    is_parquet,
+    is_stdout,
+    open_writer,
+    read_chunks,
+)
 
-def flows_to_geojson(grid_path: str, flows_path: str, output_path: str) -> None:
-    """Convert an OD flow CSV + grid shapefile to a GeoJSON FeatureCollection.
 
-    Args:
-        grid_path: Path to the grid polygon shapefile. Must have an 'id' column.
-        flows_path: Path to the flow CSV. Must have 'origin', 'dest', 'flow' columns.
-        output_path: Path to write the output GeoJSON file.
-    """
+# tippecanoe settings for the flow archives (see README: "tippecanoe flags explained")
+TIPPECANOE_ARGS = ["--minimum-zoom=5", "--maximum-zoom=12", "--drop-densest-as-needed"]
+
+# --pyramid: block size in metres on the grid's projected CRS, and the zoom
+# band its flows are shown at; the original cells take over from BASE_MINZOOM
+PYRAMID = [(4000, 5, 7), (2000, 8, 9), (1000, 10, 10)]
+BASE_MINZOOM = 11
+TOP_K = 20
 
-    # --- Load grid and compute WGS84 centroids ---
+
+def load_grid(grid_path: str, crs: str | None = None) -> pd.DataFrame:
+    """WGS84 lon/lat of every grid cell centroid, indexed by cell id (cached, see ../centroids.py).
+
+    With crs, the centroids in that CRS are added as x/y columns.
+    """
     print("Loading grid shapefile...", file=sys.stderr)
-    grid = gpd.read_file(grid_path)
-    grid_wgs84 = grid.to_crs("EPSG:4326")
-    centroids = grid_wgs84.set_index("id")["geometry"].centroid
-    id_to_coords: dict[int, tuple[float, float]] = {
-        int(idx): (geom.x, geom.y) for idx, geom in centroids.items()
-    }
+    centroids = centroid_table(grid_path, "id")
+    if crs is not None:
+        projected = centroid_table(grid_path, "id", crs=crs)
+        centroids["x"] = projected["lon"].to_numpy()
+        centroids["y"] = projected["lat"].to_numpy()
+    columns = [c for c in ("lon", "lat", "x", "y") if c in centroids]
+    id_to_coords = centroids[columns].set_axis(centroids["id"].astype(int).to_numpy())
+    # A repeated cell id keeps its last geometry
+    id_to_coords = id_to_coords[~id_to_coords.index.duplicated(keep="last")]
     print(f"  {len(id_to_coords)} grid cells loaded", file=sys.stderr)
+    return id_to_coords
 
-    # --- Load flow CSV ---
-    print("Loading flow CSV...", file=sys.stderr)
-    flows = pd.read_csv(flows_path, index_col=0)
-    total_rows = len(flows)
 
-    # Filter self-flows: origin == dest produces zero-length lines
-    flows = flows[flows["origin"] != flows["dest"]]
-    print(
-        f"  {total_rows} rows → {len(flows)} after removing self-flows",
-        file=sys.stderr,
-    )
+def grid_crs(grid_path: str, crs: str | None = None) -> str:
+    """The projected CRS --pyramid lays blocks out in: crs, else the grid file's own.
 
-    # --- Build GeoJSON features ---
-    features = []
-    skipped = 0
+    Block sizes are metres, so a geographic CRS (or one in feet) is refused.
+    """
+    import geopandas as gpd
+    from pyproj import CRS
 
-    for _, row in flows.iterrows():
-        origin_id = int(row["origin"])
-        dest_id = int(row["dest"])
+    if crs is None:
+        # The CRS comes from the file's header; one row is enough to read it
+        source = gpd.read_file(grid_path, rows=1).crs
+        if source is None:
+            raise SystemExit(f"{grid_path} has no CRS; pass --grid-crs")
+    else:
+        source = CRS.from_user_input(crs)
+    unit = source.axis_info[0].unit_name if source.axis_info else None
+    if source.is_geographic or unit != "metre":
+        raise SystemExit(
+            f"--pyramid needs a projected CRS in metres for its blocks, got {source.to_string()}; "
+            "pass --grid-crs (e.g. the grid's local UTM zone)"
+        )
+    return source.to_string()
 
-        if origin_id not in id_to_coords or dest_id not in id_to_coords:
-            skipped += 1
-            continue
 
-        orig_lon, orig_lat = id_to_coords[origin_id]
-        dest_lon, dest_lat = id_to_coords[dest_id]
+def pyramid_path(output_path: str) -> str:
+    """The tippecanoe input written next to output_path by --pyramid."""
+    if is_stdout(output_path):
+        return output_path
+    path = Path(output_path)
+    return str(path.with_name(f"{path.name.split('.')[0]}.pyramid.geojsonseq"))
 
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "LineString",
-                "coordinates": [[orig_lon, orig_lat], [dest_lon, dest_lat]],
-            },
-            "properties": {
-                "flow": float(row["flow"]),
-                "origin": origin_id,
-                "dest": dest_id,
-            },
-        }
-        features.append(feature)
 
-    if skipped:
-        print(f"  Skipped {skipped} rows with unmatched grid IDs", file=sys.stderr)
+def block_levels(
+    cells: pd.DataFrame, sizes: list[int], crs: str
+) -> list[tuple[int, pd.Series, pd.DataFrame]]:
+    """For each block size: the block key of every cell and the lon/lat of every block.
+
+    cells has the x/y of every cell centroid in crs (load_grid with crs).
+    Blocks are squares of `size` metres keyed by an integer; a block's point
+    is the mean centroid of its cells, so lines end inside the gridded area.
+    """
+    from pyproj import Transformer
+
+    to_wgs84 = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+    x, y = cells["x"].to_numpy(), cells["y"].to_numpy()
+    levels = []
+    for size in sizes:
+        bx = np.floor(x / size).astype(np.int64)
+        by = np.floor(y / size).astype(np.int64)
+        keys = (bx - bx.min()) * (by.max() - by.min() + 1) + (by - by.min())
+        means = cells[["x", "y"]].groupby(keys).mean()
+        lon, lat = to_wgs84.transform(means["x"].to_numpy(), means["y"].to_numpy())
+        levels.append(
+            (
+                size,
+                pd.Series(keys, index=cells.index),
+                pd.DataFrame({"lon": lon, "lat": lat}, index=means.index),
+            )
+        )
+    return levels
+
+
+def top_flows(pairs: list[pd.Series], top_k: int) -> pd.DataFrame:
+    """Sum per-chunk (origin, dest) → flow totals and keep each origin's top_k flows.
+
+    Flows within one block are dropped, like self-flows between cells.
+    """
+    totals = pd.concat(pairs).groupby(level=["origin", "dest"]).sum().reset_index()
+    totals = totals[totals["origin"] != totals["dest"]]
+    totals = totals.sort_values(["origin", "flow"], ascending=[True, False], kind="stable")
+    return totals[totals.groupby("origin").cumcount() < top_k]
+
+
+def convert_flows(
+    id_to_coords: pd.DataFrame,
+    flows_path: str,
+    output_path: str,
+    precision: int = PRECISION,
+    levels: list[tuple[int, pd.Series, pd.DataFrame]] | None = None,
+    top_k: int = TOP_K,
+) -> dict:
+    """Stream one flow CSV into LineString features; returns its summary counts.
+
+    With levels (from block_levels), flows are also summed between the blocks
+    of each level, and a tippecanoe input is written to pyramid_path(output_path):
+    the top_k flows per origin block with their level's zoom band from PYRAMID,
+    and the per-cell flows from BASE_MINZOOM. The output itself keeps only
+    the per-cell flows, unless it is stdout, which then gets the tippecanoe
+    input.
+    """
+    total_rows = kept_rows = skipped = 0
+    flow_min, flow_max = math.inf, -math.inf
+    base_zoom = {"minzoom": BASE_MINZOOM}
+    # Per-chunk block-pair totals, one list per level
+    pairs = [[] for _ in levels or []]
+
+    with ExitStack() as stack:
+        writer = stack.enter_context(open_writer(output_path, precision=precision))
+        tiles = None
+        if levels is not None:
+            tiles = writer
+            if not is_stdout(output_path):
+                tiles = stack.enter_context(
+                    open_writer(pyramid_path(output_path), precision=precision)
+                )
+        for flows in read_chunks(flows_path, index_col=0):
+            total_rows += len(flows)
+
+            # Filter self-flows: origin == dest produces zero-length lines
+            flows = flows[flows["origin"] != flows["dest"]]
+            kept_rows += len(flows)
+
+            origin_ids = flows["origin"].astype(int).to_numpy()
+            dest_ids = flows["dest"].astype(int).to_numpy()
+            origin = id_to_coords.reindex(origin_ids)
+            dest = id_to_coords.reindex(dest_ids)
+            matched = origin["lon"].notna().to_numpy() & dest["lon"].notna().to_numpy()
+            skipped += len(flows) - int(matched.sum())
+
+            flow = flows["flow"].astype(float).to_numpy()[matched]
+            if len(flow):
+                flow_min = min(flow_min, flow.min())
+                flow_max = max(flow_max, flow.max())
+
+            # Features share one pre-encoded LineString skeleton (see feature_io)
+            lines = (
+                origin["lon"].to_numpy()[matched],
+                origin["lat"].to_numpy()[matched],
+                dest["lon"].to_numpy()[matched],
+                dest["lat"].to_numpy()[matched],
+                {
+                    "flow": flow.tolist(),
+                    "origin": origin_ids[matched].tolist(),
+                    "dest": dest_ids[matched].tolist(),
+                },
+            )
+            if tiles is not writer:
+                writer.write_lines(*lines)
+            if tiles is not None:
+                tiles.write_lines(*lines, tippecanoe=base_zoom)
 
-    # --- Write output ---
-    geojson = {"type": "FeatureCollection", "features": features}
-    with open(output_path, "w") as f:
-        json.dump(geojson, f)
+            for (_, blocks, _), level_pairs in zip(levels or [], pairs):
+                chunk = pd.DataFrame(
+                    {
+                        "origin": blocks.reindex(origin_ids[matched]).to_numpy(),
+                        "dest": blocks.reindex(dest_ids[matched]).to_numpy(),
+                        "flow": flow,
+                    }
+                )
+                level_pairs.append(chunk.groupby(["origin", "dest"])["flow"].sum())
 
-    flow_values = [f["properties"]["flow"] for f in features]
-    print(f"\nOutput: {len(features)} LineString features", file=sys.stderr)
+        level_counts = {}
+        for (size, _, points), level_pairs, (_, minzoom, maxzoom) in zip(
+            levels or [], pairs, PYRAMID
+        ):
+            if not level_pairs:
+                level_counts[size] = 0
+                continue
+            top = top_flows(level_pairs, top_k)
+            origin = points.loc[top["origin"].to_numpy()]
+            dest = points.loc[top["dest"].to_numpy()]
+            level_counts[size] = tiles.write_lines(
+                origin["lon"].to_numpy(),
+                origin["lat"].to_numpy(),
+                dest["lon"].to_numpy(),
+                dest["lat"].to_numpy(),
+                {"flow": top["flow"].tolist(), "block": [size] * len(top)},
+                tippecanoe={"minzoom": minzoom, "maxzoom": maxzoom},
+            )
+
+    features = writer.count
+    if tiles is writer:
+        features -= sum(level_counts.values())
+    return {
+        "flows": flows_path,
+        "output": output_path,
+        "rows": total_rows,
+        "kept": kept_rows,
+        "skipped": skipped,
+        "features": features,
+        "flow_range": (flow_min, flow_max),
+        "pyramid": None if tiles is None else tiles.path,
+        "levels": level_counts,
+    }
+
+
+def report(summary: dict) -> None:
+    print(f"\n{summary['flows']}", file=sys.stderr)
     print(
-        f"Flow range: {min(flow_values):.0f} – {max(flow_values):.0f} persons",
+        f"  {summary['rows']} rows → {summary['kept']} after removing self-flows",
         file=sys.stderr,
     )
-    print(f"Written to: {output_path}", file=sys.stderr)
+    if summary["skipped"]:
+        print(f"  Skipped {summary['skipped']} rows with unmatched grid IDs", file=sys.stderr)
+
+    print(f"Output: {summary['features']} LineString features", file=sys.stderr)
+    if summary["features"]:
+        flow_min, flow_max = summary["flow_range"]
+        print(
+            f"Flow range: {flow_min:.0f} – {flow_max:.0f} persons",
+            file=sys.stderr,
+        )
+    print(f"Written to: {summary['output']}", file=sys.stderr)
+    if summary["pyramid"] is not None:
+        print(f"Pyramid ({summary['pyramid']}):", file=sys.stderr)
+        for size, count in summary["levels"].items():
+            print(f"  {count} between {size / 1000:g} km blocks", file=sys.stderr)
+
+
+def flows_to_geojson(
+    grid_path: str,
+    flows_path: str,
+    output_path: str,
+    precision: int = PRECISION,
+    pyramid: bool = False,
+    top_k: int = TOP_K,
+    crs: str | None = None,
+) -> None:
+    """Convert an OD flow CSV + grid shapefile to a GeoJSON FeatureCollection.
+
+    Args:
+        grid_path: Path to the grid polygon shapefile. Must have an 'id' column.
+        flows_path: Path to the flow CSV. Must have 'origin', 'dest', 'flow' columns.
+        output_path: Path to write the output GeoJSON file ('-' for stdout).
+        precision: Decimal places kept in coordinates.
+        pyramid: Also write block-aggregated flows for the PYRAMID zoom bands.
+        top_k: Flows kept per origin block in each pyramid level.
+        crs: Projected CRS of the pyramid blocks (default: the grid file's).
+    """
+    levels = None
+    if pyramid:
+        crs = grid_crs(grid_path, crs)
+        id_to_coords = load_grid(grid_path, crs)
+        levels = block_levels(id_to_coords, [size for size, _, _ in PYRAMID], crs)
+    else:
+        id_to_coords = load_grid(grid_path)
+    print("Loading flow CSV...", file=sys.stderr)
+    report(convert_flows(id_to_coords, flows_path, output_path, precision, levels, top_k))
+
+
+def convert_scenarios(
+    id_to_coords: pd.DataFrame,
+    tasks: list[tuple[str, str]],
+    precision: int = PRECISION,
+    workers: int = 1,
+    levels: list[tuple[int, pd.Series, pd.DataFrame]] | None = None,
+    top_k: int = TOP_K,
+) -> list[dict]:
+    """Convert (flows, output) pairs against one grid, in parallel worker processes."""
+    options = (precision, levels, top_k)
+    if workers <= 1 or len(tasks) == 1:
+        return [convert_flows(id_to_coords, f, o, *options) for f, o in tasks]
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        futures = [
+            pool.submit(convert_flows, id_to_coords, f, o, *options) for f, o in tasks
+        ]
+        return [future.result() for future in futures]
+
+
+def tippecanoe_version() -> str:
+    try:
+        result = subprocess.run(["tippecanoe", "--version"], capture_output=True, text=True)
+    except FileNotFoundError:
+        raise SystemExit("tippecanoe not found (https://github.com/felt/tippecanoe)")
+    return (result.stderr or result.stdout).strip()
+
+
+def build_archive(output: str, layers: dict[str, str]) -> None:
+    """One tippecanoe run writing every GeoJSON in layers (name → path) as its own layer."""
+    print(f"\nBuilding {output} with layers: {', '.join(layers)}", file=sys.stderr)
+    cmd = ["tippecanoe", f"--output={output}", "--force", *TIPPECANOE_ARGS]
+    for name, path in layers.items():
+        cmd.append(f"--named-layer={name}:{path}")
+    subprocess.run(cmd, check=True)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Convert DAVE OD flow CSV to GeoJSON LineString features"
+        description="Convert DAVE OD flow CSVs to GeoJSON LineString features"
     )
     parser.add_argument("grid", help="Path to grid shapefile (.shp)")
-    parser.add_argument("flows", help="Path to flow CSV file")
-    parser.add_argument("-o", "--output", required=True, help="Output GeoJSON path")
+    parser.add_argument(
+        "flows", nargs="+", help="Path to flow CSV file(s) (or Parquet tables)"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="append",
+        required=True,
+        help="Output path, once per flow file: .geojson, .geojsonseq (newline-delimited), "
+        ".parquet (GeoParquet) or - for stdout",
+    )
+    parser.add_argument(
+        "--pmtiles",
+        help="Also build one PMTiles archive with a layer per flow file (GeoJSON outputs only)",
+    )
+    parser.add_argument(
+        "--layer",
+        action="append",
+        help="Layer name in --pmtiles, once per flow file (default: output file name)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Flow files converted in parallel (default: all cores)",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="Also write a tippecanoe input (<output>.pyramid.geojsonseq, tiled by "
+        "--pmtiles) adding flows summed between 1, 2 and 4 km blocks for zoom 5-10; "
+        f"per-cell flows start at zoom {BASE_MINZOOM} in it",
+    )
+    parser.add_argument(
+        "--grid-crs",
+        help="Projected CRS in metres the --pyramid blocks are laid out in "
+        "(default: the grid file's own)",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=TOP_K,
+        help=f"Flows kept per origin block in each --pyramid level (default: {TOP_K})",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=PRECISION,
+        help=f"Decimal places kept in coordinates (default: {PRECISION})",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Rebuild even if the output is up to date"
+    )
     args = parser.parse_args()
 
-    flows_to_geojson(args.grid, args.flows, args.output)
+    if len(args.output) != len(args.flows):
+        parser.error("give one -o/--output per flow file")
+    layers = args.layer or [Path(o).name.split(".")[0] for o in args.output]
+    if len(layers) != len(args.flows):
+        parser.error("give one --layer per flow file")
+    if len(set(layers)) != len(layers):
+        parser.error(f"layer names must be unique: {layers}")
+    if args.pmtiles and any(
+        is_stdout(o) or (is_parquet(o) and not args.pyramid) for o in args.output
+    ):
+        parser.error("--pmtiles needs GeoJSON outputs (or --pyramid)")
+
+    if is_stdout(args.output[0]):
+        if len(args.flows) > 1:
+            parser.error("- (stdout) takes a single flow file")
+        # Output piped to stdout is always rebuilt
+        flows_to_geojson(
+            args.grid,
+            args.flows[0],
+            args.output[0],
+            args.precision,
+            args.pyramid,
+            args.top_k,
+            args.grid_crs,
+        )
+        sys.exit(0)
+
+    # Resolved up front: it is part of the cache key, and a bad CRS fails early
+    crs = grid_crs(args.grid, args.grid_crs) if args.pyramid else None
+    cache = BuildCache()
+    shared = Path(__file__).resolve().parent.parent
+    scripts = [__file__, shared / "feature_io.py", shared / "centroids.py"]
+    keys = {
+        output: cache.key(
+            scripts,
+            with_sidecars(args.grid) + [Path(flows)],
+            {
+                "precision": args.precision,
+                "pyramid": PYRAMID if args.pyramid else None,
+                "top_k": args.top_k if args.pyramid else None,
+                "grid_crs": crs,
+            },
+        )
+        for flows, output in zip(args.flows, args.output)
+    }
+    # With --pyramid each output comes with its tippecanoe input
+    targets = {
+        output: [output, pyramid_path(output)] if args.pyramid else [output]
+        for output in args.output
+    }
+    stale = [
+        (flows, output)
+        for flows, output in zip(args.flows, args.output)
+        if not all(cache.check(t, keys[output], force=args.force) for t in targets[output])
+    ]
+    if stale:
+        # The grid is read once and shared by every scenario
+        id_to_coords = load_grid(args.grid, crs)
+        levels = None
+        if args.pyramid:
+            levels = block_levels(id_to_coords, [size for size, _, _ in PYRAMID], crs)
+        print(f"Converting {len(stale)} flow file(s)...", file=sys.stderr)
+        for summary in convert_scenarios(
+            id_to_coords, stale, args.precision, args.workers, levels, args.top_k
+        ):
+            report(summary)
+            for target in targets[summary["output"]]:
+                cache.record(target, keys[summary["output"]])
+
+    if args.pmtiles:
+        tile_inputs = [targets[output][-1] for output in args.output]
+        archive_key = cache.key(
+            [__file__],
+            tile_inputs,
+            {"layers": layers, "tippecanoe": tippecanoe_version()},
+        )
+        if not cache.check(args.pmtiles, archive_key, force=args.force):
+            build_archive(args.pmtiles, dict(zip(layers, tile_inputs)))
+            cache.record(args.pmtiles, archive_key)
@@ -3,6 +3,8 @@ set -e
 
 # Convert DAVE flow CSV to PMTiles via GeoJSON spatial join.
 # Usage: ./process.sh <grid.shp> <flows.csv> <output.pmtiles>
+# Steps whose inputs are unchanged are skipped (see ../build_cache.py);
+# set FORCE=1 to rebuild everything.
 
 GRID_PATH="$1"
 FLOWS_PATH="$2"
@@ -10,23 +12,34 @@ OUTPUT_PMTILES="$3"
 
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 GEOJSON_OUT="$(dirname "${OUTPUT_PMTILES}")/$(basename "${OUTPUT_PMTILES}" .pmtiles).geojson"
+FORCE_FLAG="${FORCE:+--force}"
 
 echo "📦 Step 1: Converting flow CSV to GeoJSON (spatial join with grid)..."
 uv run --project "${SCRIPT_DIR}/.." \
   python "${SCRIPT_DIR}/flows_to_geojson.py" \
   "${GRID_PATH}" \
   "${FLOWS_PATH}" \
-  -o "${GEOJSON_OUT}"
+  -o "${GEOJSON_OUT}" \
+  ${FORCE_FLAG}
 
 echo "🗺️  Step 2: Converting GeoJSON to PMTiles with tippecanoe..."
-tippecanoe \
-  --output="${OUTPUT_PMTILES}" \
-  --layer=dave_flows \
-  --minimum-zoom=5 \
-  --maximum-zoom=12 \
-  --drop-densest-as-needed \
-  --force \
-  "${GEOJSON_OUT}"
+CACHE_ARGS=(
+  "${OUTPUT_PMTILES}"
+  --script "${SCRIPT_DIR}/process.sh"
+  --inputs "${GEOJSON_OUT}"
+  --param "tippecanoe=$(tippecanoe --version 2>&1)"
+)
+if ! python3 "${SCRIPT_DIR}/../build_cache.py" check "${CACHE_ARGS[@]}" ${FORCE_FLAG}; then
+  tippecanoe \
+    --output="${OUTPUT_PMTILES}" \
+    --layer=dave_flows \
+    --minimum-zoom=5 \
+    --maximum-zoom=12 \
+    --drop-densest-as-needed \
+    --force \
+    "${GEOJSON_OUT}"
+  python3 "${SCRIPT_DIR}/../build_cache.py" record "${CACHE_ARGS[@]}"
+fi
 
 echo "✅ Done! GeoJSON at ${GEOJSON_OUT}, PMTiles at ${OUTPUT_PMTILES}"
 echo ""
@@ -0,0 +1,526 @@
+"""
+Streaming feature I/O for the CSV → features converters.
+
+Converters read their table in chunks of CHUNK_ROWS rows (read_chunks: a CSV
+or a Parquet table) and hand each chunk's features to a writer from
+open_writer(), so memory stays flat whatever the input size. The output
+format follows the path:
+
+    -                               newline-delimited GeoJSON on stdout
+    .geojsonseq / .geojsonl /
+    .ndjson / .jsonl                newline-delimited GeoJSON (one feature per line)
+    .parquet / .geoparquet          GeoParquet: typed columns + WKB geometry
+    anything else (.geojson)        a FeatureCollection, written incrementally
+
+Newline-delimited output is what tippecanoe reads natively, so a converter
+can pipe straight into it without an intermediate file or ogr2ogr:
+
+    python csv_to_pmtiles.py data.csv -o - | tippecanoe -o data.pmtiles -l data
+
+JSON is written compact (no whitespace, UTF-8 rather than \\u escapes) with
+coordinates rounded to PRECISION decimals, and NaN/Infinity (missing values
+in pandas chunks) written as null, so the output stays valid JSON. orjson is
+used when installed (`uv sync --extra fast`), several times faster than
+the stdlib encoder; the two differ only in how very small or large floats
+are spelled.
+
+GeoParquet keeps a join's result typed and compressed, so it is built once
+and re-read cheaply: by tools that load only the columns they need, or by
+this module's CLI, which streams it back out as GeoJSON for tippecanoe
+(needs pyarrow and shapely 2: `uv sync --extra parquet`):
+
+    python3 feature_io.py flows.parquet - | tippecanoe -o flows.pmtiles -l flows
+
+Usage (from a converter one directory down, imported like build_cache):
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from feature_io import open_writer, read_chunks
+
+    with open_writer(args.output) as writer:
+        for chunk in read_chunks(args.input):
+            writer.write_points(
+                chunk["lon"].to_numpy(), chunk["lat"].to_numpy(),
+                {"name": chunk["name"].tolist()},
+            )
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+from itertools import islice, repeat
+from pathlib import Path
+from typing import Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib encoder writes the same JSON, slower
+    orjson = None
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import shapely
+except ImportError:  # optional: only GeoParquet input/output needs them
+    pa = None
+
+CHUNK_ROWS = 200_000
+SEQ_SUFFIXES = (".geojsonseq", ".geojsonl", ".ndjson", ".jsonl")
+PARQUET_SUFFIXES = (".parquet", ".geoparquet")
+STDOUT = "-"
+# Decimal places kept in coordinates: 6 is ~0.1 m, far below a zoom 12 pixel
+PRECISION = 6
+# Features encoded per write to the output by FeatureWriter.write
+BATCH = 10_000
+
+# Constant parts of every feature, encoded once
+_POINT = b'{"type":"Feature","geometry":{"type":"Point","coordinates":'
+_LINE = b'{"type":"Feature","geometry":{"type":"LineString","coordinates":'
+_PROPERTIES = b'},"properties":'
+_END = b"}"
+_COLLECTION = b'{"type":"FeatureCollection","features":['
+
+if orjson is not None:
+    _dumps = orjson.dumps
+else:
+    _encode = json.JSONEncoder(
+        ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    ).encode
+
+    def _finite(value):
+        """value with NaN/Infinity floats replaced by None, as orjson writes them."""
+        if isinstance(value, float):
+            return value if math.isfinite(value) else None
+        if isinstance(value, dict):
+            return {k: _finite(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [_finite(v) for v in value]
+        return value
+
+    def _dumps(value) -> bytes:
+        try:
+            return _encode(value).encode()
+        except ValueError:
+            # Only values holding NaN/Infinity pay for the cleanup
+            return _encode(_finite(value)).encode()
+
+
+def is_stdout(path: str) -> bool:
+    return str(path) == STDOUT
+
+
+def is_parquet(path: str) -> bool:
+    return Path(str(path)).suffix.lower() in PARQUET_SUFFIXES
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise SystemExit(
+            "Parquet input/output needs pyarrow and shapely 2. Run: uv sync --extra parquet"
+        )
+
+
+def read_chunks(path: str, **csv_options) -> Iterator:
+    """DataFrames of up to CHUNK_ROWS rows from a CSV or a Parquet table.
+
+    csv_options are passed to pd.read_csv and ignored for Parquet.
+    """
+    import pandas as pd
+
+    if not is_parquet(path):
+        yield from pd.read_csv(path, chunksize=CHUNK_ROWS, **csv_options)
+        return
+    _require_pyarrow()
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=CHUNK_ROWS):
+        yield batch.to_pandas()
+
+
+def _rounded(values, precision: int | None = PRECISION) -> list[float]:
+    """Coordinates as a list of floats rounded to precision decimals.
+
+    numpy arrays and pandas Series are rounded vectorised; other iterables
+    one value at a time.
+    """
+    if hasattr(values, "round"):
+        return (values if precision is None else values.round(precision)).tolist()
+    if precision is None:
+        return [float(v) for v in values]
+    return [round(float(v), precision) for v in values]
+
+
+def _round_nested(coords, precision: int):
+    if isinstance(coords, (list, tuple)):
+        return [_round_nested(c, precision) for c in coords]
+    return round(coords, precision)
+
+
+def _property_rows(properties: dict[str, list], count: int) -> Iterable[dict]:
+    names = list(properties)
+    if not names:
+        return repeat({}, count)
+    return (dict(zip(names, row)) for row in zip(*properties.values()))
+
+
+class FeatureWriter:
+    """Write GeoJSON features as they are produced, never holding them all.
+
+    Files are written under a temporary name and renamed into place by
+    close(), so an interrupted run never leaves a truncated output that
+    looks complete. Coordinates are rounded to `precision` decimals
+    (None keeps full precision).
+    """
+
+    def __init__(self, path: str, seq: bool | None = None, precision: int | None = PRECISION):
+        self.path = str(path)
+        if seq is None:
+            seq = is_stdout(self.path) or Path(self.path).suffix.lower() in SEQ_SUFFIXES
+        self.seq = seq
+        self.precision = precision
+        self.count = 0
+        if is_stdout(self.path):
+            self.tmp, self.fh = None, sys.stdout.buffer
+        else:
+            self.tmp = f"{self.path}.{os.getpid()}.tmp"
+            self.fh = open(self.tmp, "wb")
+        if not self.seq:
+            self.fh.write(_COLLECTION)
+
+    def _emit(self, encoded: list[bytes]) -> int:
+        if not encoded:
+            return 0
+        if self.seq:
+            self.fh.write(b"\n".join(encoded))
+            self.fh.write(b"\n")
+        else:
+            if self.count:
+                self.fh.write(b",")
+            self.fh.write(b",".join(encoded))
+        self.count += len(encoded)
+        return len(encoded)
+
+    def write(self, features: Iterable[dict]) -> int:
+        """Write feature dicts; returns how many were written."""
+        precision, written = self.precision, 0
+        features = iter(features)
+        while batch := list(islice(features, BATCH)):
+            if precision is not None:
+                for feature in batch:
+                    geometry = feature.get("geometry")
+                    if geometry and "coordinates" in geometry:
+                        geometry["coordinates"] = _round_nested(geometry["coordinates"], precision)
+            written += self._emit([_dumps(feature) for feature in batch])
+        return written
+
+    def write_points(self, lon, lat, properties: dict[str, list]) -> int:
+        """Write one Point per lon/lat pair; properties maps names to value columns."""
+        lon, lat = _rounded(lon, self.precision), _rounded(lat, self.precision)
+        rows = _property_rows(properties, len(lon))
+        return self._emit(
+            [
+                b"".join((_POINT, _dumps((x, y)), _PROPERTIES, _dumps(row), _END))
+                for x, y, row in zip(lon, lat, rows)
+            ]
+        )
+
+    def write_lines(
+        self, lon0, lat0, lon1, lat1, properties: dict[str, list], tippecanoe: dict | None = None
+    ) -> int:
+        """Write one two-point LineString per row; properties maps names to value columns.
+
+        tippecanoe, e.g. {"minzoom": 5, "maxzoom": 7}, is added to every feature
+        as tippecanoe's per-feature zoom range.
+        """
+        lon0, lat0 = _rounded(lon0, self.precision), _rounded(lat0, self.precision)
+        lon1, lat1 = _rounded(lon1, self.precision), _rounded(lat1, self.precision)
+        rows = _property_rows(properties, len(lon0))
+        end = _END if tippecanoe is None else b',"tippecanoe":' + _dumps(tippecanoe) + _END
+        return self._emit(
+            [
+                b"".join(
+                    (_LINE, _dumps(((x0, y0), (x1, y1))), _PROPERTIES, _dumps(row), end)
+                )
+                for x0, y0, x1, y1, row in zip(lon0, lat0, lon1, lat1, rows)
+            ]
+        )
+
+    def close(self) -> None:
+        if not self.seq:
+            self.fh.write(b"]}")
+        if self.tmp is None:
+            self.fh.flush()
+            return
+        self.fh.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self) -> None:
+        if self.tmp is not None:
+            self.fh.close()
+            os.unlink(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class GeoParquetWriter:
+    """Write features to GeoParquet, one row group per write call.
+
+    Properties become typed Arrow columns (a column mixing types, like join
+    keys that are int for some rows and str for others, is stored as
+    strings) next to a WKB `geometry` column in WGS84. NaN is stored as
+    null. Later chunks are cast to the column types of the first one; a
+    chunk that does not fit (pandas reads a column with gaps as float, a
+    column first all-null gets values, a new column appears) widens the
+    schema instead (_widened) and starts a new segment file, and close()
+    rewrites the segments into one file with the widest schema. Same
+    interface and temporary-file handling as FeatureWriter.
+    """
+
+    def __init__(self, path: str, precision: int | None = PRECISION):
+        _require_pyarrow()
+        self.path = str(path)
+        self.precision = precision
+        self.count = 0
+        self.tmp = f"{self.path}.{os.getpid()}.tmp"
+        self.writer = None
+        self.geometry_type = None
+        # Segment files written so far; the last one is open in self.writer
+        self.segments = []
+
+    @staticmethod
+    def _column(values: list):
+        try:
+            return pa.array(values, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if v is None else str(v) for v in values])
+
+    def _open_segment(self, schema) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        segment = f"{self.tmp}.{len(self.segments)}"
+        self.segments.append(segment)
+        self.writer = pq.ParquetWriter(segment, schema, compression="zstd")
+
+    def _emit(self, geometry_type: str, geometry, properties: dict[str, list]) -> int:
+        if not len(geometry):
+            return 0
+        if self.geometry_type not in (None, geometry_type):
+            raise ValueError(f"cannot mix {geometry_type} with {self.geometry_type} features")
+        columns = {name: self._column(values) for name, values in properties.items()}
+        columns["geometry"] = pa.array(shapely.to_wkb(geometry), type=pa.binary())
+        table = pa.table(columns)
+        if self.writer is None:
+            geo = {
+                "version": "1.0.0",
+                "primary_column": "geometry",
+                # No "crs": GeoParquet then means OGC:CRS84, i.e. WGS84 lon/lat
+                "columns": {"geometry": {"encoding": "WKB", "geometry_types": [geometry_type]}},
+            }
+            self._open_segment(table.schema.with_metadata({"geo": json.dumps(geo)}))
+            self.geometry_type = geometry_type
+        try:
+            table = _conformed(table, self.writer.schema)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            self._open_segment(_widened(self.writer.schema, table.schema))
+            table = _conformed(table, self.writer.schema)
+        self.writer.write_table(table)
+        self.count += len(geometry)
+        return len(geometry)
+
+    def write(self, features: Iterable[dict]) -> int:
+        """Write feature dicts; returns how many were written."""
+        written = 0
+        features = iter(features)
+        while batch := list(islice(features, BATCH)):
+            geometries = [f["geometry"] for f in batch]
+            if self.precision is not None:
+                for geom in geometries:
+                    geom["coordinates"] = _round_nested(geom["coordinates"], self.precision)
+            geometry = shapely.from_geojson([json.dumps(geom) for geom in geometries])
+            type_ids = set(shapely.get_type_id(geometry).tolist())
+            if len(type_ids) > 1:
+                raise ValueError(f"cannot mix geometry types in {self.path}")
+            names = dict.fromkeys(name for f in batch for name in f.get("properties") or {})
+            properties = {
+                name: [(f.get("properties") or {}).get(name) for f in batch] for name in names
+            }
+            written += self._emit(_GEOMETRY_TYPES[type_ids.pop()], geometry, properties)
+        return written
+
+    def write_points(self, lon, lat, properties: dict[str, list]) -> int:
+        """Write one Point per lon/lat pair; properties maps names to value columns."""
+        lon, lat = _rounded(lon, self.precision), _rounded(lat, self.precision)
+        return self._emit("Point", shapely.points(lon, lat), properties)
+
+    def write_lines(
+        self, lon0, lat0, lon1, lat1, properties: dict[str, list], tippecanoe: dict | None = None
+    ) -> int:
+        """Write one two-point LineString per row; properties maps names to value columns.
+
+        tippecanoe is accepted for FeatureWriter compatibility and dropped:
+        GeoParquet has no per-feature zoom range.
+        """
+        ends = [_rounded(v, self.precision) for v in (lon0, lat0, lon1, lat1)]
+        coords = np.array(ends, dtype=float).T.reshape(-1, 2, 2)
+        return self._emit("LineString", shapely.linestrings(coords), properties)
+
+    def close(self) -> None:
+        if self.writer is None:
+            # Nothing written: still leave a valid, empty file
+            self._open_segment(pa.schema([("geometry", pa.binary())]))
+        schema = self.writer.schema
+        self.writer.close()
+        self.writer = None
+        if len(self.segments) > 1:
+            # The last segment has the widest schema: bring the others to it
+            with pq.ParquetWriter(self.tmp, schema, compression="zstd") as out:
+                for segment in self.segments:
+                    source = pq.ParquetFile(segment)
+                    for group in range(source.num_row_groups):
+                        out.write_table(_conformed(source.read_row_group(group), schema))
+            for segment in self.segments:
+                os.unlink(segment)
+        else:
+            os.replace(self.segments[0], self.tmp)
+        self.segments = []
+        os.replace(self.tmp, self.path)
+
+    def abort(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        for path in [*self.segments, self.tmp]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _conformed(table, schema):
+    """table with exactly schema's columns, in order (missing ones null), cast to it.
+
+    Raises pyarrow's cast errors when a value does not fit, and ArrowInvalid
+    for a column schema lacks.
+    """
+    extra = set(table.column_names) - set(schema.names)
+    if extra:
+        raise pa.ArrowInvalid(f"new columns {sorted(extra)}")
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(len(table), field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _widened(schema, other):
+    """A schema both fit in: null columns take the other type, numbers widen
+    to int64 or float64, and any other conflict becomes a string column."""
+    types = {field.name: field.type for field in schema}
+    for field in other:
+        old = types.get(field.name)
+        if old is None or pa.types.is_null(old):
+            types[field.name] = field.type
+        elif pa.types.is_null(field.type) or old == field.type:
+            continue
+        elif all(pa.types.is_integer(t) for t in (old, field.type)):
+            types[field.name] = pa.int64()
+        elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (old, field.type)):
+            types[field.name] = pa.float64()
+        else:
+            types[field.name] = pa.string()
+    return pa.schema(list(types.items()), metadata=schema.metadata)
+
+
+# shapely type ids → GeoJSON geometry type names
+_GEOMETRY_TYPES = {
+    0: "Point",
+    1: "LineString",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+}
+
+
+def open_writer(
+    path: str, precision: int | None = PRECISION
+) -> FeatureWriter | GeoParquetWriter:
+    """The writer for an output path: GeoParquet for .parquet/.geoparquet, else GeoJSON."""
+    if is_parquet(path):
+        return GeoParquetWriter(path, precision=precision)
+    return FeatureWriter(path, precision=precision)
+
+
+def copy_features(path: str, writer: FeatureWriter | GeoParquetWriter) -> int:
+    """Stream the features of a GeoParquet file into a writer; returns the count."""
+    _require_pyarrow()
+    source = pq.ParquetFile(path)
+    geo = json.loads(source.schema_arrow.metadata[b"geo"])
+    geometry_col = geo["primary_column"]
+    written = 0
+    for batch in source.iter_batches(batch_size=CHUNK_ROWS):
+        geometry = shapely.from_wkb(batch.column(geometry_col).to_numpy(zero_copy_only=False))
+        properties = {
+            name: batch.column(name).to_pylist()
+            for name in batch.schema.names
+            if name != geometry_col
+        }
+        types = shapely.get_type_id(geometry)
+        if (types == 0).all():
+            written += writer.write_points(
+                shapely.get_x(geometry), shapely.get_y(geometry), properties
+            )
+        elif (types == 1).all() and (shapely.get_num_points(geometry) == 2).all():
+            ends = shapely.get_coordinates(geometry).reshape(-1, 4)
+            written += writer.write_lines(*ends.T, properties)
+        else:
+            rows = _property_rows(properties, len(geometry))
+            written += writer.write(
+                {
+                    "type": "Feature",
+                    "geometry": json.loads(shapely.to_geojson(geom)),
+                    "properties": row,
+                }
+                for geom, row in zip(geometry, rows)
+            )
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Stream a GeoParquet file out as GeoJSON, GeoJSONSeq or GeoParquet"
+    )
+    parser.add_argument("input", help="GeoParquet file")
+    parser.add_argument(
+        "output", help="Output path (.geojsonseq for newline-delimited, - for stdout)"
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=PRECISION,
+        help=f"Decimal places kept in coordinates (default: {PRECISION})",
+    )
+    args = parser.parse_args()
+
+    with open_writer(args.output, precision=args.precision) as writer:
+        copy_features(args.input, writer)
+    print(f"{writer.count} features written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
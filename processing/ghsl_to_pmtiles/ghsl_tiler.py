@@ -0,0 +1,729 @@
+#!/usr/bin/env python3
+"""
+Render the GHSL built-surface COG straight into a PMTiles archive.
+
+Replaces `gdaldem color-relief` + `gdal2tiles.py` + pack_mbtiles.py: the
+EPSG:3857 COG is read with windowed reads (one 2048 px metatile at a time,
+using the COG overviews at low zooms), colored with the 5-column RGBA ramp of
+ghsl_colors.txt through a lookup table, and encoded to WebP in a process
+pool. Fully transparent tiles are skipped before encoding, and tiles stream
+into the PMTiles writer in tile-id order — no tile directory is written.
+
+Usage:
+    python3 ghsl_tiler.py <cog.tif> <colors.txt> <output.pmtiles> [--zoom 0-13] [--workers N]
+
+    # One SLURM longitude strip → shard, combined later by `pack_mbtiles.py merge`
+    python3 ghsl_tiler.py cog.tif ghsl_colors.txt z13_07.pmtiles --zoom 13 --lon-range=-22.5,0
+
+Like the split gdal2tiles runs, zooms below --near-from (default 13) use
+average resampling and zooms from it up use nearest.
+
+With --pyramid, only the deepest zoom is read from the COG; every tile above
+it is the average of its 4 children, computed on raw values before coloring
+and streamed level by level, so each source pixel is read once for the whole
+pyramid instead of once per zoom. With --lon-range, the zoom range must start
+at or above the strip's alignment zoom (4 for 16 strips): a parent tile across
+the strip edge would be averaged from this strip's children only.
+"""
+
+import argparse
+import csv
+import io
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+import numpy as np
+from PIL import Image
+
+try:
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.errors import WindowError
+    from rasterio.windows import Window, from_bounds
+except ImportError:
+    print("Error: rasterio not installed. Install with: pip install rasterio")
+    sys.exit(1)
+
+from pack_mbtiles import (
+    COMPRESSION_NONE,
+    TILE_TYPES,
+    BuildCache,
+    PMTilesWriter,
+    bounded_map,
+    merge_pmtiles,
+    tile_bounds,
+    tile_digest,
+    zxy_to_tileid,
+)
+
+TILE_SIZE = 256
+ORIGIN = 20037508.342789244  # half the EPSG:3857 world width, in metres
+PROGRESS_SECONDS = 30
+
+
+def load_color_ramp(path: str):
+    """Parse a gdaldem color file of `value R G B A` lines.
+
+    Returns the RGBA of the `nv` (nodata) entry, or None, and the sorted
+    (value, RGBA) stops.
+    """
+    nodata_rgba, stops = None, []
+    with open(path) as fh:
+        for line in fh:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            if len(parts) != 5:
+                raise ValueError(
+                    f"{path}: expected 5 columns 'value R G B A', got {line.strip()!r} "
+                    "(4 columns would be read as RGB by gdaldem)"
+                )
+            rgba = [int(v) for v in parts[1:]]
+            if parts[0].lower() == "nv":
+                nodata_rgba = rgba
+            else:
+                stops.append((float(parts[0]), rgba))
+    if not stops:
+        raise ValueError(f"{path}: no color stops")
+    stops.sort()
+    return nodata_rgba, stops
+
+
+def build_lut(stops, nodata_rgba, nodata, size: int) -> np.ndarray:
+    """RGBA lookup table for integer values 0..size-1, matching gdaldem color-relief.
+
+    Values between stops are linearly interpolated, values outside the stops
+    take the nearest end color, and nodata maps to the `nv` color
+    (transparent when the file has none).
+    """
+    values = np.arange(size)
+    xs = [value for value, _ in stops]
+    lut = np.empty((size, 4), dtype=np.uint8)
+    for channel in range(4):
+        lut[:, channel] = np.rint(np.interp(values, xs, [rgba[channel] for _, rgba in stops]))
+    if nodata is not None and 0 <= nodata < size:
+        lut[int(nodata)] = nodata_rgba or (0, 0, 0, 0)
+    return lut
+
+
+def tile_range(z: int, bounds, lon_range=None):
+    """Inclusive (min_x, min_y, max_x, max_y) of the zoom-z tiles covering EPSG:3857 bounds."""
+    n = 1 << z
+    span = 2 * ORIGIN / n
+    west, south, east, north = (max(-ORIGIN, min(ORIGIN, v)) for v in bounds)
+    min_x = math.floor((west + ORIGIN) / span)
+    max_x = math.ceil((east + ORIGIN) / span) - 1
+    min_y = math.floor((ORIGIN - north) / span)
+    max_y = math.ceil((ORIGIN - south) / span) - 1
+    if lon_range:
+        min_x = max(min_x, math.floor((lon_range[0] + 180) / 360 * n))
+        max_x = min(max_x, math.ceil((lon_range[1] + 180) / 360 * n) - 1)
+    return max(min_x, 0), max(min_y, 0), min(max_x, n - 1), min(max_y, n - 1)
+
+
+def strip_zoom(lon_range) -> int:
+    """Lowest zoom whose tile edges fall on both ends of lon_range (0 without one).
+
+    Below it the strip's edge tiles straddle the neighbouring strips.
+    """
+    if not lon_range:
+        return 0
+    for z in range(31):
+        edges = [(lon + 180) / 360 * (1 << z) for lon in lon_range]
+        if all(abs(edge - round(edge)) < 1e-9 for edge in edges):
+            return z
+    return 31
+
+
+def metatiles(z: int, size: int, tiles):
+    """Metatiles of zoom z covering the tile range, in Hilbert order.
+
+    An aligned size×size block of tiles is a contiguous run of tile ids, so
+    visiting blocks in the Hilbert order of their own zoom level and sorting
+    the tiles inside each block keeps the whole stream in tile-id order.
+    """
+    size = min(size, 1 << z)
+    block_zoom = z - int(math.log2(size))
+    min_x, min_y, max_x, max_y = tiles
+    blocks = sorted(
+        (zxy_to_tileid(block_zoom, mx, my), mx, my)
+        for mx in range(min_x // size, max_x // size + 1)
+        for my in range(min_y // size, max_y // size + 1)
+    )
+    return [(z, mx, my, size, tiles) for _, mx, my in blocks]
+
+
+METADATA = {"name": "ghsl", "format": "webp", "type": "overlay", "version": "1.0"}
+
+
+def open_source(cog: str, colors: str):
+    """Check the COG and build its color lookup table: (lut, nodata, bounds)."""
+    nodata_rgba, stops = load_color_ramp(colors)
+    with rasterio.open(cog) as src:
+        if src.crs is None or src.crs.to_epsg() != 3857:
+            print(f"Error: {cog} must be in EPSG:3857, got {src.crs}", file=sys.stderr)
+            sys.exit(1)
+        dtype = np.dtype(src.dtypes[0])
+        if not np.issubdtype(dtype, np.integer) or dtype.itemsize > 2:
+            print(f"Error: {cog} must be an 8- or 16-bit integer raster", file=sys.stderr)
+            sys.exit(1)
+        lut = build_lut(stops, nodata_rgba, src.nodata, 1 << (8 * dtype.itemsize))
+        return lut, src.nodata, src.bounds
+
+
+_worker = {}
+
+
+def _init_worker(
+    cog: str, lut: np.ndarray, near_from: int, quality: int, min_coverage: float, ranges=None
+) -> None:
+    # One dataset handle per process, reused for every metatile
+    src = rasterio.open(cog)
+    _worker.update(
+        src=src,
+        lut=lut,
+        nodata=src.nodata,
+        near_from=near_from,
+        quality=quality,
+        min_coverage=min_coverage,
+        ranges=ranges,
+    )
+
+
+def read_metatile(z: int, mx: int, my: int, size: int):
+    """Read the source values of a metatile at zoom-z resolution.
+
+    Returns (values, (y0, y1, x0, x1)), the part of the metatile covered by
+    the dataset, or None when the metatile lies outside it.
+    """
+    src = _worker["src"]
+    span = 2 * ORIGIN / (1 << z) * size
+    west, north = -ORIGIN + mx * span, ORIGIN - my * span
+    window = from_bounds(west, north - span, west + span, north, transform=src.transform)
+    try:
+        clipped = window.intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        return None
+
+    pixels = size * TILE_SIZE
+    scale_x, scale_y = pixels / window.width, pixels / window.height
+    x0 = round((clipped.col_off - window.col_off) * scale_x)
+    x1 = round((clipped.col_off + clipped.width - window.col_off) * scale_x)
+    y0 = round((clipped.row_off - window.row_off) * scale_y)
+    y1 = round((clipped.row_off + clipped.height - window.row_off) * scale_y)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    resampling = Resampling.nearest if z >= _worker["near_from"] else Resampling.average
+    values = src.read(1, window=clipped, out_shape=(y1 - y0, x1 - x0), resampling=resampling)
+    return values, (y0, y1, x0, x1)
+
+
+def raw_sums(values: np.ndarray, box, pixels: int, nodata):
+    """(total, count) of a metatile: raw value sum and number of data pixels behind each pixel."""
+    y0, y1, x0, x1 = box
+    count = np.zeros((pixels, pixels), dtype=np.uint32)
+    count[y0:y1, x0:x1] = 1 if nodata is None else values != nodata
+    total = np.zeros((pixels, pixels), dtype=np.float64)
+    total[y0:y1, x0:x1] = values
+    total[count == 0] = 0
+    return total, count
+
+
+def encode_tiles(
+    z: int,
+    mx: int,
+    my: int,
+    size: int,
+    rgba: np.ndarray,
+    total: np.ndarray,
+    count: np.ndarray,
+    tiles,
+    quality: int,
+    min_coverage: float,
+):
+    """Classify and WebP-encode the tiles of a size×size metatile that fall in the tile range.
+
+    A tile's coverage is the fraction of its pixels with a non-zero alpha.
+    Fully transparent tiles, and tiles whose coverage is below min_coverage,
+    are dropped before encoding. Kept tiles also get the mean raw value of
+    their data pixels, from the total and count arrays of raw_sums().
+
+    Returns ([(tile_id, z, x, y, webp, digest, coverage, mean)] in tile-id
+    order, number of non-transparent tiles dropped).
+    """
+    min_x, min_y, max_x, max_y = tiles
+    encoded, dropped = [], 0
+    for ty in range(size):
+        y = my * size + ty
+        if not min_y <= y <= max_y:
+            continue
+        rows = slice(ty * TILE_SIZE, (ty + 1) * TILE_SIZE)
+        for tx in range(size):
+            x = mx * size + tx
+            if not min_x <= x <= max_x:
+                continue
+            cols = slice(tx * TILE_SIZE, (tx + 1) * TILE_SIZE)
+            tile = rgba[rows, cols]
+            coverage = np.count_nonzero(tile[:, :, 3]) / (TILE_SIZE * TILE_SIZE)
+            if coverage == 0:
+                continue  # fully transparent: never encoded, never stored
+            if coverage < min_coverage:
+                dropped += 1
+                continue
+            pixels = int(count[rows, cols].sum())
+            mean = float(total[rows, cols].sum()) / pixels if pixels else None
+            buf = io.BytesIO()
+            Image.fromarray(np.ascontiguousarray(tile)).save(buf, "WEBP", quality=quality)
+            data = buf.getvalue()
+            encoded.append((zxy_to_tileid(z, x, y), z, x, y, data, tile_digest(data), coverage, mean))
+    encoded.sort(key=itemgetter(0))
+    return encoded, dropped
+
+
+def render_metatile(task):
+    """Render one metatile; returns encode_tiles() output."""
+    z, mx, my, size, tiles = task
+    lut = _worker["lut"]
+    read = read_metatile(z, mx, my, size)
+    if read is None:
+        return [], 0
+    values, box = read
+    if not lut[values, 3].any():
+        return [], 0
+    # Pixels outside the dataset stay transparent
+    y0, y1, x0, x1 = box
+    pixels = size * TILE_SIZE
+    rgba = np.zeros((pixels, pixels, 4), dtype=np.uint8)
+    rgba[y0:y1, x0:x1] = lut[values]
+    total, count = raw_sums(values, box, pixels, _worker["nodata"])
+    return encode_tiles(
+        z, mx, my, size, rgba, total, count, tiles, _worker["quality"], _worker["min_coverage"]
+    )
+
+
+def halve(a: np.ndarray) -> np.ndarray:
+    """Sum 2×2 pixel blocks: the same area one zoom level up."""
+    h, w = a.shape
+    return a.reshape(h // 2, 2, w // 2, 2).sum(axis=(1, 3), dtype=a.dtype)
+
+
+def colorize(total: np.ndarray, count: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """RGBA of the mean raw value per pixel; pixels without data are transparent."""
+    mean = np.rint(total / np.maximum(count, 1)).astype(np.intp)
+    rgba = lut[mean]
+    rgba[count == 0] = 0
+    return rgba
+
+
+def render_block(task):
+    """Render a max-zoom metatile and the pyramid above it, up to its single root tile.
+
+    Each level is the 2×2 average of the raw values below it, not of colors.
+    Returns the tiles of the requested zooms (deepest level first), the
+    number of tiles dropped as near-empty, and (z, x, y, total, count) of
+    the root tile — None when the block has no data.
+    """
+    z, mx, my, size = task
+    ranges = _worker["ranges"]
+    read = read_metatile(z, mx, my, size)
+    if read is None:
+        return [], 0, None
+    values, box = read
+    total, count = raw_sums(values, box, size * TILE_SIZE, _worker["nodata"])
+    # Only the requested max-zoom tiles feed the levels above
+    min_x, min_y, max_x, max_y = ranges[z]
+    outside = np.ones(count.shape, dtype=bool)
+    rows = slice(max(0, min_y - my * size) * TILE_SIZE, max(0, max_y + 1 - my * size) * TILE_SIZE)
+    cols = slice(max(0, min_x - mx * size) * TILE_SIZE, max(0, max_x + 1 - mx * size) * TILE_SIZE)
+    outside[rows, cols] = False
+    total[outside] = 0
+    count[outside] = 0
+    if not count.any():
+        return [], 0, None
+
+    tiles, dropped = [], 0
+    while True:
+        if z in ranges:
+            rgba = colorize(total, count, _worker["lut"])
+            encoded, skipped = encode_tiles(
+                z, mx, my, size, rgba, total, count, ranges[z],
+                _worker["quality"], _worker["min_coverage"],
+            )
+            tiles.extend(encoded)
+            dropped += skipped
+        if size == 1:
+            return tiles, dropped, (z, mx, my, total, count)
+        total, count, z, size = halve(total), halve(count), z - 1, size // 2
+
+
+class ParentLevels:
+    """Average finished tiles into their parents while the tiles stream by.
+
+    Blocks arrive in Hilbert order, so the four children of a parent arrive
+    one after another: each zoom level only holds the parent being filled,
+    which is finished (emitted, then averaged into its own parent) as soon
+    as a tile of another parent shows up.
+    """
+
+    def __init__(self, min_zoom: int, emit):
+        self.min_zoom = min_zoom
+        self.emit = emit  # emit(z, x, y, total, count) for every finished parent
+        self.pending = {}  # zoom → (x, y, total, count) of the parent being filled
+
+    def add(self, z: int, x: int, y: int, total: np.ndarray, count: np.ndarray) -> None:
+        if z <= self.min_zoom:
+            return
+        parent = self.pending.get(z - 1)
+        if parent and parent[:2] != (x >> 1, y >> 1):
+            self._finish(z - 1)
+            parent = None
+        if parent is None:
+            shape = (2 * TILE_SIZE, 2 * TILE_SIZE)
+            parent = self.pending[z - 1] = (
+                x >> 1, y >> 1, np.zeros(shape, dtype=np.float64), np.zeros(shape, dtype=np.uint32)
+            )
+        oy, ox = (y & 1) * TILE_SIZE, (x & 1) * TILE_SIZE
+        parent[2][oy : oy + TILE_SIZE, ox : ox + TILE_SIZE] = total
+        parent[3][oy : oy + TILE_SIZE, ox : ox + TILE_SIZE] = count
+
+    def _finish(self, z: int) -> None:
+        x, y, total, count = self.pending.pop(z)
+        total, count = halve(total), halve(count)
+        self.emit(z, x, y, total, count)
+        self.add(z, x, y, total, count)
+
+    def close(self) -> None:
+        # Deepest first: finishing a level completes the last parent of the one above
+        while self.pending:
+            self._finish(max(self.pending))
+
+
+class LevelArchives:
+    """One temporary PMTiles archive per zoom level, merged into one archive at the end.
+
+    A bottom-up pyramid completes the deepest level first, while PMTiles
+    stores tiles in tile-id order, i.e. top level first.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.levels = {}  # zoom → [file, PMTilesWriter, [min_x, min_y, max_x, max_y]]
+
+    @property
+    def tiles(self) -> int:
+        return sum(writer.tiles for _, writer, _ in self.levels.values())
+
+    def add(self, tile_id: int, z: int, x: int, y: int, data: bytes, digest: str) -> None:
+        level = self.levels.get(z)
+        if level is None:
+            out = open(os.path.join(self.directory, f"z{z:02d}.pmtiles"), "wb")
+            level = self.levels[z] = [out, PMTilesWriter(out), [x, y, x, y]]
+        extent = level[2]
+        level[2] = [min(extent[0], x), min(extent[1], y), max(extent[2], x), max(extent[3], y)]
+        level[1].add(tile_id, data, digest)
+
+    def merge(self, output: str) -> None:
+        paths = []
+        for z in sorted(self.levels):
+            out, writer, extent = self.levels[z]
+            writer.finish(
+                METADATA, TILE_TYPES[".webp"], COMPRESSION_NONE, z, z, tile_bounds(z, *extent)
+            )
+            out.close()
+            paths.append(out.name)
+        merge_pmtiles(output, paths)
+
+
+class TileIndex:
+    """Side index of per-tile statistics: one CSV row per stored tile.
+
+    coverage is the fraction of visible pixels, mean the mean raw value of
+    the data pixels (the built-up percentage for GHSL).
+    """
+
+    FIELDS = ("z", "x", "y", "coverage", "mean")
+
+    def __init__(self, path: str):
+        self.fh = open(path, "w", newline="")
+        self.writer = csv.writer(self.fh)
+        self.writer.writerow(self.FIELDS)
+
+    def add(self, z: int, x: int, y: int, coverage: float, mean) -> None:
+        self.writer.writerow([z, x, y, f"{coverage:.4f}", "" if mean is None else f"{mean:.2f}"])
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+def report_dropped(dropped: int, min_coverage: float) -> None:
+    if dropped:
+        print(f"Dropped {dropped:,} near-empty tiles (coverage < {min_coverage:g})", flush=True)
+
+
+def report_metatiles(done: int, total: int, tiles: int, t_start: float) -> None:
+    rate = done / (time.time() - t_start)
+    print(
+        f"  {done:>8,} / {total:,} metatiles  ({done / total * 100:.1f}%)  "
+        f"{tiles:,} tiles  ETA {(total - done) / rate / 60:.1f}min",
+        flush=True,
+    )
+
+
+def render(
+    cog: str,
+    colors: str,
+    output: str,
+    zooms: range,
+    lon_range=None,
+    near_from: int = 13,
+    workers: int | None = None,
+    quality: int = 85,
+    metatile: int = 8,
+    min_coverage: float = 0.0,
+    stats: str | None = None,
+) -> None:
+    """Render every zoom level independently from the COG (and its overviews)."""
+    workers = workers or os.cpu_count()
+    lut, _, bounds = open_source(cog, colors)
+    tasks = [
+        task for z in zooms for task in metatiles(z, metatile, tile_range(z, bounds, lon_range))
+    ]
+    print(
+        f"Rendering zoom {zooms.start}-{zooms.stop - 1} of {cog}: {len(tasks):,} metatiles "
+        f"with {workers} workers",
+        flush=True,
+    )
+
+    min_zoom = max_zoom = None
+    extent = None  # [min_x, min_y, max_x, max_y] at max_zoom
+    dropped = 0
+    index = TileIndex(stats) if stats else None
+    t_start = t_report = time.time()
+    with open(output, "wb") as out, ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(cog, lut, near_from, quality, min_coverage)
+    ) as pool:
+        writer = PMTilesWriter(out)
+        for done, (tiles, skipped) in enumerate(
+            bounded_map(pool, render_metatile, tasks, 4 * workers), 1
+        ):
+            dropped += skipped
+            for tile_id, z, x, y, data, digest, coverage, mean in tiles:
+                if min_zoom is None:
+                    min_zoom = z
+                if z != max_zoom:
+                    max_zoom, extent = z, [x, y, x, y]
+                else:
+                    extent = [min(extent[0], x), min(extent[1], y), max(extent[2], x), max(extent[3], y)]
+                writer.add(tile_id, data, digest)
+                if index:
+                    index.add(z, x, y, coverage, mean)
+            if time.time() - t_report > PROGRESS_SECONDS:
+                t_report = time.time()
+                report_metatiles(done, len(tasks), writer.tiles, t_start)
+        if min_zoom is None:
+            print("Error: every tile is transparent — check the color ramp and zooms", file=sys.stderr)
+            sys.exit(1)
+        writer.finish(
+            METADATA,
+            TILE_TYPES[".webp"],
+            COMPRESSION_NONE,
+            min_zoom,
+            max_zoom,
+            tile_bounds(max_zoom, *extent),
+        )
+    if index:
+        index.close()
+
+    elapsed = time.time() - t_start
+    report_dropped(dropped, min_coverage)
+    print(
+        f"Done: {writer.tiles:,} tiles ({len(writer.blobs):,} unique) → {output}  "
+        f"({elapsed/60:.1f} min)",
+        flush=True,
+    )
+
+
+def render_pyramid(
+    cog: str,
+    colors: str,
+    output: str,
+    zooms: range,
+    lon_range=None,
+    near_from: int = 13,
+    workers: int | None = None,
+    quality: int = 85,
+    metatile: int = 8,
+    min_coverage: float = 0.0,
+    stats: str | None = None,
+) -> None:
+    """Render the deepest zoom from the COG and average every level above it from its children.
+
+    Each source pixel is read once for the whole pyramid. Workers render a
+    max-zoom metatile and the levels above it up to the metatile's root tile;
+    the main process averages those roots into the remaining upper levels.
+    """
+    workers = workers or os.cpu_count()
+    lut, _, bounds = open_source(cog, colors)
+    ranges = {z: tile_range(z, bounds, lon_range) for z in zooms}
+    max_zoom = zooms.stop - 1
+    tasks = [task[:4] for task in metatiles(max_zoom, metatile, ranges[max_zoom])]
+    print(
+        f"Rendering zoom {max_zoom} of {cog} and averaging zoom {zooms.start}-{max_zoom - 1} "
+        f"from it: {len(tasks):,} metatiles with {workers} workers",
+        flush=True,
+    )
+
+    dropped = 0
+    index = TileIndex(stats) if stats else None
+    t_start = t_report = time.time()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp:
+        levels = LevelArchives(tmp)
+
+        def store(tiles):
+            for tile_id, z, x, y, data, digest, coverage, mean in tiles:
+                levels.add(tile_id, z, x, y, data, digest)
+                if index:
+                    index.add(z, x, y, coverage, mean)
+
+        def emit(z, x, y, total, count):
+            nonlocal dropped
+            if z in ranges:
+                rgba = colorize(total, count, lut)
+                tiles, skipped = encode_tiles(
+                    z, x, y, 1, rgba, total, count, ranges[z], quality, min_coverage
+                )
+                store(tiles)
+                dropped += skipped
+
+        parents = ParentLevels(zooms.start, emit)
+        with ProcessPoolExecutor(
+            workers,
+            initializer=_init_worker,
+            initargs=(cog, lut, near_from, quality, min_coverage, ranges),
+        ) as pool:
+            for done, (tiles, skipped, root) in enumerate(
+                bounded_map(pool, render_block, tasks, 4 * workers), 1
+            ):
+                store(tiles)
+                dropped += skipped
+                if root is not None:
+                    parents.add(*root)
+                if time.time() - t_report > PROGRESS_SECONDS:
+                    t_report = time.time()
+                    report_metatiles(done, len(tasks), levels.tiles, t_start)
+        parents.close()
+        if index:
+            index.close()
+        if not levels.levels:
+            print("Error: every tile is transparent — check the color ramp and zooms", file=sys.stderr)
+            sys.exit(1)
+        report_dropped(dropped, min_coverage)
+        print(f"Rendered {levels.tiles:,} tiles in {(time.time() - t_start)/60:.1f} min", flush=True)
+        levels.merge(output)
+
+
+def _parse_zooms(text: str) -> range:
+    low, _, high = text.partition("-")
+    return range(int(low), int(high or low) + 1)
+
+
+def _parse_lon_range(text: str):
+    west, east = (float(v) for v in text.split(","))
+    return west, east
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render a single-band EPSG:3857 COG into a WebP PMTiles archive"
+    )
+    parser.add_argument("input", help="Source COG (EPSG:3857, 8/16-bit integer)")
+    parser.add_argument("colors", help="gdaldem color file with 5 columns: value R G B A")
+    parser.add_argument("output", help="Output .pmtiles file")
+    parser.add_argument("--zoom", type=_parse_zooms, default="0-13", help="Zoom range (default: 0-13)")
+    parser.add_argument(
+        "--lon-range",
+        type=_parse_lon_range,
+        help="Only tiles within WEST,EAST degrees (a SLURM strip; exact at zoom ≥ 4 for 16 strips); "
+        "write --lon-range=W,E when W is negative",
+    )
+    parser.add_argument(
+        "--near-from",
+        type=int,
+        default=13,
+        help="Nearest resampling from this zoom up, average below (default: 13)",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="Read the source once at the deepest zoom and average each parent tile "
+        "from its 4 children (raw values, before coloring)",
+    )
+    parser.add_argument(
+        "--min-coverage",
+        type=float,
+        default=0.0,
+        help="Drop tiles with a smaller fraction of visible pixels (default: 0, only fully "
+        "transparent tiles are dropped)",
+    )
+    parser.add_argument(
+        "--stats", help="Write per-tile statistics (z,x,y,coverage,mean) of stored tiles to this CSV"
+    )
+    parser.add_argument("--workers", type=int, help="Render processes (default: all CPUs)")
+    parser.add_argument("--quality", type=int, default=85, help="WebP quality (default: 85)")
+    parser.add_argument(
+        "--metatile", type=int, default=8, help="Tiles per metatile side, a power of 2 (default: 8)"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Render even if the output is up to date"
+    )
+    args = parser.parse_args()
+    if not args.output.endswith(".pmtiles"):
+        parser.error("output must be a .pmtiles file")
+    if args.metatile < 1 or args.metatile & (args.metatile - 1):
+        parser.error("--metatile must be a power of 2")
+    if args.pyramid and args.zoom.start < strip_zoom(args.lon_range):
+        # Each strip would write its own half-empty copy of the edge parents
+        parser.error(
+            f"--pyramid with --lon-range={args.lon_range[0]:g},{args.lon_range[1]:g} needs "
+            f"--zoom to start at {strip_zoom(args.lon_range)} or above, where tiles no "
+            "longer straddle the strip edges; render the zooms below it without --lon-range"
+        )
+
+    cache = BuildCache() if BuildCache else None
+    params = {
+        "zoom": [args.zoom.start, args.zoom.stop - 1],
+        "lon_range": args.lon_range,
+        "near_from": args.near_from,
+        "quality": args.quality,
+        "metatile": args.metatile,
+        "pyramid": args.pyramid,
+        "min_coverage": args.min_coverage,
+        "stats": args.stats,
+    }
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    scripts = [__file__, os.path.join(script_dir, "pack_mbtiles.py")]
+    key = cache.key(scripts, [args.input, args.colors], params) if cache else None
+    # The side index is only rewritten with the archive, so a missing one forces a render
+    stats_ok = not args.stats or os.path.exists(args.stats)
+    if cache and stats_ok and cache.check(args.output, key, force=args.force):
+        sys.exit(0)
+    (render_pyramid if args.pyramid else render)(
+        args.input,
+        args.colors,
+        args.output,
+        args.zoom,
+        lon_range=args.lon_range,
+        near_from=args.near_from,
+        workers=args.workers,
+        quality=args.quality,
+        metatile=args.metatile,
+        min_coverage=args.min_coverage,
+        stats=args.stats,
+    )
+    if cache:
+        cache.record(args.output, key)
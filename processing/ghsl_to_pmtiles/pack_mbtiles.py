@@ -1,23 +1,92 @@
 #!/usr/bin/env python3
 """
-Pack an XYZ tile directory into an MBTiles SQLite file.
+Pack an XYZ tile directory into an MBTiles SQLite file or a PMTiles v3 archive.
 
 Usage:
-    python3 pack_mbtiles.py <tiles_dir> <output.mbtiles> [num_readers]
+    python3 pack_mbtiles.py <tiles_dir> <output.mbtiles> [num_readers] [--dedupe] [--resume] [--force]
+    python3 pack_mbtiles.py <tiles_dir> <output.pmtiles> [num_readers] [--force]
+    python3 pack_mbtiles.py merge <output> <shard> [<shard> ...] [--force]
 
-MBTiles uses TMS y-ordering (y=0 at bottom), opposite of XYZ (y=0 at top).
-This script applies the y-flip automatically.
+The format follows the output extension (or --format). MBTiles uses TMS
+y-ordering (y=0 at bottom), opposite of XYZ (y=0 at top); this script applies
+the y-flip automatically. With --dedupe the MBTiles file uses the
+deduplicated layout (`map` + `images` tables behind a `tiles` view), storing
+each distinct tile payload once.
 
-No external dependencies — uses only Python stdlib.
+MBTiles are written by a dedicated writer thread in (z, x, tms_y) order with
+journaling off, so reads never wait on SQLite; a quick_check runs at the end.
+A pack that is killed midway can leave a corrupt file — delete it and rerun,
+or pack with --resume: the build is then journaled (WAL) and every finished
+z/x column is recorded in a `pack_progress` table committed with its tiles,
+so rerunning the same command after a kill skips the finished columns and
+repacks the partially written ones.
+
+Disjoint tile directories (e.g. one per longitude strip of a SLURM array)
+can be packed into shard archives on their own nodes and combined with the
+merge subcommand, which k-way merges the shards' already ordered contents
+(tile id for PMTiles, z/x/y for MBTiles) in a single streaming pass.
+The number of in-flight reads starts at num_readers and is tuned from the
+observed throughput.
+
+PMTiles are written in a single pass: tiles are read in Hilbert-curve order,
+identical tiles (ocean, desert, ...) are stored once, and a clustered
+root/leaf directory is written at the end. No `pmtiles convert` step or
+intermediate .mbtiles file is needed.
+
+No external dependencies — uses only Python stdlib. When ../build_cache.py
+is importable (i.e. run from the repo), an unchanged tile directory is not
+repacked; --force always repacks.
 """
 
+import argparse
+import gzip
+import hashlib
+import heapq
+import json
+import math
 import os
+import queue
+import random
 import sqlite3
+import struct
 import sys
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    from build_cache import BuildCache
+except ImportError:  # copied on its own, e.g. to $WORK on the cluster
+    BuildCache = None
 
 BATCH_SIZE = 50_000
+CHECKPOINT_TILES = 1_000_000  # commit the long MBTiles transaction this often
+WRITER_QUEUE_BATCHES = 4  # batches buffered between the readers and the writer
+ESTIMATE_SAMPLE = 32  # columns listed per zoom level to estimate the tile count
+
+# PMTiles v3 layout (https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md)
+PMTILES_HEADER = struct.Struct("<7sB11Q6B4iB2i")  # 127 bytes
+PMTILES_FIELDS = (
+    "magic", "version",
+    "root_offset", "root_length", "metadata_offset", "metadata_length",
+    "leaf_offset", "leaf_length", "data_offset", "data_length",
+    "addressed_tiles", "tile_entries", "tile_contents",
+    "clustered", "internal_compression", "tile_compression", "tile_type",
+    "min_zoom", "max_zoom",
+    "min_lon_e7", "min_lat_e7", "max_lon_e7", "max_lat_e7",
+    "center_zoom", "center_lon_e7", "center_lat_e7",
+)  # fmt: skip
+PMTILES_ROOT_LIMIT = 16_384  # header + root directory must fit in the first 16 KiB
+COMPRESSION_NONE, COMPRESSION_GZIP = 1, 2
+TILE_TYPES = {".pbf": 1, ".mvt": 1, ".png": 2, ".jpg": 3, ".jpeg": 3, ".webp": 4, ".avif": 5}
+
+
+def tile_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 def read_tile(args):
@@ -28,88 +97,890 @@ def read_tile(args):
     return (z, x, y_tms, data)
 
 
-def collect_tasks(tiles_dir):
-    tasks = []
-    for z_str in sorted((d for d in os.listdir(tiles_dir) if d.isdigit()), key=int):
-        z = int(z_str)
-        z_dir = os.path.join(tiles_dir, z_str)
-        if not os.path.isdir(z_dir):
-            continue
-        for x_str in os.listdir(z_dir):
-            x_dir = os.path.join(z_dir, x_str)
-            if not os.path.isdir(x_dir):
-                continue
-            x = int(x_str)
-            for fname in os.listdir(x_dir):
-                y_str = fname.split(".")[0]
-                if y_str.isdigit():
-                    tasks.append((os.path.join(x_dir, fname), z, x, int(y_str)))
-    return tasks
-
-
-def pack(tiles_dir: str, output: str, num_readers: int = 16) -> None:
+def read_tile_hashed(args):
+    # Hashing in the reader threads keeps it off the writer (hashlib releases the GIL)
+    z, x, y_tms, data = read_tile(args)
+    return (z, x, y_tms, data, tile_digest(data))
+
+
+def _numbered_entries(path, dirs):
+    """Sorted (number, path) of the entries named <number> or <number>.<ext>."""
+    found = []
+    with os.scandir(path) as it:
+        for entry in it:
+            stem = entry.name.split(".")[0]
+            if stem.isdigit() and entry.is_dir() == dirs:
+                found.append((int(stem), entry.path))
+    found.sort()
+    return found
+
+
+def list_columns(tiles_dir):
+    """(z, x, x_dir) of every tile column, by zoom then x."""
+    return [
+        (z, x, x_dir)
+        for z, z_dir in _numbered_entries(tiles_dir, dirs=True)
+        for x, x_dir in _numbered_entries(z_dir, dirs=True)
+    ]
+
+
+def tree_fingerprint(tiles_dir) -> str:
+    """Fingerprint of a z/x/y tree from its column directories' mtimes, not its tiles.
+
+    Adding, removing or renaming a tile updates its column's mtime, so this
+    follows a re-render while stat'ing only the ~10^4 column directories
+    instead of millions of tiles. A tile rewritten in place under the same
+    name is not seen: repack with --force.
+    """
+    entries = hashlib.sha256()
+    for z, x, x_dir in list_columns(tiles_dir):
+        stat = os.stat(x_dir)
+        entries.update(f"{z}/{x}\0{stat.st_mtime_ns}\n".encode())
+    return entries.hexdigest()
+
+
+def list_column(column):
+    z, x, x_dir = column
+    return [(path, z, x, y) for y, path in _numbered_entries(x_dir, dirs=False)]
+
+
+def bounded_map(pool, fn, items, window):
+    """Ordered pool.map that keeps at most `window` calls in flight.
+
+    Unlike Executor.map it does not submit the whole iterable upfront, so
+    items can be a lazy stream and results are consumed as they arrive.
+    window may be a callable, re-evaluated as calls complete.
+    """
+    limit = window if callable(window) else lambda: window
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        while len(pending) >= limit():
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_tiles(columns, pool, window, tms=False):
+    """Stream (path, z, x, y) in column order while later columns are still being listed.
+
+    With tms=True each column is yielded bottom-up, i.e. by ascending TMS row.
+    """
+    for tiles in bounded_map(pool, list_column, columns, window):
+        yield from reversed(tiles) if tms else tiles
+
+
+class ReadTuner:
+    """Hill-climb the number of in-flight reads on the tiles/s of each batch.
+
+    Keeps moving in the same direction while throughput improves and turns
+    around when it drops, so it settles near the storage's sweet spot.
+    """
+
+    def __init__(self, start: int, high: int):
+        self.low, self.high = max(1, start // 4), high
+        self.readers = start
+        self.direction = 1
+        self.last_rate = None
+        self.t_last = time.time()
+
+    def __call__(self) -> int:
+        return self.readers
+
+    def update(self, tiles: int) -> None:
+        now = time.time()
+        rate = tiles / max(now - self.t_last, 1e-9)
+        self.t_last = now
+        if self.last_rate is not None and rate < self.last_rate:
+            self.direction = -self.direction
+        self.last_rate = rate
+        step = max(1, self.readers // 4)
+        self.readers = min(self.high, max(self.low, self.readers + self.direction * step))
+
+
+def estimate_tiles(columns, pool):
+    """Estimate the tile count from a random sample of columns per zoom level."""
+    by_zoom = {}
+    for column in columns:
+        by_zoom.setdefault(column[0], []).append(column)
+    rng = random.Random(0)
+    samples = {
+        z: rng.sample(cols, min(len(cols), ESTIMATE_SAMPLE)) for z, cols in by_zoom.items()
+    }
+    counts = pool.map(lambda column: len(list_column(column)), sum(samples.values(), []))
+    total = 0
+    for z, sample in samples.items():
+        listed = sum(next(counts) for _ in sample)
+        total += listed / len(sample) * len(by_zoom[z])
+    return round(total)
+
+
+def scan(tiles_dir, pool, num_readers, done=frozenset()):
+    """List the tile columns of tiles_dir and print a sampled estimate of the tile count.
+
+    Columns whose (z, x) is in done are left out.
+    """
     print(f"Scanning tile directory: {tiles_dir}", flush=True)
     t0 = time.time()
-    tasks = collect_tasks(tiles_dir)
-    total_tiles = len(tasks)
-    print(f"Found {total_tiles:,} tiles in {time.time()-t0:.1f}s — starting pack with {num_readers} readers", flush=True)
+    columns = list_columns(tiles_dir)
+    if not columns:
+        print(f"Error: no tiles found in {tiles_dir}", file=sys.stderr)
+        sys.exit(1)
+    if done:
+        total_columns = len(columns)
+        columns = [column for column in columns if column[:2] not in done]
+        print(
+            f"Resuming: {total_columns - len(columns):,} of {total_columns:,} columns already packed",
+            flush=True,
+        )
+    estimate = estimate_tiles(columns, pool)
+    print(
+        f"Found {len(columns):,} tile columns, ~{estimate:,} tiles in {time.time()-t0:.1f}s"
+        f" — starting pack with {num_readers} readers",
+        flush=True,
+    )
+    return columns, estimate
+
+
+def read_hilbert_tile(item):
+    tile_id, path, z, x, y = item
+    with open(path, "rb") as fh:
+        data = fh.read()
+    return tile_id, path, z, x, y, data, tile_digest(data)
+
+
+def report_progress(written, estimate, t_start, readers=None):
+    # The total is a sampled estimate; never let it fall below what is already done
+    total_tiles = max(estimate, written)
+    rate = written / (time.time() - t_start)
+    pct = written / total_tiles * 100
+    eta = (total_tiles - written) / rate if rate > 0 else 0
+    print(
+        f"  {written:>8,} / ~{total_tiles:,} tiles  ({pct:.1f}%)  "
+        f"{rate:.0f} tiles/s  " + (f"{readers} readers  " if readers else "") + f"ETA {eta/60:.1f}min",
+        flush=True,
+    )
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    """PMTiles tile id: tiles of all lower zooms, then the Hilbert index of (x, y)."""
+    acc = ((1 << (2 * z)) - 1) // 3
+    n = 1 << z
+    s = n >> 1
+    while s:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        acc += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x, y = n - 1 - x, n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return acc
+
+
+def _write_varint(buf: bytearray, n: int) -> None:
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def serialize_directory(entries) -> bytes:
+    """Encode [tile_id, offset, length, run_length] entries as a gzipped PMTiles directory."""
+    buf = bytearray()
+    _write_varint(buf, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        _write_varint(buf, tile_id - last_id)
+        last_id = tile_id
+    for entry in entries:
+        _write_varint(buf, entry[3])
+    for entry in entries:
+        _write_varint(buf, entry[2])
+    next_offset = None
+    for _, offset, length, _ in entries:
+        # 0 means "directly after the previous entry", which clustered data mostly is
+        _write_varint(buf, 0 if offset == next_offset else offset + 1)
+        next_offset = offset + length
+    return gzip.compress(bytes(buf), mtime=0)
+
+
+def build_directories(entries):
+    """Return (root, leaves): a single root directory, or a root pointing at leaf directories."""
+    root = serialize_directory(entries)
+    if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_LIMIT:
+        return root, b""
+    leaf_size = max(4096, len(entries) // 3500)
+    while True:
+        root_entries, leaves = [], bytearray()
+        for i in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[i : i + leaf_size])
+            root_entries.append([entries[i][0], len(leaves), len(leaf), 0])
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_LIMIT:
+            return root, bytes(leaves)
+        leaf_size = int(leaf_size * 1.2)
+
+
+def tile_bounds(z, min_x, min_y, max_x, max_y):
+    """(west, south, east, north) in degrees of an XYZ tile range."""
+    n = 1 << z
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (min_x / n * 360 - 180, lat(max_y + 1), (max_x + 1) / n * 360 - 180, lat(min_y))
+
+
+def hilbert_order(tiles):
+    """Re-sort a zoom-ascending (path, z, x, y) stream by PMTiles tile id.
+
+    Tile ids of a zoom level all sort before those of the next one, so only
+    one level at a time needs to be held and sorted.
+    """
+    for _, level in groupby(tiles, key=itemgetter(1)):
+        yield from sorted((zxy_to_tileid(z, x, y), path, z, x, y) for path, z, x, y in level)
+
+
+class PMTilesWriter:
+    """Append tiles in tile-id order to a clustered, deduplicated PMTiles v3 file.
+
+    Tile data goes right after the 16 KiB reserved for the header and root
+    directory; finish() appends metadata and leaf directories, then fills in
+    the reserved area.
+
+    Every directory entry and the digest of every distinct tile stay in
+    memory until finish(): about 375 bytes per tile when tiles are unique,
+    so up to ~2 GB for the ~5.4M-tile GHSL tree (less with runs of identical
+    tiles). Size the job's memory for it: a strip shard job needs its strip's
+    share, the final `merge` (same writer) the whole archive's.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.entries = []  # [tile_id, offset, length, run_length], offsets relative to tile data
+        self.blobs = {}  # digest → (offset, length) of the first copy written
+        self.data_length = 0
+        self.tiles = 0
+        out.seek(PMTILES_ROOT_LIMIT)
+
+    def add(self, tile_id: int, data: bytes, digest: str) -> bool:
+        """Append a tile; a tile id already written is ignored and returns False."""
+        last = self.entries[-1] if self.entries else None
+        if last and tile_id < last[0] + last[3]:
+            return False
+        blob = self.blobs.get(digest)
+        if blob is None:
+            self.out.write(data)
+            blob = self.blobs[digest] = (self.data_length, len(data))
+            self.data_length += len(data)
+        # Consecutive tile ids sharing a blob collapse into one run-length entry
+        if last and last[1] == blob[0] and last[0] + last[3] == tile_id:
+            last[3] += 1
+        else:
+            self.entries.append([tile_id, blob[0], blob[1], 1])
+        self.tiles += 1
+        return True
+
+    def finish(self, metadata: dict, tile_type, tile_compression, min_zoom, max_zoom, bounds):
+        root, leaves = build_directories(self.entries)
+        metadata = gzip.compress(json.dumps(metadata).encode(), mtime=0)
+        metadata_offset = PMTILES_ROOT_LIMIT + self.data_length
+        self.out.write(metadata)
+        self.out.write(leaves)
+
+        west, south, east, north = bounds
+        header = {
+            "magic": b"PMTiles",
+            "version": 3,
+            "root_offset": PMTILES_HEADER.size,
+            "root_length": len(root),
+            "metadata_offset": metadata_offset,
+            "metadata_length": len(metadata),
+            "leaf_offset": metadata_offset + len(metadata),
+            "leaf_length": len(leaves),
+            "data_offset": PMTILES_ROOT_LIMIT,
+            "data_length": self.data_length,
+            "addressed_tiles": self.tiles,
+            "tile_entries": len(self.entries),
+            "tile_contents": len(self.blobs),
+            "clustered": 1,
+            "internal_compression": COMPRESSION_GZIP,
+            "tile_compression": tile_compression,
+            "tile_type": tile_type,
+            "min_zoom": min_zoom,
+            "max_zoom": max_zoom,
+            "min_lon_e7": round(west * 1e7),
+            "min_lat_e7": round(south * 1e7),
+            "max_lon_e7": round(east * 1e7),
+            "max_lat_e7": round(north * 1e7),
+            "center_zoom": min_zoom,
+            "center_lon_e7": round((west + east) / 2 * 1e7),
+            "center_lat_e7": round((south + north) / 2 * 1e7),
+        }
+        self.out.seek(0)
+        self.out.write(PMTILES_HEADER.pack(*(header[field] for field in PMTILES_FIELDS)))
+        self.out.write(root)
+
+
+def pack_pmtiles(tiles_dir: str, output: str, num_readers: int = 16) -> None:
+    if not list_columns(tiles_dir):
+        raise SystemExit(f"No {{z}}/{{x}} tile directories in {tiles_dir}")
+    ext = None
+    min_zoom = max_zoom = None
+    extent = None  # [min_x, min_y, max_x, max_y] at max_zoom
+
+    tuner = ReadTuner(num_readers, high=4 * num_readers)
+    with open(output, "wb") as out, ThreadPoolExecutor(max_workers=tuner.high) as pool:
+        columns, estimate = scan(tiles_dir, pool, num_readers)
+        t_start = tuner.t_last = time.time()
+        writer = PMTilesWriter(out)
+        # Hilbert order keeps the archive clustered and turns runs of identical
+        # neighbouring tiles into single directory entries
+        ordered = hilbert_order(iter_tiles(columns, pool, 2 * num_readers))
+        for tile_id, path, z, x, y, data, digest in bounded_map(
+            pool, read_hilbert_tile, ordered, tuner
+        ):
+            if min_zoom is None:
+                min_zoom, ext = z, os.path.splitext(path)[1].lower()
+            if z != max_zoom:
+                max_zoom, extent = z, [x, y, x, y]
+            else:
+                extent = [min(extent[0], x), min(extent[1], y), max(extent[2], x), max(extent[3], y)]
+            writer.add(tile_id, data, digest)
+            if writer.tiles % BATCH_SIZE == 0:
+                tuner.update(BATCH_SIZE)
+                report_progress(writer.tiles, estimate, t_start, tuner.readers)
+        if not writer.tiles:
+            out.close()
+            os.remove(output)
+            raise SystemExit(f"No tiles in {tiles_dir}: nothing to pack")
+        writer.finish(
+            {"name": "ghsl", "format": ext.lstrip("."), "type": "overlay", "version": "1.0"},
+            TILE_TYPES.get(ext, 0),
+            COMPRESSION_NONE if ext in (".png", ".jpg", ".jpeg", ".webp", ".avif") else 0,
+            min_zoom,
+            max_zoom,
+            tile_bounds(max_zoom, *extent),
+        )
 
-    conn = sqlite3.connect(output)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
+    elapsed = time.time() - t_start
+    print(
+        f"Done: {writer.tiles:,} tiles ({len(writer.blobs):,} unique, "
+        f"{len(writer.entries):,} directory entries) → {output}  ({elapsed/60:.1f} min)",
+        flush=True,
+    )
+
+
+def _read_varint(buf: bytes, pos: int):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def deserialize_directory(blob: bytes):
+    """Decode a gzipped PMTiles directory into [tile_id, offset, length, run_length] entries."""
+    buf = gzip.decompress(blob)
+    count, pos = _read_varint(buf, 0)
+    entries = [[0, 0, 0, 0] for _ in range(count)]
+    tile_id = 0
+    for entry in entries:
+        delta, pos = _read_varint(buf, pos)
+        tile_id += delta
+        entry[0] = tile_id
+    for field in (3, 2):
+        for entry in entries:
+            entry[field], pos = _read_varint(buf, pos)
+    for i, entry in enumerate(entries):
+        value, pos = _read_varint(buf, pos)
+        if value == 0 and i > 0:
+            entry[1] = entries[i - 1][1] + entries[i - 1][2]
+        else:
+            entry[1] = value - 1
+    return entries
+
+
+def read_pmtiles_header(path: str) -> dict:
+    with open(path, "rb") as fh:
+        header = dict(zip(PMTILES_FIELDS, PMTILES_HEADER.unpack(fh.read(PMTILES_HEADER.size))))
+    if header["magic"] != b"PMTiles" or header["version"] != 3:
+        raise ValueError(f"{path} is not a PMTiles v3 archive")
+    if header["internal_compression"] != COMPRESSION_GZIP:
+        raise ValueError(f"{path}: only gzip-compressed directories are supported")
+    return header
+
+
+def iter_pmtiles(path: str):
+    """Yield (tile_id, data, digest) of a PMTiles v3 archive in tile-id order.
+
+    Leaf directories are read as they are reached, so memory stays flat.
+    """
+    header = read_pmtiles_header(path)
+    with open(path, "rb") as fh:
+
+        def walk(offset, length):
+            fh.seek(offset)
+            for tile_id, data_offset, data_length, run_length in deserialize_directory(fh.read(length)):
+                if run_length == 0:
+                    yield from walk(header["leaf_offset"] + data_offset, data_length)
+                    continue
+                fh.seek(header["data_offset"] + data_offset)
+                data = fh.read(data_length)
+                digest = tile_digest(data)
+                for i in range(run_length):
+                    yield tile_id + i, data, digest
+
+        yield from walk(header["root_offset"], header["root_length"])
+
+
+def merge_pmtiles(output: str, shards: list) -> None:
+    """Merge PMTiles shards by k-way merging their tile-id ordered contents."""
+    headers = [read_pmtiles_header(shard) for shard in shards]
+    if len({(h["tile_type"], h["tile_compression"]) for h in headers}) > 1:
+        print("Error: shards have different tile types or compressions", file=sys.stderr)
+        sys.exit(1)
+    with open(shards[0], "rb") as fh:
+        fh.seek(headers[0]["metadata_offset"])
+        metadata = json.loads(gzip.decompress(fh.read(headers[0]["metadata_length"])))
+    estimate = sum(h["addressed_tiles"] for h in headers)
+    print(f"Merging {len(shards)} shards, {estimate:,} tiles → {output}", flush=True)
+
+    t_start = time.time()
+    duplicates = 0
+    with open(output, "wb") as out:
+        writer = PMTilesWriter(out)
+        # Ties go to the earlier shard: the first copy of a tile wins
+        for tile_id, data, digest in heapq.merge(*map(iter_pmtiles, shards), key=itemgetter(0)):
+            if not writer.add(tile_id, data, digest):
+                duplicates += 1
+            elif writer.tiles % BATCH_SIZE == 0:
+                report_progress(writer.tiles, estimate, t_start)
+        # Like pack_pmtiles, bounds come from the deepest zoom level
+        max_zoom = max(h["max_zoom"] for h in headers)
+        deepest = [h for h in headers if h["max_zoom"] == max_zoom]
+        writer.finish(
+            metadata,
+            headers[0]["tile_type"],
+            headers[0]["tile_compression"],
+            min(h["min_zoom"] for h in headers),
+            max_zoom,
+            (
+                min(h["min_lon_e7"] for h in deepest) / 1e7,
+                min(h["min_lat_e7"] for h in deepest) / 1e7,
+                max(h["max_lon_e7"] for h in deepest) / 1e7,
+                max(h["max_lat_e7"] for h in deepest) / 1e7,
+            ),
+        )
+
+    elapsed = time.time() - t_start
+    if duplicates:
+        print(f"Warning: {duplicates:,} tiles present in several shards, kept the first", flush=True)
+    print(
+        f"Done: {writer.tiles:,} tiles ({len(writer.blobs):,} unique, "
+        f"{len(writer.entries):,} directory entries) → {output}  ({elapsed/60:.1f} min)",
+        flush=True,
+    )
+
+
+MBTILES_FLAT_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tiles (
+        zoom_level  INTEGER NOT NULL,
+        tile_column INTEGER NOT NULL,
+        tile_row    INTEGER NOT NULL,
+        tile_data   BLOB    NOT NULL,
+        UNIQUE(zoom_level, tile_column, tile_row)
+    );
+"""
+
+MBTILES_DEDUPE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS map (
+        zoom_level  INTEGER NOT NULL,
+        tile_column INTEGER NOT NULL,
+        tile_row    INTEGER NOT NULL,
+        tile_id     TEXT    NOT NULL,
+        UNIQUE(zoom_level, tile_column, tile_row)
+    );
+    CREATE TABLE IF NOT EXISTS images (
+        tile_id   TEXT PRIMARY KEY,
+        tile_data BLOB NOT NULL
+    );
+    CREATE VIEW IF NOT EXISTS tiles AS
+        SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+               map.tile_row AS tile_row, images.tile_data AS tile_data
+        FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+
+class TileWriter:
+    """Insert tile batches on a dedicated thread, fed through a bounded queue.
+
+    All inserts run in one long transaction, committed every
+    CHECKPOINT_TILES tiles, so the readers never block on SQLite. Finished
+    columns passed along with a batch are recorded in pack_progress in the
+    same transaction as their tiles. An insert error is re-raised by the
+    next put() or by close().
+    """
+
+    def __init__(self, conn: sqlite3.Connection, dedupe: bool):
+        self.conn = conn
+        self.dedupe = dedupe
+        self.error = None
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_BATCHES)
+        self.thread = threading.Thread(target=self._run, name="mbtiles-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, batch, images, finished=()) -> None:
+        if self.error:
+            raise self.error
+        self.queue.put((batch, images, finished))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _insert(self, batch, images, finished):
+        if self.dedupe:
+            self.conn.executemany("INSERT OR IGNORE INTO images VALUES (?,?)", images)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO map VALUES (?,?,?,?)",
+                [(z, x, y, digest) for z, x, y, _, digest in batch],
+            )
+        else:
+            self.conn.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)", batch)
+        if finished:
+            self.conn.executemany("INSERT OR IGNORE INTO pack_progress VALUES (?,?)", finished)
+
+    def _run(self):
+        uncommitted = 0
+        while (item := self.queue.get()) is not None:
+            if self.error:
+                continue  # keep draining so put() never blocks on a dead writer
+            try:
+                self._insert(*item)
+                uncommitted += len(item[0])
+                if uncommitted >= CHECKPOINT_TILES:
+                    self.conn.commit()
+                    uncommitted = 0
+            except Exception as exc:
+                self.error = exc
+        if not self.error:
+            try:
+                self.conn.commit()
+            except Exception as exc:
+                self.error = exc
+
+
+def resume_state(conn: sqlite3.Connection, rows_table: str) -> set:
+    """Finished (z, x) columns of an interrupted pack; drops rows of unfinished ones.
+
+    The checkpoint that was in progress when the pack died may have committed
+    part of a column; its rows are deleted so the column is repacked whole.
+    """
+    done = set(conn.execute("SELECT zoom_level, tile_column FROM pack_progress"))
+    partial = [
+        column
+        for column in conn.execute(f"SELECT DISTINCT zoom_level, tile_column FROM {rows_table}")
+        if column not in done
+    ]
+    for z, x in partial:
+        conn.execute(f"DELETE FROM {rows_table} WHERE zoom_level = ? AND tile_column = ?", (z, x))
+    conn.commit()
+    if partial:
+        print(f"Discarded {len(partial):,} partially written columns", flush=True)
+    return done
+
+
+def open_mbtiles(output: str, dedupe: bool, resume: bool):
+    """Open output for packing; returns the connection and whether a pack was interrupted."""
+    # Used by the writer thread while packing, by the main thread before and after
+    conn = sqlite3.connect(output, check_same_thread=False)
+    existing = conn.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()
+    if existing and existing[0] != ("view" if dedupe else "table"):
+        layout = "flat" if existing[0] == "table" else "deduplicated"
+        print(
+            f"Error: {output} already has a {layout} tiles layout — delete it or "
+            f"{'drop' if dedupe else 'add'} --dedupe",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    interrupted = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'pack_progress'"
+    ).fetchone()
+    if resume:
+        # Every commit must survive a kill, so the build is journaled
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    else:
+        # No journal while building: the file is scratch until the final check
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
     conn.execute("PRAGMA cache_size=-131072")  # 128MB cache
-    conn.executescript("""
-        CREATE TABLE IF NOT EXISTS tiles (
+    conn.executescript((MBTILES_DEDUPE_SCHEMA if dedupe else MBTILES_FLAT_SCHEMA) + """
+        CREATE TABLE IF NOT EXISTS pack_progress (
             zoom_level  INTEGER NOT NULL,
             tile_column INTEGER NOT NULL,
-            tile_row    INTEGER NOT NULL,
-            tile_data   BLOB    NOT NULL,
-            UNIQUE(zoom_level, tile_column, tile_row)
+            PRIMARY KEY (zoom_level, tile_column)
         );
-        CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
         INSERT OR REPLACE INTO metadata VALUES ('name',    'ghsl');
         INSERT OR REPLACE INTO metadata VALUES ('format',  'webp');
         INSERT OR REPLACE INTO metadata VALUES ('type',    'overlay');
         INSERT OR REPLACE INTO metadata VALUES ('version', '1.0');
     """)
+    return conn, bool(interrupted)
+
+
+def finish_mbtiles(conn: sqlite3.Connection, output: str, dedupe: bool) -> None:
+    """Drop the progress table, restore journaling, integrity-check and report."""
+    conn.execute("DROP TABLE pack_progress")
+    conn.commit()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    check = conn.execute("PRAGMA quick_check").fetchone()[0]
+    if check != "ok":
+        print(f"Error: {output} failed its integrity check: {check}", file=sys.stderr)
+        sys.exit(1)
+
+    if dedupe:
+        # Whole-file figures, so a resumed pack reports the same as a single run
+        images, stored = conn.execute("SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM images").fetchone()
+        tiles, logical = conn.execute(
+            "SELECT COUNT(*), SUM(LENGTH(images.tile_data)) FROM map JOIN images USING (tile_id)"
+        ).fetchone()
+        if images:
+            print(
+                f"Dedupe: {images:,} unique images for {tiles:,} tiles ({tiles / images:.2f}:1), "
+                f"{stored / 1e6:,.0f} MB stored for {logical / 1e6:,.0f} MB of tiles",
+                flush=True,
+            )
+    conn.close()
+
+
+def pack(
+    tiles_dir: str,
+    output: str,
+    num_readers: int = 16,
+    dedupe: bool = False,
+    resume: bool = False,
+) -> None:
+    conn, interrupted = open_mbtiles(output, dedupe, resume)
+    rows_table = "map" if dedupe else "tiles"
+    # Only an interrupted pack leaves pack_progress behind; otherwise start over in place
+    done = resume_state(conn, rows_table) if resume and interrupted else set()
+    if not done:
+        conn.execute("DELETE FROM pack_progress")
+        conn.commit()
 
     written = 0
     batch = []
-    t_start = time.time()
-    t_last = t_start
-
-    with ThreadPoolExecutor(max_workers=num_readers) as pool:
-        for tile in pool.map(read_tile, tasks, chunksize=500):
-            batch.append(tile)
-            if len(batch) >= BATCH_SIZE:
-                conn.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)", batch)
-                conn.commit()
-                written += len(batch)
-                batch = []
-                now = time.time()
-                rate = written / (now - t_start)
-                pct = written / total_tiles * 100
-                eta = (total_tiles - written) / rate if rate > 0 else 0
-                print(
-                    f"  {written:>8,} / {total_tiles:,} tiles  ({pct:.1f}%)  "
-                    f"{rate:.0f} tiles/s  ETA {eta/60:.1f}min",
-                    flush=True,
-                )
-                t_last = now
-
-    if batch:
-        conn.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)", batch)
-        conn.commit()
-        written += len(batch)
+    finished = []  # columns whose last tile is in batch or an earlier one
+    column = None
+    # Digests of the payloads already in `images`, so duplicates are never sent to SQLite
+    seen = {row[0] for row in conn.execute("SELECT tile_id FROM images")} if dedupe else None
+    new_images = []
 
-    conn.close()
+    reader = read_tile_hashed if dedupe else read_tile
+    tuner = ReadTuner(num_readers, high=4 * num_readers)
+    writer = TileWriter(conn, dedupe)
+    try:
+        with ThreadPoolExecutor(max_workers=tuner.high) as pool:
+            columns, estimate = scan(tiles_dir, pool, num_readers, done)
+            t_start = tuner.t_last = time.time()
+            # Bottom-up columns give (z, x, tms_y) order: appends to the UNIQUE index
+            tiles = iter_tiles(columns, pool, 2 * num_readers, tms=True)
+            for tile in bounded_map(pool, reader, tiles, tuner):
+                # Tiles arrive column by column: a new column means the last one is complete
+                if tile[:2] != column:
+                    if column is not None:
+                        finished.append(column)
+                    column = tile[:2]
+                batch.append(tile)
+                if dedupe:
+                    data, digest = tile[3], tile[4]
+                    if digest not in seen:
+                        seen.add(digest)
+                        new_images.append((digest, data))
+                if len(batch) >= BATCH_SIZE:
+                    writer.put(batch, new_images, finished)
+                    written += len(batch)
+                    batch, new_images, finished = [], [], []
+                    tuner.update(BATCH_SIZE)
+                    report_progress(written, estimate, t_start, tuner.readers)
+
+        if column is not None:
+            finished.append(column)
+        if batch or finished:
+            writer.put(batch, new_images, finished)
+            written += len(batch)
+    finally:
+        writer.close()
+
+    finish_mbtiles(conn, output, dedupe)
     elapsed = time.time() - t_start
     print(f"Done: {written:,} tiles → {output}  ({elapsed/60:.1f} min)", flush=True)
 
 
+def merge_mbtiles(output: str, shards: list, dedupe: bool = False) -> None:
+    """Merge MBTiles shards by k-way merging their (z, x, tms_y) ordered tiles."""
+    conn, _ = open_mbtiles(output, dedupe, resume=False)
+    conn.execute("DELETE FROM pack_progress")
+    seen = {row[0] for row in conn.execute("SELECT tile_id FROM images")} if dedupe else None
+    # One connection per shard, for both the count and the merge cursor
+    shard_conns = []
+    try:
+        for shard in shards:
+            shard_conns.append(sqlite3.connect(shard))
+        estimate = sum(
+            shard_conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+            for shard_conn in shard_conns
+        )
+        # The tiles index (or view) hands every shard over in key order
+        cursors = [
+            shard_conn.execute(
+                "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles "
+                "ORDER BY zoom_level, tile_column, tile_row"
+            )
+            for shard_conn in shard_conns
+        ]
+        print(f"Merging {len(shards)} shards, {estimate:,} tiles → {output}", flush=True)
+
+        t_start = time.time()
+        written = duplicates = 0
+        batch, new_images = [], []
+        last = None
+        writer = TileWriter(conn, dedupe)
+        try:
+            # Ties go to the earlier shard: the first copy of a tile wins
+            for tile in heapq.merge(*cursors, key=itemgetter(0, 1, 2)):
+                if tile[:3] == last:
+                    duplicates += 1
+                    continue
+                last = tile[:3]
+                if dedupe:
+                    digest = tile_digest(tile[3])
+                    tile += (digest,)
+                    if digest not in seen:
+                        seen.add(digest)
+                        new_images.append((digest, tile[3]))
+                batch.append(tile)
+                if len(batch) >= BATCH_SIZE:
+                    writer.put(batch, new_images)
+                    written += len(batch)
+                    batch, new_images = [], []
+                    report_progress(written, estimate, t_start)
+            if batch:
+                writer.put(batch, new_images)
+                written += len(batch)
+        finally:
+            writer.close()
+
+        finish_mbtiles(conn, output, dedupe)
+        elapsed = time.time() - t_start
+        if duplicates:
+            print(
+                f"Warning: {duplicates:,} tiles present in several shards, kept the first",
+                flush=True,
+            )
+        print(f"Done: {written:,} tiles → {output}  ({elapsed/60:.1f} min)", flush=True)
+    finally:
+        for shard_conn in shard_conns:
+            shard_conn.close()
+
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="pack_mbtiles.py merge",
+        description="Merge shard archives packed from disjoint tile directories",
+    )
+    parser.add_argument("output", help="Output .mbtiles or .pmtiles file")
+    parser.add_argument("shards", nargs="+", help="Shard archives, all in the output's format")
+    parser.add_argument("--dedupe", action="store_true", help="MBTiles: deduplicated layout")
+    parser.add_argument(
+        "--force", action="store_true", help="Merge even if the shards are unchanged"
+    )
+    args = parser.parse_args(argv)
+    fmt = "pmtiles" if args.output.endswith(".pmtiles") else "mbtiles"
+    if any(shard.endswith(".pmtiles") != (fmt == "pmtiles") for shard in args.shards):
+        parser.error(f"all shards must be {fmt} files, like the output")
+    if fmt == "pmtiles" and args.dedupe:
+        parser.error("--dedupe applies to MBTiles output (PMTiles always deduplicates)")
+
+    cache = BuildCache() if BuildCache else None
+    key = cache.key([__file__], args.shards, {"merge": fmt, "dedupe": args.dedupe}) if cache else None
+    if cache and cache.check(args.output, key, force=args.force):
+        sys.exit(0)
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    if fmt == "pmtiles":
+        merge_pmtiles(args.output, args.shards)
+    else:
+        merge_mbtiles(args.output, args.shards, dedupe=args.dedupe)
+    if cache:
+        cache.record(args.output, key)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print(f"Usage: {sys.argv[0]} <tiles_dir> <output.mbtiles> [num_readers]")
-        sys.exit(1)
-    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 16
-    pack(sys.argv[1], sys.argv[2], readers)
+    if sys.argv[1:2] == ["merge"]:
+        merge_main(sys.argv[2:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description="Pack an XYZ tile directory into MBTiles or PMTiles"
+    )
+    parser.add_argument("tiles_dir", help="XYZ tile directory ({z}/{x}/{y}.ext)")
+    parser.add_argument("output", help="Output .mbtiles or .pmtiles file")
+    parser.add_argument(
+        "num_readers", nargs="?", type=int, default=16, help="Parallel tile readers (default: 16)"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["mbtiles", "pmtiles"],
+        help="Output format (default: from the output extension)",
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="MBTiles: store each distinct tile once (map/images tables + tiles view)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="MBTiles: journaled build that records finished columns; rerun to continue after a kill",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Repack even if the tile directory is unchanged"
+    )
+    args = parser.parse_args()
+    fmt = args.format or ("pmtiles" if args.output.endswith(".pmtiles") else "mbtiles")
+    if fmt == "pmtiles" and (args.dedupe or args.resume):
+        parser.error("--dedupe and --resume apply to MBTiles output (PMTiles always deduplicates)")
+
+    # The tile tree is fingerprinted by its column directories only: walking
+    # millions of tiles would delay the start of packing by minutes on GPFS
+    cache = BuildCache() if BuildCache else None
+    key = None
+    if cache:
+        key = cache.key(
+            [__file__],
+            params={
+                "tiles": tree_fingerprint(args.tiles_dir),
+                "format": fmt,
+                "dedupe": args.dedupe,
+            },
+        )
+    if cache and cache.check(args.output, key, force=args.force):
+        sys.exit(0)
+    if fmt == "pmtiles":
+        pack_pmtiles(args.tiles_dir, args.output, args.num_readers)
+    else:
+        pack(args.tiles_dir, args.output, args.num_readers, dedupe=args.dedupe, resume=args.resume)
+    if cache:
+        cache.record(args.output, key)
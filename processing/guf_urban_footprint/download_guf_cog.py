@@ -4,13 +4,23 @@ Download DLR Global Urban Footprint (GUF) data and convert to Cloud Optimized Ge
 
 This script downloads urban footprint data from the DLR WMS service and creates
 a Cloud Optimized GeoTIFF (COG) for efficient web visualization with deck.gl.
+
+Tiles are fetched concurrently (--concurrency) over keep-alive connections,
+spaced to --rate requests per second and retried with exponential backoff; a
+tile that still fails aborts the run instead of leaving a hole of nodata in
+the COG. Fetched tiles are cached, so a rerun resumes where it stopped.
+--wms-url points the script at another WMS, e.g. a local stand-in server.
 """
 
 import argparse
 import hashlib
 import math
 import os
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 from pathlib import Path
 from typing import Optional, Tuple
@@ -30,6 +40,9 @@ except ImportError:
     print("Error: rasterio not installed. Install with: pip install rasterio")
     sys.exit(1)
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from build_cache import BuildCache  # noqa: E402
+
 
 # Predefined regions (west, south, east, north)
 REGIONS = {
@@ -47,75 +60,196 @@ WMS_LAYERS = {
     "2.8": "GUF28_DLR_v1_Mosaic",  # ~84m resolution
 }
 
+WMS_URL = "https://geoservice.dlr.de/eoc/land/wms"
 
-def get_wms_tile(
-    bbox: Tuple[float, float, float, float],
-    width: int,
-    height: int,
-    layer: str,
-    cache_dir: Optional[Path] = None,
-) -> np.ndarray:
-    """
-    Fetch a single tile from DLR WMS service with optional caching.
+# Tile requests in flight, and requests per second allowed to the WMS host
+CONCURRENCY = 8
+RATE = 10.0
+# Retries per tile; the first waits BACKOFF seconds, each next one twice as long
+RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# HTTP statuses worth retrying: rate limiting and server-side failures
+RETRY_STATUS = {429, 500, 502, 503, 504}
 
-    Args:
-        bbox: (west, south, east, north) in EPSG:4326
-        width: Image width in pixels
-        height: Image height in pixels
-        layer: WMS layer name
-        cache_dir: Optional directory to cache downloaded tiles
 
-    Returns:
-        numpy array of shape (height, width) with uint8 values
-    """
-    west, south, east, north = bbox
+class TileFetchError(RuntimeError):
+    """A WMS tile could not be fetched."""
 
-    # Check cache first
-    if cache_dir:
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        # Create unique filename based on bbox, dimensions, and layer
-        cache_key = f"{layer}_{west}_{south}_{east}_{north}_{width}_{height}"
-        cache_hash = hashlib.md5(cache_key.encode()).hexdigest()
-        cache_file = cache_dir / f"tile_{cache_hash}.npy"
 
-        if cache_file.exists():
-            return np.load(cache_file)
+class RateLimiter:
+    """Space calls out to at most `rate` per second, across threads (0 = no limit)."""
 
-    params = {
-        "SERVICE": "WMS",
-        "VERSION": "1.3.0",
-        "REQUEST": "GetMap",
-        "LAYERS": layer,
-        "STYLES": "",
-        "CRS": "EPSG:4326",
-        "BBOX": f"{south},{west},{north},{east}",  # WMS 1.3.0 with EPSG:4326 uses lat,lon order
-        "WIDTH": str(width),
-        "HEIGHT": str(height),
-        "FORMAT": "image/png",
-        "TRANSPARENT": "false",
-    }
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
 
-    url = f"https://geoservice.dlr.de/eoc/land/wms?{urlencode(params)}"
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
 
-    try:
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
 
-        img = Image.open(BytesIO(response.content))
-        # Convert to numpy array and take first channel (all channels are the same for grayscale)
-        arr = np.array(img)
-        if arr.ndim == 3:
-            arr = arr[:, :, 0]
+class TileFetcher:
+    """
+    Fetch WMS tiles from several threads over pooled keep-alive connections.
+
+    Each worker thread keeps its own requests.Session, so consecutive tiles
+    reuse the connection instead of a new TCP/TLS handshake per tile. All
+    requests to the WMS host share one RateLimiter. A connection error,
+    timeout, 429/5xx response or a WMS exception returned instead of an
+    image is retried with exponential backoff and jitter (honouring
+    Retry-After); other HTTP errors, and a tile still failing after
+    `retries` retries, raise TileFetchError.
+    """
+
+    def __init__(
+        self,
+        url: str = WMS_URL,
+        concurrency: int = CONCURRENCY,
+        rate: float = RATE,
+        retries: int = RETRIES,
+        timeout: float = 60,
+        cache_dir: Optional[Path] = None,
+    ):
+        self.url = url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.limiter = RateLimiter(rate)
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _cache_file(self, bbox, width: int, height: int, layer: str) -> Path:
+        west, south, east, north = bbox
+        # Create unique filename based on bbox, dimensions, and layer; the
+        # default URL is left out so tiles cached by earlier runs stay valid
+        cache_key = f"{layer}_{west}_{south}_{east}_{north}_{width}_{height}"
+        if self.url != WMS_URL:
+            cache_key = f"{self.url}_{cache_key}"
+        cache_hash = hashlib.md5(cache_key.encode()).hexdigest()
+        return self.cache_dir / f"tile_{cache_hash}.npy"
+
+    def _request(self, url: str, width: int, height: int) -> np.ndarray:
+        error = retry_after = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1))
+                time.sleep(retry_after or delay * random.uniform(0.5, 1.0))
+            retry_after = None
+            self.limiter.wait()
+            try:
+                response = self._session().get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+                continue
+
+            if response.status_code in RETRY_STATUS:
+                error = f"HTTP {response.status_code}"
+                value = response.headers.get("Retry-After", "")
+                retry_after = min(MAX_BACKOFF, float(value)) if value.isdigit() else None
+                continue
+            if not response.ok:
+                raise TileFetchError(f"HTTP {response.status_code}: {response.text[:200]}")
+            if not response.headers.get("Content-Type", "").startswith("image/"):
+                # WMS servers report errors as an XML ServiceException with status 200
+                error = f"not an image: {response.text[:200]}"
+                continue
+
+            try:
+                img = Image.open(BytesIO(response.content))
+                # Convert to numpy array and take first channel (all channels are the same for grayscale)
+                arr = np.array(img)
+            except OSError as e:
+                error = f"unreadable image: {e}"
+                continue
+            if arr.ndim == 3:
+                arr = arr[:, :, 0]
+            if arr.shape != (height, width):
+                raise TileFetchError(
+                    f"expected {width}x{height} pixels, got {arr.shape[1]}x{arr.shape[0]}"
+                )
+            return arr
+
+        raise TileFetchError(f"failed after {self.retries + 1} attempts: {error}")
+
+    def get(
+        self,
+        bbox: Tuple[float, float, float, float],
+        width: int,
+        height: int,
+        layer: str,
+    ) -> np.ndarray:
+        """
+        Fetch a single tile from the WMS service, or from the tile cache.
+
+        Args:
+            bbox: (west, south, east, north) in EPSG:4326
+            width: Image width in pixels
+            height: Image height in pixels
+            layer: WMS layer name
+
+        Returns:
+            numpy array of shape (height, width) with uint8 values
+        """
+        west, south, east, north = bbox
+
+        # Check cache first
+        if self.cache_dir:
+            cache_file = self._cache_file(bbox, width, height, layer)
+            if cache_file.exists():
+                return np.load(cache_file)
+
+        params = {
+            "SERVICE": "WMS",
+            "VERSION": "1.3.0",
+            "REQUEST": "GetMap",
+            "LAYERS": layer,
+            "STYLES": "",
+            "CRS": "EPSG:4326",
+            "BBOX": f"{south},{west},{north},{east}",  # WMS 1.3.0 with EPSG:4326 uses lat,lon order
+            "WIDTH": str(width),
+            "HEIGHT": str(height),
+            "FORMAT": "image/png",
+            "TRANSPARENT": "false",
+        }
+        separator = "&" if "?" in self.url else "?"
+        url = f"{self.url}{separator}{urlencode(params)}"
+
+        try:
+            arr = self._request(url, width, height)
+        except TileFetchError as e:
+            raise TileFetchError(f"tile {bbox}: {e}") from None
 
-        # Save to cache
-        if cache_dir:
-            np.save(cache_file, arr)
+        # Save to cache (renamed into place, so an interrupted run leaves no partial tile)
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = cache_file.with_name(f"{cache_file.stem}.{threading.get_ident()}.tmp.npy")
+            np.save(tmp, arr)
+            os.replace(tmp, cache_file)
 
         return arr
-    except Exception as e:
-        print(f"Error fetching tile {bbox}: {e}")
-        # Return nodata array
-        return np.full((height, width), 128, dtype=np.uint8)
+
+    def close(self) -> None:
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
 
 
 def create_cog(
@@ -125,6 +259,7 @@ def create_cog(
     tile_size: int = 2048,
     max_pixels: int = 50000,
     cache_dir: Optional[Path] = None,
+    fetcher: Optional[TileFetcher] = None,
 ) -> None:
     """
     Download GUF data and create a Cloud Optimized GeoTIFF with optional tile caching.
@@ -135,9 +270,15 @@ def create_cog(
         resolution: "0.4" for ~12m or "2.8" for ~84m
         tile_size: Size of WMS request tiles in pixels
         max_pixels: Maximum dimension in pixels (to prevent too large files)
+        cache_dir: Tile cache directory (ignored when a fetcher is given)
+        fetcher: TileFetcher to download with (default: the DLR WMS)
+
+    Raises:
+        TileFetchError: a tile could not be fetched; the COG is not written
     """
     west, south, east, north = bbox
     layer = WMS_LAYERS[resolution]
+    fetcher = fetcher or TileFetcher(cache_dir=cache_dir)
 
     # Calculate approximate resolution in degrees
     res_arcsec = float(resolution)
@@ -173,38 +314,42 @@ def create_cog(
     # Create output array
     data = np.zeros((height, width), dtype=np.uint8)
 
-    # Download tiles with progress bar
-    with tqdm(total=total_tiles, desc="Downloading tiles") as pbar:
-        for ty in range(n_tiles_y):
-            for tx in range(n_tiles_x):
-                # Calculate tile bounds in pixels
-                x_start = tx * tile_size
-                y_start = ty * tile_size
-                x_end = min(x_start + tile_size, width)
-                y_end = min(y_start + tile_size, height)
-
-                tile_width = x_end - x_start
-                tile_height = y_end - y_start
-
-                # Calculate geographic bounds for this tile
-                tile_west = west + (x_start / width) * (east - west)
-                tile_east = west + (x_end / width) * (east - west)
-                tile_north = north - (y_start / height) * (north - south)
-                tile_south = north - (y_end / height) * (north - south)
-
-                # Fetch tile
-                tile_data = get_wms_tile(
-                    (tile_west, tile_south, tile_east, tile_north),
-                    tile_width,
-                    tile_height,
-                    layer,
-                    cache_dir,
-                )
-
-                # Place in output array
-                data[y_start:y_end, x_start:x_end] = tile_data
+    # Download tiles concurrently with progress bar
+    pool = ThreadPoolExecutor(max_workers=fetcher.concurrency)
+    futures = {}
+    for ty in range(n_tiles_y):
+        for tx in range(n_tiles_x):
+            # Calculate tile bounds in pixels
+            x_start = tx * tile_size
+            y_start = ty * tile_size
+            x_end = min(x_start + tile_size, width)
+            y_end = min(y_start + tile_size, height)
+
+            # Calculate geographic bounds for this tile
+            tile_west = west + (x_start / width) * (east - west)
+            tile_east = west + (x_end / width) * (east - west)
+            tile_north = north - (y_start / height) * (north - south)
+            tile_south = north - (y_end / height) * (north - south)
+
+            future = pool.submit(
+                fetcher.get,
+                (tile_west, tile_south, tile_east, tile_north),
+                x_end - x_start,
+                y_end - y_start,
+                layer,
+            )
+            futures[future] = (slice(y_start, y_end), slice(x_start, x_end))
 
+    try:
+        with tqdm(total=total_tiles, desc="Downloading tiles") as pbar:
+            for future in as_completed(futures):
+                # Place in output array; popping the future frees its tile
+                data[futures.pop(future)] = future.result()
                 pbar.update(1)
+    finally:
+        # On failure, drop the tiles not started yet; ones in flight finish (and are cached)
+        pool.shutdown(cancel_futures=True)
+        fetcher.close()
 
     print("Creating Cloud Optimized GeoTIFF...")
 
@@ -311,6 +456,34 @@ def main():
         default="tile_cache",
         help="Directory to cache downloaded tiles (default: tile_cache)",
     )
+    parser.add_argument(
+        "--wms-url",
+        default=WMS_URL,
+        help=f"WMS endpoint to fetch tiles from. Default: {WMS_URL}",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Tile requests in flight. Default: {CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=RATE,
+        help=f"Maximum requests per second to the WMS host (0 = no limit). Default: {RATE:g}",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help=f"Retries per tile, with exponential backoff. Default: {RETRIES}",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild the COG even if it is up to date for these parameters",
+    )
 
     args = parser.parse_args()
 
@@ -345,16 +518,44 @@ def main():
     # Setup cache directory
     cache_dir = Path(__file__).parent / args.cache_dir if args.cache_dir else None
 
-    # Create COG
-    create_cog(
-        bbox=bbox,
-        output_path=output_path,
-        resolution=args.resolution,
-        tile_size=args.tile_size,
-        max_pixels=args.max_pixels,
+    # The WMS mosaic is static, so the key only covers the request parameters
+    params = {
+        "bbox": list(bbox),
+        "layer": WMS_LAYERS[args.resolution],
+        "tile_size": args.tile_size,
+        "max_pixels": args.max_pixels,
+    }
+    if args.wms_url != WMS_URL:
+        params["wms_url"] = args.wms_url
+    cache = BuildCache()
+    key = cache.key([__file__], params=params)
+    if cache.check(output_path, key, force=args.force):
+        return
+
+    fetcher = TileFetcher(
+        url=args.wms_url,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        retries=args.retries,
         cache_dir=cache_dir,
     )
 
+    # Create COG
+    try:
+        create_cog(
+            bbox=bbox,
+            output_path=output_path,
+            resolution=args.resolution,
+            tile_size=args.tile_size,
+            max_pixels=args.max_pixels,
+            fetcher=fetcher,
+        )
+    except TileFetchError as e:
+        print(f"Error: {e}")
+        print("Tiles fetched so far are cached; rerun to resume.")
+        sys.exit(1)
+    cache.record(output_path, key)
+
 
 if __name__ == "__main__":
     main()
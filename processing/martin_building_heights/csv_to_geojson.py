@@ -2,63 +2,91 @@
 """
 Convert building heights CSV to GeoJSON format.
 Creates point features with ~25km² grid cells for visualization.
+
+Rows are streamed from the CSV to the output, so memory stays flat. An output
+of `-` writes newline-delimited features to stdout for tippecanoe:
+
+    python3 csv_to_geojson.py city_height_obs_vs_sim.csv - | tippecanoe ...
 """
 
+import argparse
 import csv
-import json
+import math
+import sys
 from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from build_cache import BuildCache  # noqa: E402
+from feature_io import FeatureWriter, is_stdout  # noqa: E402
+
+
+def _widen(bounds, value):
+    """Grow a [min, max] pair in place to include value."""
+    bounds[0], bounds[1] = min(bounds[0], value), max(bounds[1], value)
+
+
+def _features(reader, years, heights):
+    for row in reader:
+        # Parse coordinates
+        lon = float(row["x"])
+        lat = float(row["y"])
+
+        # Parse height values
+        height_fit = float(row["height_fit"])
+        sim_height_fit = float(row["sim_height_fit"])
+
+        # Parse year (extract year from date string)
+        year_str = row["year"]
+        year = int(year_str.split("-")[0])
+        _widen(years, year)
+        _widen(heights, height_fit)
+
+        # Create GeoJSON feature
+        yield {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {
+                "city": row["city"],
+                "height_fit": height_fit,
+                "sim_height_fit": sim_height_fit,
+                "year": year,
+            },
+        }
 
 
 def csv_to_geojson(input_csv, output_geojson):
-    """Convert CSV with building height data to GeoJSON."""
-
-    features = []
-
-    with open(input_csv, "r") as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        for row in reader:
-            # Parse coordinates
-            lon = float(row["x"])
-            lat = float(row["y"])
-
-            # Parse height values
-            height_fit = float(row["height_fit"])
-            sim_height_fit = float(row["sim_height_fit"])
-
-            # Parse year (extract year from date string)
-            year_str = row["year"]
-            year = int(year_str.split("-")[0])
-
-            # Create GeoJSON feature
-            feature = {
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": [lon, lat]},
-                "properties": {
-                    "city": row["city"],
-                    "height_fit": height_fit,
-                    "sim_height_fit": sim_height_fit,
-                    "year": year,
-                },
-            }
-
-            features.append(feature)
-
-    # Create GeoJSON FeatureCollection
-    geojson = {"type": "FeatureCollection", "features": features}
-
-    # Write to output file
-    with open(output_geojson, "w") as outfile:
-        json.dump(geojson, outfile)
-
-    print(f"Converted {len(features)} features to GeoJSON")
-    print(
-        f"Year range: {min(f['properties']['year'] for f in features)} - {max(f['properties']['year'] for f in features)}"
-    )
-    print(
-        f"Height range: {min(f['properties']['height_fit'] for f in features):.2f} - {max(f['properties']['height_fit'] for f in features):.2f} meters"
-    )
+    """Convert CSV with building height data to GeoJSON ('-' streams to stdout)."""
+
+    years, heights = [math.inf, -math.inf], [math.inf, -math.inf]
+    with open(input_csv, "r") as csvfile, FeatureWriter(output_geojson) as writer:
+        writer.write(_features(csv.DictReader(csvfile), years, heights))
+
+    # Progress goes to stderr: stdout may be the feature stream
+    print(f"Converted {writer.count} features to GeoJSON", file=sys.stderr)
+    if not writer.count:
+        return
+    print(f"Year range: {years[0]} - {years[1]}", file=sys.stderr)
+    print(f"Height range: {heights[0]:.2f} - {heights[1]:.2f} meters", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    csv_to_geojson("city_height_obs_vs_sim.csv", "building_heights_china.geojson")
+    parser = argparse.ArgumentParser(description="Convert building heights CSV to GeoJSON")
+    parser.add_argument("input", nargs="?", default="city_height_obs_vs_sim.csv")
+    parser.add_argument("output", nargs="?", default="building_heights_china.geojson")
+    parser.add_argument(
+        "--force", action="store_true", help="Rebuild even if the output is up to date"
+    )
+    args = parser.parse_args()
+
+    if is_stdout(args.output):
+        # Output piped to stdout is always rebuilt
+        csv_to_geojson(args.input, args.output)
+        sys.exit(0)
+
+    cache = BuildCache()
+    scripts = [__file__, Path(__file__).resolve().parent.parent / "feature_io.py"]
+    key = cache.key(scripts, [args.input])
+    if not cache.check(args.output, key, force=args.force):
+        csv_to_geojson(args.input, args.output)
+        cache.record(args.output, key)
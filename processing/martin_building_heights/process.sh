@@ -1,29 +1,41 @@
 #!/bin/bash
-set -e
+set -eo pipefail
 
 # Script to convert building heights CSV to PMTiles format
 # Input: city_height_obs_vs_sim.csv
 # Output: ../../frontend/public/geodata/building_heights_china.pmtiles
+# Features are streamed as GeoJSONSeq straight into tippecanoe, with no
+# intermediate GeoJSON file. The step is skipped when its inputs are unchanged
+# (see ../build_cache.py); set FORCE=1 to rebuild everything.
 
-echo "Converting CSV to GeoJSON..."
-python3 csv_to_geojson.py
+INPUT_CSV=city_height_obs_vs_sim.csv
+OUTPUT_PMTILES=../../frontend/public/geodata/building_heights_china.pmtiles
+FORCE_FLAG="${FORCE:+--force}"
+CACHE_ARGS=(
+  "${OUTPUT_PMTILES}"
+  --script process.sh
+  --script csv_to_geojson.py
+  --script ../feature_io.py
+  --inputs "${INPUT_CSV}"
+  --param "tippecanoe=$(tippecanoe --version 2>&1)"
+)
 
-echo "Converting GeoJSON to GeoJSONSeq..."
-ogr2ogr -f GeoJSONSeq building_heights_china.geojsonseq building_heights_china.geojson
+if python3 ../build_cache.py check "${CACHE_ARGS[@]}" ${FORCE_FLAG}; then
+  exit 0
+fi
 
-echo "Converting GeoJSONSeq to PMTiles with tippecanoe..."
-tippecanoe \
-  --output=../../frontend/public/geodata/building_heights_china.pmtiles \
-  --layer=building_heights_china \
-  --force \
-  --maximum-zoom=12 \
-  --minimum-zoom=4 \
-  --base-zoom=8 \
-  --drop-densest-as-needed \
-  --extend-zooms-if-still-dropping \
-  building_heights_china.geojsonseq
+echo "Converting CSV to PMTiles with tippecanoe..."
+python3 csv_to_geojson.py "${INPUT_CSV}" - |
+  tippecanoe \
+    --output="${OUTPUT_PMTILES}" \
+    --layer=building_heights_china \
+    --force \
+    --maximum-zoom=12 \
+    --minimum-zoom=4 \
+    --base-zoom=8 \
+    --drop-densest-as-needed \
+    --extend-zooms-if-still-dropping
 
-echo "Cleaning up intermediate files..."
-rm -f building_heights_china.geojsonseq
+python3 ../build_cache.py record "${CACHE_ARGS[@]}"
 
-echo "Done! PMTiles created at ../../frontend/public/geodata/building_heights_china.pmtiles"
+echo "Done! PMTiles created at ${OUTPUT_PMTILES}"